@@ -1,8 +1,9 @@
 import logging
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import UTC, datetime, timedelta
-from typing import cast
+from typing import Any, cast
 
 import click
 import pulsar
@@ -18,14 +19,31 @@ from accounting_s3_usage.sampler.messager import (
     S3AccessBillingEventMessager,
     S3StorageSamplerMessager,
 )
-from accounting_s3_usage.sampler.metrics import create_athena_table
+from accounting_s3_usage.sampler.metrics import (
+    ACCESS_LOG_BACKEND,
+    LOCAL_ACCESS_LOG_BACKENDS,
+    LOGS_PARTITION_DATE_SOURCE,
+    STORAGE_EVENTS_DB_PATH,
+    STORAGE_SAMPLE_BACKEND,
+    create_athena_table,
+    create_ip_ranges_table,
+    create_rollup_table,
+    get_workspaces_written_since,
+    load_rolled_up_workspaces,
+    refresh_ip_ranges_table,
+    rollup_settled_days,
+    storage_size_cache,
+)
 from accounting_s3_usage.sampler.sample_requests import (
     generate_access_billing_requests,
+    generate_batched_access_billing_requests,
     generate_sample_times,
     generate_storage_sample_requests,
     generate_workspace_s3_access_point_list,
     next_collection_after,
+    parse_workspace_prefix,
 )
+from accounting_s3_usage.sampler.telemetry import athena_costs
 from accounting_s3_usage.sampler.time_utils import wait_until
 
 PULSAR_SERVICE_URL = os.getenv("PULSAR_URL", "pulsar://localhost:6650")
@@ -39,6 +57,24 @@ client: pulsar.Client | None = None
 storage_messager: GeneratorRunner | None = None
 usage_messager: GeneratorRunner | None = None
 
+# When set, access billing queries cover every workspace at once rather than one workspace each.
+batch_all_workspaces = False
+
+# When set, access billing queries cover every pending interval at once rather than one interval each.
+batch_all_intervals = False
+
+# When set, settled days' logs are rolled up into a compact Parquet table before billing.
+rollup_enabled = False
+
+# When set, remote IPs are classified for data transfer by Athena, using a lookup table of AWS's IP
+# ranges refreshed before billing.
+classify_egress_in_athena = False
+
+# How many threads each pipeline processes requests with. The two pipelines run concurrently, so
+# these are separate budgets: listings for storage sampling and Athena queries for access billing.
+storage_sampler_threads = 4
+access_collector_threads = 4
+
 
 def generate_billing_events(last_generation: datetime, interval: timedelta) -> Messager.Failures:
     """This generates and sends all billing events which are new since last_generation."""
@@ -51,6 +87,7 @@ def generate_billing_events(last_generation: datetime, interval: timedelta) -> M
         last_generation,
         interval,
     )
+    athena_costs.reset()
 
     if not storage_messager or not usage_messager:
         assert client is not None
@@ -66,29 +103,87 @@ def generate_billing_events(last_generation: datetime, interval: timedelta) -> M
 
         storage_messager = GeneratorRunner(
             messager=S3StorageSamplerMessager(producer=storage_producer),
-            threads=4,
+            threads=storage_sampler_threads,
             batch_size=2,
             name="storage-sampler",
         )
 
+        # Each batch's Athena queries run concurrently, so larger batches mean more queries in
+        # flight. metrics.ATHENA_MAX_CONCURRENT_QUERIES bounds the total.
         usage_messager = GeneratorRunner(
             messager=S3AccessBillingEventMessager(producer=usage_producer),
-            threads=4,
-            batch_size=2,
+            threads=access_collector_threads,
+            batch_size=10,
             name="access-collector",
         )
 
     ap_list = list(generate_workspace_s3_access_point_list())
 
-    access_billing_requests = generate_access_billing_requests(
-        ap_list,
-        generate_sample_times(last_generation, interval),
-    )
+    # The pipelines share nothing but the list of access points, so a cycle takes as long as the
+    # slower of them rather than both.
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix="pipeline") as executor:
+        usage_future = executor.submit(bill_access, usage_messager, ap_list, last_generation, interval)
+        storage_future = executor.submit(sample_storage, storage_messager, ap_list)
+
+        usage_failures = usage_future.result()
+        storage_failures = storage_future.result()
+
+    athena_costs.log_summary()
+    failures = storage_failures.add(usage_failures)
+
+    if athena_costs.over_budget():
+        # Retrying would only scan more, so stop until someone has looked at why.
+        logging.error(
+            "Athena queries scanned %d bytes, over the budget of %d bytes. Stopping.",
+            athena_costs.total_data_scanned_bytes(),
+            athena_costs.scan_budget_bytes,
+        )
+        failures = failures.add(Messager.Failures(permanent=True))
+
+    return failures
+
+
+def bill_access(
+    runner: GeneratorRunner, ap_list: list[dict[str, Any]], last_generation: datetime, interval: timedelta
+) -> Messager.Failures:
+    """Generates and sends all access billing events for intervals which are new since last_generation."""
+    if rollup_enabled:
+        try:
+            rollup_settled_days([parse_workspace_prefix(ap["Name"]) for ap in ap_list], last_generation)
+        except Exception:
+            # Billing falls back to the raw logs for days which aren't rolled up.
+            logging.exception("Failed to roll up access logs")
+
+    if classify_egress_in_athena:
+        try:
+            refresh_ip_ranges_table()
+        except Exception:
+            # Until the table has been loaded, remote IPs are classified here. After that, the last
+            # IP ranges written are used.
+            logging.exception("Failed to refresh the IP ranges table")
+
+    if batch_all_workspaces or batch_all_intervals:
+        access_billing_requests = generate_batched_access_billing_requests(
+            ap_list,
+            generate_sample_times(last_generation, interval),
+            batch_workspaces=batch_all_workspaces,
+            batch_intervals=batch_all_intervals,
+        )
+    else:
+        access_billing_requests = generate_access_billing_requests(
+            ap_list,
+            generate_sample_times(last_generation, interval),
+        )
+
+    return runner.consume(access_billing_requests)
+
 
-    usage_failures = usage_messager.consume(access_billing_requests)
-    storage_failures = storage_messager.consume(generate_storage_sample_requests(ap_list))
+def sample_storage(runner: GeneratorRunner, ap_list: list[dict[str, Any]]) -> Messager.Failures:
+    """Samples and sends the current storage use of every workspace."""
+    if storage_size_cache is not None:
+        storage_size_cache.refresh_changes(get_workspaces_written_since, datetime.now(UTC))
 
-    return storage_failures.add(usage_failures)
+    return runner.consume(generate_storage_sample_requests(ap_list))
 
 
 @click.command()
@@ -102,7 +197,60 @@ def generate_billing_events(last_generation: datetime, interval: timedelta) -> M
     help="Interval for periodic sampling in the form '1d', '2h', '30m' or '30s'.",
 )
 @click.option("--once", is_flag=True, help="Run sampling once immediately, then exit.")
-def cli(verbose: int, pulsar_url: str, backfill: int, interval: str, once: bool) -> None:
+@click.option(
+    "--batch-workspaces",
+    is_flag=True,
+    help="Query access logs once per interval for all workspaces instead of once per workspace.",
+)
+@click.option(
+    "--batch-intervals",
+    is_flag=True,
+    help="Query access logs once for all pending intervals (such as when back-filling) instead of once per interval.",
+)
+@click.option(
+    "--rollup",
+    is_flag=True,
+    help="Roll settled days' access logs up into a compact Parquet table and bill from that.",
+)
+@click.option(
+    "--athena-egress-classification",
+    is_flag=True,
+    help="Classify remote IPs for data transfer in Athena queries, against a table of AWS's IP ranges.",
+)
+@click.option(
+    "--storage-threads",
+    type=int,
+    default=storage_sampler_threads,
+    show_default=True,
+    help="Threads sampling storage, concurrently with access billing.",
+)
+@click.option(
+    "--access-threads",
+    type=int,
+    default=access_collector_threads,
+    show_default=True,
+    help="Threads generating access billing events, concurrently with storage sampling.",
+)
+@click.option(
+    "--scan-budget-gb",
+    type=float,
+    default=None,
+    help="Stop, rather than start more Athena queries, once a cycle's queries have scanned this many GB.",
+)
+def cli(
+    verbose: int,
+    pulsar_url: str,
+    backfill: int,
+    interval: str,
+    once: bool,
+    batch_workspaces: bool,
+    batch_intervals: bool,
+    rollup: bool,
+    athena_egress_classification: bool,
+    storage_threads: int,
+    access_threads: int,
+    scan_budget_gb: float | None,
+) -> None:
     setup_logging(verbosity=verbose, enable_otel_logging=True)
     log_component_version("eodhp-accounting-s3-usage")
 
@@ -124,10 +272,49 @@ def cli(verbose: int, pulsar_url: str, backfill: int, interval: str, once: bool)
             logging.fatal("Failed to parse --interval")
             sys.exit(2)
 
-    create_athena_table()
+    if ACCESS_LOG_BACKEND in LOCAL_ACCESS_LOG_BACKENDS and not batch_workspaces:
+        # Without batching each workspace would list, download and parse every log object again.
+        logging.fatal(f"ACCESS_LOG_BACKEND={ACCESS_LOG_BACKEND} requires --batch-workspaces")
+        sys.exit(2)
+
+    if rollup and ACCESS_LOG_BACKEND == "athena" and LOGS_PARTITION_DATE_SOURCE != "EventTime":
+        # Each day is rolled up from its partition, which only holds all of that day's logs by EventTime.
+        logging.fatal("--rollup requires WORKSPACE_S3_ACCESS_LOGS_PARTITION_DATE_SOURCE=EventTime")
+        sys.exit(2)
+
+    if STORAGE_SAMPLE_BACKEND == "events" and not STORAGE_EVENTS_DB_PATH:
+        logging.fatal("STORAGE_SAMPLE_BACKEND=events requires STORAGE_EVENTS_DB_PATH")
+        sys.exit(2)
+
+    if scan_budget_gb is not None:
+        athena_costs.scan_budget_bytes = int(scan_budget_gb * 1024**3)
+
+    if ACCESS_LOG_BACKEND == "athena":
+        create_athena_table()
+    # Usage read from the log objects locally never reads the rollup table.
+    rollup = rollup and ACCESS_LOG_BACKEND == "athena"
+    if rollup:
+        create_rollup_table()
+        load_rolled_up_workspaces()
+    if athena_egress_classification and ACCESS_LOG_BACKEND == "athena":
+        create_ip_ranges_table()
 
     logging.info(f"S3 accounting collector starting with interval {interval_td}. Back-filling {backfill} intervals.")
 
+    global batch_all_workspaces
+    global batch_all_intervals
+    global rollup_enabled
+    global classify_egress_in_athena
+    global storage_sampler_threads
+    global access_collector_threads
+    batch_all_workspaces = batch_workspaces
+    batch_all_intervals = batch_intervals
+    rollup_enabled = rollup
+    # Usage read from the log objects locally is always classified here.
+    classify_egress_in_athena = athena_egress_classification and ACCESS_LOG_BACKEND == "athena"
+    storage_sampler_threads = storage_threads
+    access_collector_threads = access_threads
+
     global client
     client = pulsar.Client(pulsar_url)
 
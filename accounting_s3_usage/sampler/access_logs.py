@@ -0,0 +1,511 @@
+import calendar
+import codecs
+import logging
+import mmap
+import multiprocessing
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from collections.abc import Callable, Collection, Iterable, Iterator, Sequence
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import closing
+from datetime import datetime, timedelta
+from typing import Any, cast
+
+import boto3
+from botocore.client import BaseClient
+
+# The columns of an S3 server access log line, in order. These are the columns of the Athena table.
+ACCESS_LOG_COLUMNS = (
+    "bucket_owner",
+    "bucket",
+    "requestdatetime",
+    "remoteip",
+    "requester",
+    "requestid",
+    "operation",
+    "key",
+    "request_uri",
+    "httpstatus",
+    "errorcode",
+    "bytessent",
+    "objectsize",
+    "totaltime",
+    "turnaroundtime",
+    "referrer",
+    "useragent",
+    "versionid",
+    "hostid",
+    "sigv",
+    "ciphersuite",
+    "authtype",
+    "endpoint",
+    "tlsversion",
+    "accesspointarn",
+)
+
+# Splits an S3 server access log line into ACCESS_LOG_COLUMNS. This is also the Athena table's
+# RegexSerDe `input.regex`, so log lines are parsed the same way whichever backend reads them.
+# As with RegexSerDe, the whole line must match.
+ACCESS_LOG_REGEX = (
+    r'([^ ]*) ([^ ]*) \[([^]]*)\] ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ("[^"]*"|-) ([^ ]*) ([^ ]*) ([^ ]*) '
+    r'([^ ]*) ([^ ]*) ([^ ]*) ("[^"]*"|-) ("[^"]*"|-) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*)'
+    r"(?: ([^ ]*))?.*$"
+)
+
+access_log_pattern = re.compile(ACCESS_LOG_REGEX)
+access_log_bytes_pattern = re.compile(ACCESS_LOG_REGEX.encode())
+
+# The columns billing needs. Log entries are read as records of just these, in this order.
+BILLING_COLUMNS = ("requestdatetime", "remoteip", "operation", "key", "request_uri", "bytessent")
+BILLING_GROUPS = tuple(ACCESS_LOG_COLUMNS.index(column) + 1 for column in BILLING_COLUMNS)
+
+AccessLogRecord = tuple[str, str, str, str, str, str]
+
+# As `regexp_extract(request_uri, 'prefix=([^/%& "]+)', 1)` in `metrics.attributed_log_entries_sql`.
+listing_workspace_pattern = re.compile(r'prefix=([^/%& "]+)')
+
+# Operations which can change the objects stored: writes, copies, deletes (including each key of a
+# multi-object delete) and lifecycle expirations. Athena matches it with `regexp_like(operation, ...)`.
+WRITE_OPERATIONS_REGEX = r"^(REST\.(PUT|POST|COPY|DELETE)\.|BATCH\.DELETE\.|S3\.EXPIRE\.|S3\.CREATE\.DELETEMARKER)"
+write_operation_pattern = re.compile(WRITE_OPERATIONS_REGEX)
+
+MONTHS = {calendar.month_abbr[month]: month for month in range(1, 13)}
+
+
+class RequestTimeParser:
+    """
+    Converts log request times, such as '06/Feb/2019:00:00:38 +0000', to POSIX timestamps.
+    Most log lines share a date with the line before, so the start of each day is cached.
+    """
+
+    def __init__(self) -> None:
+        self._day_starts: dict[str, int] = {}
+
+    def parse(self, requestdatetime: str) -> int:
+        date_part = requestdatetime[:11]
+        day_start = self._day_starts.get(date_part)
+        if day_start is None:
+            day_start = calendar.timegm(
+                (int(date_part[7:11]), MONTHS[date_part[3:6]], int(date_part[0:2]), 0, 0, 0, 0, 0, 0)
+            )
+            self._day_starts[date_part] = day_start
+
+        offset_sign = -1 if requestdatetime[21] == "+" else 1
+        offset = offset_sign * (int(requestdatetime[22:24]) * 3600 + int(requestdatetime[24:26]) * 60)
+
+        return (
+            day_start
+            + int(requestdatetime[12:14]) * 3600
+            + int(requestdatetime[15:17]) * 60
+            + int(requestdatetime[18:20])
+            + offset
+        )
+
+
+def parse_access_log_lines(lines: Iterable[str]) -> Iterator[AccessLogRecord]:
+    """Parses log lines into records of BILLING_COLUMNS, skipping lines which don't match."""
+    for line in lines:
+        match = access_log_pattern.match(line.rstrip("\r\n"))
+        if match is not None:
+            yield cast(AccessLogRecord, match.group(*BILLING_GROUPS))
+
+
+def map_access_log_file(path: str) -> Iterator[AccessLogRecord]:
+    """
+    Reads records of BILLING_COLUMNS from a log file on the local filesystem, which is memory
+    mapped rather than read. Each line is matched in place as bytes and only the fields billing
+    needs are copied out and decoded.
+
+    This isn't faster than `parse_access_log_lines` over the open file: in
+    `benchmarks.bench_access_logs` it's slower, and the mapped pages read count towards the
+    process's peak RSS, up to the size of the file, although they're page cache the kernel can
+    reclaim.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            size = len(mapped)
+            pos = 0
+
+            while pos < size:
+                newline = mapped.find(b"\n", pos)
+                line_end = newline if newline != -1 else size
+                content_end = line_end - 1 if line_end > pos and mapped[line_end - 1] == ord("\r") else line_end
+
+                match = access_log_bytes_pattern.match(mapped, pos, content_end)
+                if match is not None:
+                    requestdatetime, remoteip, operation, key, request_uri, bytessent = match.group(*BILLING_GROUPS)
+                    yield (
+                        requestdatetime.decode("ascii", errors="replace"),
+                        remoteip.decode("ascii", errors="replace"),
+                        operation.decode("ascii", errors="replace"),
+                        key.decode("utf-8", errors="replace"),
+                        request_uri.decode("utf-8", errors="replace"),
+                        bytessent.decode("ascii", errors="replace"),
+                    )
+
+                pos = line_end + 1
+
+
+def aggregate_access_logs(
+    lines: Iterable[str],
+    workspaces: Collection[str] | None,
+    start_time: datetime | None,
+    end_time: datetime | None,
+    interval: timedelta | None = None,
+) -> dict[tuple[str, int, str], list[int]]:
+    """As `aggregate_access_log_records`, over raw log lines."""
+    return aggregate_access_log_records(parse_access_log_lines(lines), workspaces, start_time, end_time, interval)
+
+
+def aggregate_access_log_records(
+    records: Iterable[AccessLogRecord],
+    workspaces: Collection[str] | None,
+    start_time: datetime | None,
+    end_time: datetime | None,
+    interval: timedelta | None = None,
+) -> dict[tuple[str, int, str], list[int]]:
+    """
+    Totals bytes sent, object requests and listing requests in a single pass over log records,
+    for each workspace in `workspaces` (or every workspace, if None), interval and remote IP. Only
+    log entries in the half-open period from `start_time` to `end_time` are included. Either may
+    be None to leave the period unbounded, in which case intervals count from the epoch.
+
+    Log entries are attributed to workspaces exactly as by `metrics.attributed_log_entries_sql`
+    and split into intervals as by `metrics.interval_index_sql`.
+    """
+    start = int(start_time.timestamp()) if start_time is not None else 0
+    end = int(end_time.timestamp()) if end_time is not None else None
+    interval_seconds = int(interval.total_seconds()) if interval is not None else None
+    workspace_set = frozenset(workspaces) if workspaces is not None else None
+    parse_time = RequestTimeParser().parse
+
+    totals: defaultdict[tuple[str, int, str], list[int]] = defaultdict(lambda: [0, 0, 0])
+
+    for requestdatetime, remoteip, _, key, request_uri, bytessent in records:
+        object_workspace = key.split("/", 1)[0] if "/" in key else None
+
+        listing_match = listing_workspace_pattern.search(request_uri)
+        listing_workspace = listing_match.group(1) if listing_match else None
+
+        if workspace_set is not None:
+            if object_workspace not in workspace_set:
+                object_workspace = None
+            if listing_workspace not in workspace_set:
+                listing_workspace = None
+
+        if object_workspace is None and listing_workspace is None:
+            continue
+
+        request_time = parse_time(requestdatetime)
+        if request_time < start or (end is not None and request_time >= end):
+            continue
+
+        interval_index = (request_time - start) // interval_seconds if interval_seconds else 0
+
+        if object_workspace is not None:
+            entry = totals[(object_workspace, interval_index, remoteip)]
+            entry[0] += int(bytessent) if bytessent.isdigit() else 0
+            entry[1] += 1
+
+        if listing_workspace is not None:
+            totals[(listing_workspace, interval_index, remoteip)][2] += 1
+
+    return totals
+
+
+def written_workspaces(
+    records: Iterable[AccessLogRecord], start_time: datetime, end_time: datetime | None = None
+) -> set[str]:
+    """
+    The workspaces with objects written or deleted by requests logged in the half-open period
+    from `start_time` to `end_time`, recognised by their operation as in
+    `metrics.get_workspaces_written_since`'s query.
+    """
+    start = int(start_time.timestamp())
+    end = int(end_time.timestamp()) if end_time is not None else None
+    parse_time = RequestTimeParser().parse
+    written: set[str] = set()
+
+    for requestdatetime, _, operation, key, _, _ in records:
+        if "/" not in key or write_operation_pattern.match(operation) is None:
+            continue
+
+        workspace = key.split("/", 1)[0]
+        if workspace in written:
+            continue
+
+        request_time = parse_time(requestdatetime)
+        if request_time >= start and (end is None or request_time < end):
+            written.add(workspace)
+
+    return written
+
+
+def list_access_log_objects(s3: BaseClient, bucket: str, prefixes: Iterable[str]) -> Iterator[str]:
+    """The keys of every log object under each of `prefixes` in `bucket`."""
+    paginator = s3.get_paginator("list_objects_v2")
+
+    for prefix in prefixes:
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                yield obj["Key"]
+
+
+class S3LogObjectReader:
+    """
+    Streams the records of log objects in an S3 bucket. This can be sent to worker processes,
+    each of which creates its own S3 client.
+    """
+
+    def __init__(self, bucket: str, s3: BaseClient | None = None) -> None:
+        self.bucket = bucket
+        self._s3 = s3
+
+    def __getstate__(self) -> dict[str, Any]:
+        return {"bucket": self.bucket, "_s3": None}
+
+    def __call__(self, key: str) -> Iterator[AccessLogRecord]:
+        if self._s3 is None:
+            self._s3 = boto3.client("s3")
+
+        body = self._s3.get_object(Bucket=self.bucket, Key=key)["Body"]
+        try:
+            yield from parse_access_log_lines(codecs.getreader("utf-8")(body, "replace"))
+        finally:
+            body.close()
+
+
+def iter_access_log_records(
+    read: Callable[[str], Iterable[AccessLogRecord]], keys: Iterable[str]
+) -> Iterator[AccessLogRecord]:
+    """Streams the records of each of the log objects `keys`, as read by `read`."""
+    for key in keys:
+        yield from read(key)
+
+
+def aggregate_access_log_shard(
+    read: Callable[[str], Iterable[AccessLogRecord]],
+    keys: Sequence[str],
+    workspaces: Collection[str] | None,
+    start_time: datetime | None,
+    end_time: datetime | None,
+    interval: timedelta | None,
+) -> dict[tuple[str, int, str], list[int]]:
+    """Runs `aggregate_access_log_records` over some log objects. This is run by worker processes."""
+    return dict(
+        aggregate_access_log_records(iter_access_log_records(read, keys), workspaces, start_time, end_time, interval)
+    )
+
+
+def merge_totals(
+    into: dict[tuple[str, int, str], list[int]], totals: dict[tuple[str, int, str], list[int]]
+) -> dict[tuple[str, int, str], list[int]]:
+    """Adds totals from `aggregate_access_logs` into `into`, which is returned."""
+    for group, counts in totals.items():
+        existing = into.get(group)
+        if existing is None:
+            into[group] = list(counts)
+        else:
+            for i, count in enumerate(counts):
+                existing[i] += count
+
+    return into
+
+
+def aggregate_access_log_objects(
+    read: Callable[[str], Iterable[AccessLogRecord]],
+    keys: Iterable[str],
+    workspaces: Collection[str] | None,
+    start_time: datetime | None,
+    end_time: datetime | None,
+    interval: timedelta | None = None,
+    processes: int = 1,
+    objects_per_shard: int = 32,
+) -> dict[tuple[str, int, str], list[int]]:
+    """
+    As `aggregate_access_log_records`, over the log objects `keys` as read by `read`. This is an
+    `S3LogObjectReader` for objects in S3, or `map_access_log_file` for local files.
+
+    Parsing log lines is CPU-bound. If `processes` is more than one, the objects are split into
+    shards of `objects_per_shard` which are parsed and aggregated by a pool of that many worker
+    processes. Their partial totals are merged at the end. `read` must then be picklable.
+    """
+    if processes <= 1:
+        return aggregate_access_log_shard(read, list(keys), workspaces, start_time, end_time, interval)
+
+    keys = list(keys)
+    shards = [keys[i : i + objects_per_shard] for i in range(0, len(keys), objects_per_shard)]
+    if not shards:
+        return {}
+
+    totals: dict[tuple[str, int, str], list[int]] = {}
+
+    # Worker processes are spawned rather than forked, as forking a process with running threads
+    # (such as the Athena poller) isn't safe.
+    with ProcessPoolExecutor(
+        max_workers=min(processes, len(shards)), mp_context=multiprocessing.get_context("spawn")
+    ) as pool:
+        futures = [
+            pool.submit(aggregate_access_log_shard, read, shard, workspaces, start_time, end_time, interval)
+            for shard in shards
+        ]
+        for future in as_completed(futures):
+            merge_totals(totals, future.result())
+
+    return totals
+
+
+def usage_rows(totals: dict[tuple[str, int, str], list[int]]) -> Iterator[tuple[str, int, str, float, int, int]]:
+    """
+    Converts the totals from `aggregate_access_logs` to rows as returned by
+    `metrics.get_workspaces_usage`.
+    """
+    for (workspace, interval_index, remoteip), (bytessent, object_requests, listing_requests) in totals.items():
+        yield workspace, interval_index, remoteip, bytessent / 1073741824.0, object_requests, listing_requests
+
+
+class AccessLogManifest:
+    """
+    A durable local (SQLite) record of which log objects have been processed, together with
+    running totals of bytes sent and requests made from them for each workspace, remote IP and
+    period of `resolution`.
+
+    Ingesting a set of log objects only reads those which haven't been processed before, so the
+    cost of keeping the totals up to date tracks the volume of new logs. An object's totals and
+    its record as processed are committed together, so a failure part-way through an ingest
+    neither loses nor double counts anything.
+    """
+
+    def __init__(self, path: str, resolution: timedelta = timedelta(hours=1)) -> None:
+        self.path = path
+        self.resolution = resolution
+        self._lock = threading.Lock()
+
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS processed_objects (key TEXT PRIMARY KEY, processed REAL NOT NULL)"
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS totals (
+                    workspace TEXT NOT NULL,
+                    period_start INTEGER NOT NULL,
+                    remoteip TEXT NOT NULL,
+                    bytessent INTEGER NOT NULL,
+                    object_requests INTEGER NOT NULL,
+                    listing_requests INTEGER NOT NULL,
+                    PRIMARY KEY (workspace, period_start, remoteip)
+                )
+                """
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    def ingest(self, s3: BaseClient, bucket: str, prefixes: Iterable[str], processes: int = 1) -> int:
+        """
+        Folds every log object under `prefixes` in `bucket` which hasn't been processed yet into
+        the running totals, parsing them with `processes` worker processes as for
+        `aggregate_access_log_objects`. Returns the number of objects processed.
+        """
+        # Concurrent ingests of the same objects would count them twice.
+        with self._lock:
+            new_keys = []
+            with closing(self._connect()) as conn:
+                for prefix in prefixes:
+                    processed = {
+                        key
+                        for (key,) in conn.execute(
+                            "SELECT key FROM processed_objects WHERE key >= ? AND key < ?", (prefix, prefix + "\uffff")
+                        )
+                    }
+                    new_keys += [key for key in list_access_log_objects(s3, bucket, [prefix]) if key not in processed]
+
+            if not new_keys:
+                return 0
+
+            totals = aggregate_access_log_objects(
+                S3LogObjectReader(bucket, s3), new_keys, None, None, None, self.resolution, processes=processes
+            )
+            resolution_seconds = int(self.resolution.total_seconds())
+            now = time.time()
+
+            with closing(self._connect()) as conn, conn:
+                conn.executemany(
+                    """
+                    INSERT INTO totals (workspace, period_start, remoteip, bytessent, object_requests, listing_requests)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (workspace, period_start, remoteip) DO UPDATE SET
+                        bytessent = bytessent + excluded.bytessent,
+                        object_requests = object_requests + excluded.object_requests,
+                        listing_requests = listing_requests + excluded.listing_requests
+                    """,
+                    (
+                        (workspace, period * resolution_seconds, remoteip, *counts)
+                        for (workspace, period, remoteip), counts in totals.items()
+                    ),
+                )
+                conn.executemany(
+                    "INSERT INTO processed_objects (key, processed) VALUES (?, ?)", ((key, now) for key in new_keys)
+                )
+
+            logging.info("Ingested %d new access log objects", len(new_keys))
+            return len(new_keys)
+
+    def covers(self, start_time: datetime, end_time: datetime, interval: timedelta | None = None) -> bool:
+        """Whether the period and intervals are made up of whole periods of the totals' resolution."""
+        resolution_seconds = int(self.resolution.total_seconds())
+        return (
+            int(start_time.timestamp()) % resolution_seconds == 0
+            and int(end_time.timestamp()) % resolution_seconds == 0
+            and (interval is None or int(interval.total_seconds()) % resolution_seconds == 0)
+        )
+
+    def usage(
+        self,
+        workspaces: Collection[str],
+        start_time: datetime,
+        end_time: datetime,
+        interval: timedelta | None = None,
+    ) -> Iterator[tuple[str, int, str, float, int, int]]:
+        """
+        The usage of `workspaces` from the running totals, in rows as returned by
+        `metrics.get_workspaces_usage`. The period and intervals must be covered by the totals'
+        resolution.
+        """
+        start = int(start_time.timestamp())
+        interval_seconds = int(interval.total_seconds()) if interval is not None else 0
+
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                f"""
+                SELECT workspace,
+                       CASE WHEN ? > 0 THEN (period_start - ?) / ? ELSE 0 END AS interval_index,
+                       remoteip,
+                       SUM(bytessent),
+                       SUM(object_requests),
+                       SUM(listing_requests)
+                FROM totals
+                WHERE workspace IN ({", ".join("?" for _ in workspaces)})
+                  AND period_start >= ? AND period_start < ?
+                GROUP BY 1, 2, 3
+                """,
+                (
+                    interval_seconds,
+                    start,
+                    interval_seconds or 1,
+                    *workspaces,
+                    start,
+                    int(end_time.timestamp()),
+                ),
+            ).fetchall()
+
+        for workspace, interval_index, remoteip, bytessent, object_requests, listing_requests in rows:
+            yield workspace, interval_index, remoteip, bytessent / 1073741824.0, object_requests, listing_requests
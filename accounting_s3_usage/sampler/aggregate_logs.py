@@ -0,0 +1,110 @@
+"""
+Computes access billing quantities for a period directly from the S3 server access logs,
+parsing the log objects with a pool of worker processes. For example:
+
+    python -m accounting_s3_usage.sampler.aggregate_logs --start 2025-01-01 --end 2025-01-02
+
+This prints a CSV of workspace, SKU and quantity. With --logs-dir, log files already downloaded
+to a local directory (laid out as under LOGS_PREFIX) are memory mapped and read instead of S3.
+"""
+
+import csv
+import logging
+import os
+import sys
+import time
+from collections.abc import Callable, Iterable
+from datetime import UTC, datetime
+from pathlib import Path
+
+import boto3
+import click
+
+from accounting_s3_usage.sampler.access_logs import (
+    AccessLogRecord,
+    S3LogObjectReader,
+    aggregate_access_log_objects,
+    list_access_log_objects,
+    map_access_log_file,
+)
+from accounting_s3_usage.sampler.messager import S3AccessBillingEventMessager
+from accounting_s3_usage.sampler.metrics import LOGS_PREFIX, raw_log_partitions, split_s3_url
+from accounting_s3_usage.sampler.usage_columns import UsageColumns
+
+
+@click.command()
+@click.option("-v", "--verbose", count=True, help="Increase verbosity level.")
+@click.option("--start", type=click.DateTime(), required=True, help="Start of the period, in UTC.")
+@click.option("--end", type=click.DateTime(), required=True, help="End of the period (exclusive), in UTC.")
+@click.option(
+    "--workspace",
+    "workspaces",
+    multiple=True,
+    help="Workspace to report on. May be repeated. Defaults to every workspace in the logs.",
+)
+@click.option(
+    "--processes",
+    type=int,
+    default=os.cpu_count() or 1,
+    show_default=True,
+    help="Number of worker processes parsing log objects.",
+)
+@click.option(
+    "--logs-dir",
+    type=click.Path(exists=True, file_okay=False),
+    default=None,
+    help="Read log files from this local directory instead of LOGS_PREFIX.",
+)
+def cli(
+    verbose: int,
+    start: datetime,
+    end: datetime,
+    workspaces: tuple[str, ...],
+    processes: int,
+    logs_dir: str | None,
+) -> None:
+    logging.basicConfig(level=logging.WARNING - 10 * verbose)
+
+    start_time = start.replace(tzinfo=UTC)
+    end_time = end.replace(tzinfo=UTC)
+
+    partitions = raw_log_partitions(start_time, end_time)
+    read: Callable[[str], Iterable[AccessLogRecord]]
+    if logs_dir is not None:
+        read = map_access_log_file
+        keys = sorted(
+            str(path) for partition in partitions for path in Path(logs_dir, partition).rglob("*") if path.is_file()
+        )
+    else:
+        s3 = boto3.client("s3")
+        bucket, prefix = split_s3_url(LOGS_PREFIX)
+        read = S3LogObjectReader(bucket)
+        keys = list(list_access_log_objects(s3, bucket, [f"{prefix}{partition}/" for partition in partitions]))
+
+    parse_start = time.monotonic()
+    totals = aggregate_access_log_objects(
+        read,
+        keys,
+        workspaces or None,
+        start_time,
+        end_time,
+        processes=processes,
+    )
+    logging.info("Parsed %d log objects in %.1fs", len(keys), time.monotonic() - parse_start)
+
+    usage = UsageColumns()
+    for (workspace, _, remoteip), (bytessent, object_requests, listing_requests) in totals.items():
+        usage.append(workspace, (remoteip, bytessent / 1073741824.0, object_requests, listing_requests))
+
+    messager = S3AccessBillingEventMessager()
+    sku_totals = usage.sku_totals(messager.transfer_skus, "AWS-S3-API-CALLS")
+
+    writer = csv.writer(sys.stdout)
+    writer.writerow(["workspace", "sku", "quantity"])
+    for workspace, quantities in sorted(zip(usage.groups, sku_totals, strict=True), key=lambda item: str(item[0])):
+        for sku, quantity in sorted(quantities.items()):
+            writer.writerow([workspace, sku, round(quantity, 6)])
+
+
+if __name__ == "__main__":
+    cli()
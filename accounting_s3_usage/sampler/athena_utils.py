@@ -1,55 +1,344 @@
+import codecs
+import csv
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
 import time
-from collections.abc import Generator
+from collections import deque
+from collections.abc import Callable, Generator, Iterable, Iterator, Sequence
+from concurrent.futures import Future
+from contextlib import closing
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Any
+from urllib.parse import urlparse
 
 import boto3
 from botocore.client import BaseClient
+from botocore.exceptions import ClientError
+from opentelemetry.trace import Span
 
+from .telemetry import ScanBudgetExceededError, athena_costs, query_attributes, record_athena_query, tracer
 
-def run_athena_query(athena: BaseClient, query: str, database: str, output_bucket: str) -> str:
-    """Runs an AWS Athena query and returns its execution ID."""
-    response = athena.start_query_execution(
-        QueryString=query,
-        QueryExecutionContext={"Database": database},
-        ResultConfiguration={"OutputLocation": f"s3://{output_bucket}/athena-results/"},
-    )
 
-    query_execution_id = response["QueryExecutionId"]
+def run_athena_query(
+    athena: BaseClient,
+    query: str,
+    database: str,
+    output_bucket: str,
+    kind: str = "other",
+    workspace: str | None = None,
+) -> str:
+    """
+    Runs an AWS Athena query and returns its execution ID. The query's cost and latency are
+    recorded against `kind` and `workspace`.
+    """
+    return run_athena_query_execution(athena, query, database, output_bucket, kind, workspace)["QueryExecutionId"]
 
-    # Wait until query completes
-    while True:
-        query_status = athena.get_query_execution(QueryExecutionId=query_execution_id)
-        status = query_status["QueryExecution"]["Status"]["State"]
 
-        if status == "SUCCEEDED":
-            return query_execution_id
+def run_athena_query_execution(
+    athena: BaseClient,
+    query: str,
+    database: str,
+    output_bucket: str,
+    kind: str = "other",
+    workspace: str | None = None,
+) -> dict[str, Any]:
+    """
+    As `run_athena_query`, but returns the finished query execution as Athena describes it.
 
-        if status not in {"RUNNING", "QUEUED"}:
-            raise Exception(f"Athena query {query} failed: {status} {query_status=}")
+    As with `AthenaQueryEngine`, the query fails with ScanBudgetExceededError rather than
+    starting once the cycle's scan budget is used up.
+    """
+    if athena_costs.over_budget():
+        raise ScanBudgetExceededError(f"Not starting Athena query {query}")
 
-        time.sleep(1)
+    attributes = query_attributes(kind, workspace)
+    with tracer.start_as_current_span("athena-query", attributes=attributes) as span:
+        response = athena.start_query_execution(
+            QueryString=query,
+            QueryExecutionContext={"Database": database},
+            ResultConfiguration={"OutputLocation": f"s3://{output_bucket}/athena-results/"},
+        )
 
+        query_execution_id = response["QueryExecutionId"]
+        span.set_attribute("athena.query_execution_id", query_execution_id)
 
-def run_single_result_athena_query(query: str, database: str, output_bucket: str) -> float:
-    athena = boto3.client("athena")
-    query_execution_id = run_athena_query(athena, query, database, output_bucket)
+        # Wait until query completes
+        while True:
+            query_status = athena.get_query_execution(QueryExecutionId=query_execution_id)
+            status = query_status["QueryExecution"]["Status"]["State"]
 
-    result = athena.get_query_results(QueryExecutionId=query_execution_id)
+            if status not in {"RUNNING", "QUEUED"}:
+                record_athena_query(span, query_status["QueryExecution"], attributes)
 
-    rows = result["ResultSet"]["Rows"]
+            if status == "SUCCEEDED":
+                return {**query_status["QueryExecution"], "QueryExecutionId": query_execution_id}
 
-    # The first row will be a header, eg [{'VarCharValue': 'total_gb_transferred'}]
-    if len(rows) < 2 or len(rows[1]["Data"]) < 1:
-        return 0
+            if status not in {"RUNNING", "QUEUED"}:
+                raise Exception(f"Athena query {query} failed: {status} {query_status=}")
 
-    value = rows[1]["Data"][0].get("VarCharValue", "0")
-    return float(value)
+            time.sleep(1)
+
+
+@dataclass
+class QueuedQuery:
+    query: str
+    database: str
+    output_bucket: str
+    reuse_results: bool
+    future: Future[dict[str, Any]]
+    attributes: dict[str, str]
+    span: Span
+
+
+class AthenaQueryEngine:
+    """
+    Runs many Athena queries concurrently. Callers submit queries and get futures back which
+    resolve to query execution IDs, or to the finished query executions as Athena describes them.
+
+    A single background thread starts queued queries, keeping at most `max_in_flight` running at
+    once, and tracks all running executions with `batch_get_query_execution`. It polls every
+    `min_poll_interval` seconds while executions are finishing and backs off towards
+    `max_poll_interval` while nothing changes.
+
+    Each query gets a span, from submission until it finishes, and its cost is recorded in
+    `telemetry.athena_costs`. Queued queries fail with ScanBudgetExceededError rather than starting
+    once the cycle's scan budget is used up.
+    """
+
+    # The most query execution IDs batch_get_query_execution accepts in one call.
+    POLL_BATCH_SIZE = 50
+
+    def __init__(
+        self,
+        athena: BaseClient | None = None,
+        max_in_flight: int = 20,
+        min_poll_interval: float = 0.2,
+        max_poll_interval: float = 5.0,
+        result_reuse_max_age: timedelta | None = None,
+    ) -> None:
+        self._athena = athena
+        self.max_in_flight = max_in_flight
+        self.result_reuse_max_age = result_reuse_max_age
+        self.min_poll_interval = min_poll_interval
+        self.max_poll_interval = max_poll_interval
+
+        self._condition = threading.Condition()
+        self._queued: deque[QueuedQuery] = deque()
+        self._in_flight: dict[str, QueuedQuery] = {}
+        self._poller: threading.Thread | None = None
+
+    @property
+    def athena(self) -> BaseClient:
+        with self._condition:
+            if self._athena is None:
+                self._athena = boto3.client("athena")
+
+            return self._athena
+
+    def submit(
+        self,
+        query: str,
+        database: str,
+        output_bucket: str,
+        reuse_results: bool = False,
+        kind: str = "other",
+        workspace: str | None = None,
+    ) -> Future[str]:
+        """
+        Queues a query to run and returns a future for its query execution ID. The query's cost
+        and latency are recorded against `kind` and `workspace`.
+
+        If `reuse_results` is set and the engine has a `result_reuse_max_age` then Athena may
+        return the results of an identical earlier query instead of running it again. Only set it
+        for queries whose results cannot change.
+        """
+        execution = self.submit_execution(query, database, output_bucket, reuse_results, kind, workspace)
+        future: Future[str] = Future()
+
+        def resolve(execution: Future[dict[str, Any]]) -> None:
+            if execution.exception() is not None:
+                future.set_exception(execution.exception())
+            else:
+                future.set_result(execution.result()["QueryExecutionId"])
+
+        execution.add_done_callback(resolve)
+        return future
+
+    def submit_execution(
+        self,
+        query: str,
+        database: str,
+        output_bucket: str,
+        reuse_results: bool = False,
+        kind: str = "other",
+        workspace: str | None = None,
+    ) -> Future[dict[str, Any]]:
+        """
+        As `submit`, but the future resolves to the finished query execution. Its results are at
+        `ResultConfiguration.OutputLocation`, which may not be in `output_bucket` if the workgroup
+        overrides it, nor named after the execution if an earlier execution's results were reused.
+        """
+        future: Future[dict[str, Any]] = Future()
+        attributes = query_attributes(kind, workspace)
+        span = tracer.start_span("athena-query", attributes=attributes)
+        future.add_done_callback(lambda _: span.end())
+
+        with self._condition:
+            self._queued.append(QueuedQuery(query, database, output_bucket, reuse_results, future, attributes, span))
+
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._poll_loop, name="athena-poller", daemon=True)
+                self._poller.start()
+
+            self._condition.notify()
+
+        return future
+
+    def _start_queued(self) -> bool:
+        with self._condition:
+            to_start: deque[QueuedQuery] = deque()
+            while self._queued and len(self._in_flight) + len(to_start) < self.max_in_flight:
+                to_start.append(self._queued.popleft())
+
+        started = False
+        while to_start:
+            queued = to_start.popleft()
+            future = queued.future
+            if not future.running() and not future.set_running_or_notify_cancel():
+                continue
+
+            if athena_costs.over_budget():
+                future.set_exception(ScanBudgetExceededError(f"Not starting Athena query {queued.query}"))
+                continue
+
+            kwargs: dict[str, Any] = {}
+            if queued.reuse_results and self.result_reuse_max_age:
+                kwargs["ResultReuseConfiguration"] = {
+                    "ResultReuseByAgeConfiguration": {
+                        "Enabled": True,
+                        "MaxAgeInMinutes": int(self.result_reuse_max_age.total_seconds() // 60),
+                    }
+                }
+
+            try:
+                response = self.athena.start_query_execution(
+                    QueryString=queued.query,
+                    QueryExecutionContext={"Database": queued.database},
+                    ResultConfiguration={"OutputLocation": f"s3://{queued.output_bucket}/athena-results/"},
+                    **kwargs,
+                )
+            except ClientError as e:
+                if e.response.get("Error", {}).get("Code") != "TooManyRequestsException":
+                    future.set_exception(e)
+                    continue
+
+                # We've hit Athena's concurrency quota. Retry these once something else finishes.
+                with self._condition:
+                    self._queued.extendleft(reversed(to_start))
+                    self._queued.appendleft(queued)
+                break
+            except Exception as e:
+                future.set_exception(e)
+                continue
+
+            queued.span.set_attribute("athena.query_execution_id", response["QueryExecutionId"])
+            with self._condition:
+                self._in_flight[response["QueryExecutionId"]] = queued
+            started = True
+
+        return started
+
+    def _poll_in_flight(self) -> bool:
+        with self._condition:
+            query_execution_ids = list(self._in_flight)
+
+        finished = False
+        for i in range(0, len(query_execution_ids), self.POLL_BATCH_SIZE):
+            response = self.athena.batch_get_query_execution(
+                QueryExecutionIds=query_execution_ids[i : i + self.POLL_BATCH_SIZE]
+            )
+
+            for query_execution in response["QueryExecutions"]:
+                query_execution_id = query_execution["QueryExecutionId"]
+                status = query_execution["Status"]["State"]
+
+                if status in {"RUNNING", "QUEUED"}:
+                    continue
+
+                with self._condition:
+                    queued = self._in_flight.pop(query_execution_id)
+
+                finished = True
+                record_athena_query(queued.span, query_execution, queued.attributes)
+                if status == "SUCCEEDED":
+                    queued.future.set_result(query_execution)
+                else:
+                    queued.future.set_exception(
+                        Exception(f"Athena query {queued.query} failed: {status} {query_execution=}")
+                    )
+
+        return finished
+
+    def _poll_loop(self) -> None:
+        poll_interval = self.min_poll_interval
+
+        while True:
+            with self._condition:
+                while not self._queued and not self._in_flight:
+                    self._condition.wait()
+                    poll_interval = self.min_poll_interval
+
+            try:
+                changed = self._start_queued()
+                changed = self._poll_in_flight() or changed
+            except Exception:
+                logging.exception("Failed to poll Athena query executions")
+                changed = False
+
+            if changed:
+                poll_interval = self.min_poll_interval
+            else:
+                poll_interval = min(poll_interval * 2, self.max_poll_interval)
+
+            with self._condition:
+                if not changed or not self._queued or len(self._in_flight) >= self.max_in_flight:
+                    self._condition.wait(timeout=poll_interval)
 
 
 def run_long_result_athena_query(
-    query: str, database: str, output_bucket: str, page_size: int = 100
+    query: str,
+    database: str,
+    output_bucket: str,
+    page_size: int = 100,
+    engine: AthenaQueryEngine | None = None,
+    reuse_results: bool = False,
+    kind: str = "other",
+    workspace: str | None = None,
+) -> Iterator[tuple[str | None, ...]]:
+    """
+    Runs an Athena query and iterates over its result rows, skipping any containing nulls.
+
+    Without an `engine` the query starts when iteration starts. With one, the query is submitted
+    immediately so that several can run concurrently, and iteration waits for it to finish.
+    """
+    if engine is None:
+        athena = boto3.client("athena")
+        return iter_query_results(
+            athena, lambda: run_athena_query(athena, query, database, output_bucket, kind, workspace), page_size
+        )
+
+    future = engine.submit(query, database, output_bucket, reuse_results, kind, workspace)
+    return iter_query_results(engine.athena, future.result, page_size)
+
+
+def iter_query_results(
+    athena: BaseClient, get_query_execution_id: Callable[[], str], page_size: int
 ) -> Generator[tuple[str | None, ...]]:
-    athena = boto3.client("athena")
-    query_execution_id = run_athena_query(athena, query, database, output_bucket)
+    query_execution_id = get_query_execution_id()
 
     paginator = athena.get_paginator("get_query_results")
     page_iterator = paginator.paginate(QueryExecutionId=query_execution_id, PaginationConfig={"PageSize": page_size})
@@ -76,3 +365,167 @@ def run_long_result_athena_query(
                 result_row = tuple(d.get("VarCharValue") for d in row["Data"])
                 if all(d is not None for d in result_row):
                     yield result_row
+
+
+def run_csv_result_athena_query(
+    query: str,
+    database: str,
+    output_bucket: str,
+    column_types: Sequence[Callable[[str], Any]],
+    engine: AthenaQueryEngine | None = None,
+    reuse_results: bool = False,
+    kind: str = "other",
+    workspace: str | None = None,
+) -> Iterator[tuple[Any, ...]]:
+    """
+    Like `run_long_result_athena_query` but reads the results straight from the CSV file Athena
+    writes to S3 rather than paging through `get_query_results`. Values are converted using
+    `column_types`, one per column.
+    """
+    if engine is None:
+        athena = boto3.client("athena")
+        return iter_csv_query_results(
+            boto3.client("s3"),
+            lambda: output_location(
+                run_athena_query_execution(athena, query, database, output_bucket, kind, workspace)
+            ),
+            column_types,
+        )
+
+    future = engine.submit_execution(query, database, output_bucket, reuse_results, kind, workspace)
+    return iter_csv_query_results(boto3.client("s3"), lambda: output_location(future.result()), column_types)
+
+
+def output_location(query_execution: dict[str, Any]) -> str:
+    """The S3 URL of a finished query execution's CSV result file."""
+    return query_execution["ResultConfiguration"]["OutputLocation"]
+
+
+def iter_csv_query_results(
+    s3: BaseClient, get_output_location: Callable[[], str], column_types: Sequence[Callable[[str], Any]]
+) -> Generator[tuple[Any, ...]]:
+    """
+    Streams an Athena CSV result file from S3, yielding typed rows. As with `iter_query_results`,
+    the header row and any rows containing nulls are skipped.
+
+    Athena quotes every non-null value and writes nulls as empty, unquoted fields. None of our
+    queries return empty strings, so any empty field is treated as null.
+    """
+    output_location = urlparse(get_output_location())
+    body = s3.get_object(Bucket=output_location.netloc, Key=output_location.path.lstrip("/"))["Body"]
+
+    try:
+        reader = csv.reader(codecs.getreader("utf-8")(body))
+        next(reader, None)
+
+        for row in reader:
+            if row and all(row):
+                yield tuple(convert(value) for convert, value in zip(column_types, row, strict=True))
+    finally:
+        body.close()
+
+
+class AthenaResultCache:
+    """
+    A persistent on-disk (SQLite) cache of query results, keyed by a hash of the normalized SQL.
+    Only use this for queries whose results cannot change, such as those for intervals which
+    ended long enough ago for all their logs to have been delivered.
+
+    Entries older than `max_age` are evicted, as are the least recently used entries once the
+    cached results exceed `max_bytes`.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 512 * 1024**2, max_age: timedelta = timedelta(days=30)) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS results (
+                    key TEXT PRIMARY KEY,
+                    rows TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+                """
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    @staticmethod
+    def key(query: str, database: str) -> str:
+        normalized = " ".join(query.split())
+        return hashlib.sha256(f"{database}\n{normalized}".encode()).hexdigest()
+
+    def get(self, query: str, database: str) -> list[tuple[Any, ...]] | None:
+        key = self.key(query, database)
+        now = time.time()
+
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute(
+                "SELECT rows FROM results WHERE key = ? AND created >= ?",
+                (key, now - self.max_age.total_seconds()),
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            conn.execute("UPDATE results SET last_used = ? WHERE key = ?", (now, key))
+
+        return [tuple(r) for r in json.loads(row[0])]
+
+    def put(self, query: str, database: str, rows: Iterable[tuple[Any, ...]]) -> None:
+        encoded = json.dumps(list(rows))
+        now = time.time()
+
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO results (key, rows, size, created, last_used) VALUES (?, ?, ?, ?, ?)",
+                (self.key(query, database), encoded, len(encoded), now, now),
+            )
+            self._evict(conn, now)
+
+    def _evict(self, conn: sqlite3.Connection, now: float) -> None:
+        conn.execute("DELETE FROM results WHERE created < ?", (now - self.max_age.total_seconds(),))
+
+        (total_bytes,) = conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()
+        if total_bytes <= self.max_bytes:
+            return
+
+        evict = []
+        for key, size in conn.execute("SELECT key, size FROM results ORDER BY last_used"):
+            if total_bytes <= self.max_bytes:
+                break
+
+            evict.append((key,))
+            total_bytes -= size
+
+        conn.executemany("DELETE FROM results WHERE key = ?", evict)
+
+    def cached_results(
+        self, query: str, database: str, run: Callable[[], Iterator[tuple[Any, ...]]]
+    ) -> Iterator[tuple[Any, ...]]:
+        """
+        Returns the cached results of a query if present. Otherwise calls `run` and caches the
+        results once they have been completely read.
+        """
+        cached = self.get(query, database)
+        if cached is not None:
+            logging.debug("Using cached results for query %s", self.key(query, database))
+            return iter(cached)
+
+        return self._store_when_complete(query, database, run())
+
+    def _store_when_complete(
+        self, query: str, database: str, results: Iterator[tuple[Any, ...]]
+    ) -> Generator[tuple[Any, ...]]:
+        rows = []
+        for row in results:
+            rows.append(row)
+            yield row
+
+        self.put(query, database, rows)
@@ -0,0 +1,238 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from datetime import UTC, datetime, timedelta
+from typing import Any
+
+from botocore.client import BaseClient
+
+
+def list_workspace_storage_sizes(s3: BaseClient, bucket_name: str) -> dict[str, int]:
+    """
+    Totals the size in bytes of the objects in each workspace from a single listing of the whole
+    bucket. An object belongs to the workspace named by the first segment of its key.
+    """
+    totals: defaultdict[str, int] = defaultdict(int)
+    paginator = s3.get_paginator("list_objects_v2")
+
+    for page in paginator.paginate(Bucket=bucket_name):
+        for obj in page.get("Contents", []):
+            key = obj["Key"]
+            if "/" in key:
+                totals[key.split("/", 1)[0]] += obj["Size"]
+
+    return totals
+
+
+# The most objects a single list_objects_v2 request returns.
+LIST_PAGE_SIZE = 1000
+
+# Shards with no upper bound are split as if their keys were ASCII, so that the split falls among
+# the keys rather than in the rarely used rest of the Unicode range. Keys beyond it are still
+# listed, by the shard above the split.
+ASCII_KEY_LIMIT = "\x7f"
+KEY_LIMIT = chr(0x10FFFF)
+
+
+@dataclass(eq=True, frozen=True)
+class ListingShard:
+    """
+    Part of the key space under `prefix` to list: the keys after `start_after`, up to and
+    including `end`. If `continuation_token` is set, it's instead the rest of a listing of the
+    objects directly under `prefix` and its sub-prefixes.
+    """
+
+    prefix: str
+    start_after: str | None = None
+    end: str | None = None
+    continuation_token: str | None = None
+
+
+def key_midpoint(low: str, high: str) -> str | None:
+    """
+    A key roughly halfway between `low` and `high` in the order S3 lists keys, or None if there's
+    no usable key strictly between them. Keys between printable ASCII keys are printable ASCII.
+    """
+    if low >= high:
+        return None
+
+    i = 0
+    while i < len(low) and low[i] == high[i]:
+        i += 1
+
+    # Either a character between theirs follows the prefix they share, or low continues with a
+    # greater character than it has at some position after the one where they differ.
+    low_char = ord(low[i]) if i < len(low) else ord(" ") - 1
+    high_char = ord(high[i])
+    if high_char - low_char > 1:
+        key = high[:i] + chr((low_char + high_char) // 2)
+    elif i < len(low):
+        j = i + 1
+        while j < len(low) and ord(low[j]) >= ord("~"):
+            j += 1
+        key = low[:j] + chr(((ord(low[j]) if j < len(low) else ord(" ") - 1) + ord("~") + 1) // 2)
+    else:
+        return None
+
+    # Surrogates can't be encoded in a request.
+    if any("\ud800" <= char <= "\udfff" for char in key):
+        return None
+
+    return key if low < key < high else None
+
+
+def split_key_range(prefix: str, start_after: str, end: str | None) -> list[ListingShard]:
+    """Splits the keys under `prefix` after `start_after`, up to `end`, into two shards."""
+    if end is not None:
+        high = end
+    elif start_after < prefix + ASCII_KEY_LIMIT:
+        high = prefix + ASCII_KEY_LIMIT
+    else:
+        high = prefix + KEY_LIMIT
+
+    middle = key_midpoint(start_after, high)
+    if middle is None:
+        return [ListingShard(prefix, start_after, end)]
+
+    return [ListingShard(prefix, start_after, middle), ListingShard(prefix, middle, end)]
+
+
+def split_delimited_page(prefix: str, page: dict[str, Any], start_after: str | None) -> tuple[int, list[ListingShard]]:
+    """
+    Totals the objects in a page of a listing of `prefix` delimited by '/', which starts after
+    `start_after`, returning their size in bytes and the shards holding the rest of the objects:
+    one for each of the page's sub-prefixes and one for the rest of the listing.
+    """
+    size = sum(obj["Size"] for obj in page.get("Contents", []))
+    sub_prefixes = [common_prefix["Prefix"] for common_prefix in page.get("CommonPrefixes", [])]
+    shards: list[ListingShard] = []
+
+    if start_after is not None and "/" in start_after[len(prefix) :]:
+        # Only the sub-prefix holding start_after's keys after it are left to list. Whether the
+        # page includes that sub-prefix at all varies, so it's always added here instead.
+        current = prefix + start_after[len(prefix) :].split("/", 1)[0] + "/"
+        shards.append(ListingShard(current, start_after=start_after))
+        sub_prefixes = [sub_prefix for sub_prefix in sub_prefixes if sub_prefix != current]
+
+    shards.extend(ListingShard(sub_prefix) for sub_prefix in sub_prefixes)
+
+    if page.get("IsTruncated"):
+        if page.get("CommonPrefixes"):
+            shards.append(ListingShard(prefix, continuation_token=page["NextContinuationToken"]))
+        else:
+            # A flat run of objects, so the rest is split by key instead.
+            shards.extend(split_key_range(prefix, page["Contents"][-1]["Key"], None))
+
+    return size, shards
+
+
+def list_prefix_shard(
+    s3: BaseClient, bucket_name: str, shard: ListingShard, page_size: int = LIST_PAGE_SIZE
+) -> tuple[int, list[ListingShard]]:
+    """
+    Lists the first page of a shard, returning the total size in bytes of its objects and the
+    shards the rest of it is split into.
+
+    If the first page holds the whole shard then there's nothing left to split, so small prefixes
+    are listed with a single request. Otherwise the rest of a prefix is split at its sub-prefixes,
+    found with one listing delimited by '/'. Where there are none, or the shard is already a key
+    range, the rest is split in two by key.
+    """
+    if shard.continuation_token is not None:
+        page = s3.list_objects_v2(
+            Bucket=bucket_name,
+            Prefix=shard.prefix,
+            Delimiter="/",
+            ContinuationToken=shard.continuation_token,
+            MaxKeys=page_size,
+        )
+        return split_delimited_page(shard.prefix, page, None)
+
+    list_args: dict[str, Any] = {"Bucket": bucket_name, "Prefix": shard.prefix, "MaxKeys": page_size}
+    if shard.start_after is not None:
+        list_args["StartAfter"] = shard.start_after
+
+    page = s3.list_objects_v2(**list_args)
+    contents = [obj for obj in page.get("Contents", []) if shard.end is None or obj["Key"] <= shard.end]
+    size = sum(obj["Size"] for obj in contents)
+
+    if not page.get("IsTruncated") or len(contents) < len(page["Contents"]):
+        return size, []
+
+    last_key = contents[-1]["Key"]
+    if shard.end is not None:
+        return size, split_key_range(shard.prefix, last_key, shard.end)
+
+    delimited_page = s3.list_objects_v2(
+        Bucket=bucket_name, Prefix=shard.prefix, Delimiter="/", StartAfter=last_key, MaxKeys=page_size
+    )
+    delimited_size, shards = split_delimited_page(shard.prefix, delimited_page, last_key)
+    return size + delimited_size, shards
+
+
+def parallel_prefix_storage_size(
+    s3: BaseClient, bucket_name: str, prefix: str, max_workers: int, page_size: int = LIST_PAGE_SIZE
+) -> int:
+    """
+    The total size in bytes of the objects under `prefix`, listed by `max_workers` threads.
+
+    A single listing is a serial chain of requests, one per page of objects. To list in
+    parallel, whatever is left of `prefix` after its first page is split into shards, at its
+    sub-prefixes or else by key range, and each shard is split again in the same way if it doesn't
+    fit in one page. Shards are listed concurrently as soon as they're known. Each object is
+    counted exactly once, as the shards never overlap.
+    """
+    total = 0
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {executor.submit(list_prefix_shard, s3, bucket_name, ListingShard(prefix), page_size)}
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                size, shards = future.result()
+                total += size
+
+                pending.update(
+                    executor.submit(list_prefix_shard, s3, bucket_name, shard, page_size) for shard in shards
+                )
+
+    return total
+
+
+class S3BucketListingStorage:
+    """
+    Samples the storage used by every workspace in a bucket from one listing of the bucket, so
+    the cost of sampling depends on the total number of objects rather than the number of
+    workspaces.
+
+    A listing is reused for `max_age` after it finishes, so that all of a sampling cycle's
+    requests are answered from the same listing. Concurrent requests for the same bucket wait for
+    the listing in progress rather than starting another.
+    """
+
+    def __init__(self, max_age: timedelta) -> None:
+        self.max_age = max_age
+
+        self._lock = threading.Lock()
+        self._listings: dict[str, tuple[float, datetime, dict[str, int]]] = {}
+
+    def workspace_sizes(self, s3: BaseClient, bucket_name: str) -> tuple[datetime, dict[str, int]]:
+        """
+        The time the bucket was listed and the total size in bytes of each workspace's objects.
+        Workspaces without any objects are absent.
+        """
+        with self._lock:
+            listing = self._listings.get(bucket_name)
+            if listing is None or time.monotonic() - listing[0] > self.max_age.total_seconds():
+                sample_time = datetime.now(UTC)
+                sizes = list_workspace_storage_sizes(s3, bucket_name)
+                logging.info("Listed %d workspaces' objects in %s", len(sizes), bucket_name)
+
+                listing = self._listings[bucket_name] = (time.monotonic(), sample_time, sizes)
+
+            _, sample_time, sizes = listing
+            return sample_time, sizes
@@ -0,0 +1,130 @@
+import codecs
+import csv
+import gzip
+import json
+import logging
+import re
+import threading
+from collections import defaultdict
+from collections.abc import Iterable, Iterator
+from datetime import UTC, datetime
+from typing import Any
+from urllib.parse import unquote_plus, urlparse
+
+from botocore.client import BaseClient
+from botocore.exceptions import ClientError
+
+# S3 Inventory writes each report's manifest under a prefix named for when it was created, such as
+# '2025-01-01T01-00Z/'. Other prefixes alongside these hold the data files and Hive symlinks.
+inventory_report_prefix_pattern = re.compile(r"\d{4}-\d{2}-\d{2}T\d{2}-\d{2}Z/$")
+
+
+def workspace_storage_sizes(rows: Iterable[dict[str, str]]) -> dict[str, int]:
+    """
+    Totals the size in bytes of the objects in each workspace from rows of a CSV inventory report.
+
+    An object belongs to the workspace named by the first segment of its key, as for access
+    billing. As with listing the bucket, only the current version of each object counts.
+    """
+    totals: defaultdict[str, int] = defaultdict(int)
+
+    for row in rows:
+        if row.get("IsLatest", "true") != "true" or row.get("IsDeleteMarker", "false") == "true":
+            continue
+
+        # Keys in CSV inventory reports are URL encoded.
+        key = unquote_plus(row["Key"])
+        if "/" not in key or not row["Size"]:
+            continue
+
+        totals[key.split("/", 1)[0]] += int(row["Size"])
+
+    return totals
+
+
+class S3InventoryStorage:
+    """
+    Reads workspace storage use from the reports of an S3 Inventory configuration on a workspace
+    bucket, rather than by listing the bucket.
+
+    `url` is where the configuration delivers its reports, which is normally
+    's3://<destination bucket>/<destination prefix>/<source bucket>/<configuration ID>/'. Only
+    CSV reports can be read.
+
+    The totals from the latest report are kept until a newer one is delivered, so the report is
+    read once however many workspaces are sampled from it.
+    """
+
+    def __init__(self, url: str) -> None:
+        parsed = urlparse(url)
+        self.bucket = parsed.netloc
+        self.prefix = parsed.path.strip("/") + "/"
+
+        self._lock = threading.Lock()
+        self._manifest_key: str | None = None
+        self._report: tuple[datetime, dict[str, int]] | None = None
+
+    def latest_manifest_key(self, s3: BaseClient) -> str:
+        """The key of the manifest of the most recent complete inventory report."""
+        paginator = s3.get_paginator("list_objects_v2")
+        report_prefixes = [
+            common_prefix["Prefix"]
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix, Delimiter="/")
+            for common_prefix in page.get("CommonPrefixes", [])
+            if inventory_report_prefix_pattern.search(common_prefix["Prefix"])
+        ]
+
+        for report_prefix in sorted(report_prefixes, reverse=True):
+            # The checksum is written after the manifest, so a report without one isn't finished.
+            try:
+                s3.head_object(Bucket=self.bucket, Key=f"{report_prefix}manifest.checksum")
+            except ClientError as e:
+                if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                    logging.info("Skipping incomplete inventory report %s", report_prefix)
+                    continue
+                raise
+
+            return f"{report_prefix}manifest.json"
+
+        raise Exception(f"No inventory reports found under s3://{self.bucket}/{self.prefix}")
+
+    def read_manifest(self, s3: BaseClient, manifest_key: str) -> dict[str, Any]:
+        return json.load(s3.get_object(Bucket=self.bucket, Key=manifest_key)["Body"])
+
+    def iter_report_rows(self, s3: BaseClient, manifest: dict[str, Any]) -> Iterator[dict[str, str]]:
+        """Streams the rows of every data file of an inventory report."""
+        if manifest["fileFormat"] != "CSV":
+            raise Exception(f"Unsupported inventory report format {manifest['fileFormat']}")
+
+        # The data files have no header row. Their columns are listed in the manifest.
+        columns = [column.strip() for column in manifest["fileSchema"].split(",")]
+
+        for data_file in manifest["files"]:
+            body = s3.get_object(Bucket=self.bucket, Key=data_file["key"])["Body"]
+            try:
+                with gzip.GzipFile(fileobj=body) as decompressed:
+                    yield from csv.DictReader(codecs.getreader("utf-8")(decompressed), fieldnames=columns)
+            finally:
+                body.close()
+
+    def workspace_sizes(self, s3: BaseClient, source_bucket: str) -> tuple[datetime, dict[str, int]]:
+        """
+        The time of the latest inventory report and the total size in bytes of each workspace's
+        objects in it. Workspaces without any objects are absent.
+        """
+        manifest_key = self.latest_manifest_key(s3)
+
+        with self._lock:
+            if manifest_key != self._manifest_key or self._report is None:
+                manifest = self.read_manifest(s3, manifest_key)
+                if manifest["sourceBucket"] != source_bucket:
+                    raise Exception(
+                        f"Inventory report {manifest_key} is of bucket {manifest['sourceBucket']}, not {source_bucket}"
+                    )
+
+                logging.info("Reading %d inventory data files from %s", len(manifest["files"]), manifest_key)
+                report_time = datetime.fromtimestamp(int(manifest["creationTimestamp"]) / 1000, UTC)
+                self._report = (report_time, workspace_storage_sizes(self.iter_report_rows(s3, manifest)))
+                self._manifest_key = manifest_key
+
+            return self._report
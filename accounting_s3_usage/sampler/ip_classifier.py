@@ -0,0 +1,318 @@
+import ipaddress
+import itertools
+import json
+import logging
+import mmap
+import os
+import socket
+import urllib.error
+import urllib.request
+from bisect import bisect_right
+from collections.abc import Callable, Iterable, Sequence
+from typing import Any
+
+IPNetwork = ipaddress.IPv4Network | ipaddress.IPv6Network
+
+AWS_IP_RANGES_URL = "https://ip-ranges.amazonaws.com/ip-ranges.json"
+
+# The saved form of an IPRangeIndex starts with this, then the length of a JSON header as 4 bytes.
+# After the header, padded to 16 bytes, are each IP version's range starts, range ends and class
+# codes, with addresses as big-endian integers of the version's width.
+INDEX_FILE_MAGIC = b"IPRANGE1"
+ADDRESS_WIDTHS = {4: 4, 6: 16}
+
+
+class PackedAddresses:
+    """
+    Fixed-width big-endian integers packed into a buffer, such as a memory map, and read as
+    they're indexed. Enough of a sequence for binary search.
+    """
+
+    def __init__(self, buffer: memoryview, width: int) -> None:
+        self._buffer = buffer
+        self._width = width
+
+    def __len__(self) -> int:
+        return len(self._buffer) // self._width
+
+    def __getitem__(self, i: int) -> int:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+
+        return int.from_bytes(self._buffer[i * self._width : (i + 1) * self._width])
+
+
+class IPRangeIndex:
+    """
+    Classifies IP addresses, such as by their data transfer SKU, by the networks containing them.
+    Lookups are a binary search of a sorted index of non-overlapping address ranges rather than a
+    scan of every network.
+
+    `networks` are (network, class) pairs and may overlap. Where they do, the class earliest in
+    `priority` wins. Addresses in none of the networks are of class `default`.
+    """
+
+    def __init__(self, networks: Iterable[tuple[IPNetwork, str]], priority: Sequence[str], default: str) -> None:
+        self.default = default
+        self.classes = list(priority)
+
+        by_version: dict[int, list[tuple[IPNetwork, str]]] = {4: [], 6: []}
+        for network, network_class in networks:
+            by_version[network.version].append((network, network_class))
+
+        # For each IP version, the first and last addresses and class of each range, by first
+        # address. Classes are coded by their position in `classes`.
+        self._ranges: dict[int, tuple[Sequence[int] | PackedAddresses, Sequence[int] | PackedAddresses, Sequence[int]]]
+        self._ranges = {version: self._build(networks, priority) for version, networks in by_version.items()}
+
+    @staticmethod
+    def _build(
+        networks: Sequence[tuple[IPNetwork, str]], priority: Sequence[str]
+    ) -> tuple[list[int], list[int], list[int]]:
+        # Sweep over the networks' boundaries, counting how many networks of each class cover
+        # the addresses between consecutive boundaries.
+        changes: dict[int, list[int]] = {}
+        for network, network_class in networks:
+            rank = priority.index(network_class)
+            changes.setdefault(int(network.network_address), [0] * len(priority))[rank] += 1
+            changes.setdefault(int(network.broadcast_address) + 1, [0] * len(priority))[rank] -= 1
+
+        starts: list[int] = []
+        ends: list[int] = []
+        ranks: list[int] = []
+        covering = [0] * len(priority)
+        points = sorted(changes)
+
+        for point, next_point in itertools.pairwise(points):
+            covering = [count + change for count, change in zip(covering, changes[point], strict=True)]
+            rank = next((rank for rank, count in enumerate(covering) if count), None)
+            if rank is None:
+                continue
+
+            if ranks and ends[-1] == point - 1 and ranks[-1] == rank:
+                ends[-1] = next_point - 1
+            else:
+                starts.append(point)
+                ends.append(next_point - 1)
+                ranks.append(rank)
+
+        return starts, ends, ranks
+
+    def __len__(self) -> int:
+        return sum(len(starts) for starts, _, _ in self._ranges.values())
+
+    def classify(self, ip: str) -> str:
+        address = ipaddress.ip_address(ip)
+        starts, ends, ranks = self._ranges[address.version]
+
+        value = int(address)
+        i = bisect_right(starts, value) - 1
+        if i >= 0 and value <= ends[i]:
+            return self.classes[ranks[i]]
+
+        return self.default
+
+    def classify_many(self, ips: Sequence[str]) -> list[str]:
+        """
+        Classifies many IP addresses at once. Each is still parsed one by one, then they're sorted
+        and matched to ranges in a single merge over the index, rather than searched for one by
+        one. Anything which isn't a valid IP address has the default class.
+        """
+        classified = [self.default] * len(ips)
+        values: dict[int, list[tuple[int, int]]] = {4: [], 6: []}
+
+        for position, ip in enumerate(ips):
+            try:
+                values[4].append((int.from_bytes(socket.inet_pton(socket.AF_INET, ip)), position))
+            except OSError:
+                try:
+                    values[6].append((int(ipaddress.IPv6Address(ip)), position))
+                except ValueError:
+                    continue
+
+        for version, version_values in values.items():
+            starts, ends, ranks = self._ranges[version]
+            i = 0
+
+            for value, position in sorted(version_values):
+                while i < len(ends) and ends[i] < value:
+                    i += 1
+                if i == len(ends):
+                    break
+                if starts[i] <= value:
+                    classified[position] = self.classes[ranks[i]]
+
+        return classified
+
+    def save(self, path: str, metadata: dict[str, Any]) -> None:
+        """
+        Writes the index to `path` in a compact binary form, along with `metadata` (which must be
+        JSON-serializable), for `load` to read back. The file is replaced atomically, so processes
+        sharing it never see it part-written.
+        """
+        header = json.dumps(
+            {
+                "metadata": metadata,
+                "classes": self.classes,
+                "default": self.default,
+                "counts": {version: len(starts) for version, (starts, _, _) in self._ranges.items()},
+            }
+        ).encode()
+        prefix = INDEX_FILE_MAGIC + len(header).to_bytes(4) + header
+        chunks = [prefix, bytes(-len(prefix) % 16)]
+
+        for version, (starts, ends, ranks) in self._ranges.items():
+            width = ADDRESS_WIDTHS[version]
+            chunks.append(b"".join(start.to_bytes(width) for start in starts))
+            chunks.append(b"".join(end.to_bytes(width) for end in ends))
+            chunks.append(bytes(ranks))
+
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.writelines(chunks)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> tuple["IPRangeIndex", dict[str, Any]]:
+        """
+        Reads an index written by `save`, and its metadata. The file is memory-mapped rather than
+        read, and ranges are decoded only as they're searched, so this takes about as long
+        however many ranges there are.
+        """
+        with open(path, "rb") as f:
+            buffer = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+        if buffer[: len(INDEX_FILE_MAGIC)] != INDEX_FILE_MAGIC:
+            raise Exception(f"{path} is not a saved IP range index")
+
+        header_start = len(INDEX_FILE_MAGIC) + 4
+        header_end = header_start + int.from_bytes(buffer[len(INDEX_FILE_MAGIC) : header_start])
+        header = json.loads(bytes(buffer[header_start:header_end]))
+
+        index = cls.__new__(cls)
+        index.classes = header["classes"]
+        index.default = header["default"]
+        index._ranges = {}
+
+        offset = header_end + -header_end % 16
+        for version, width in ADDRESS_WIDTHS.items():
+            count = header["counts"][str(version)]
+            starts = PackedAddresses(buffer[offset : offset + count * width], width)
+            ends = PackedAddresses(buffer[offset + count * width : offset + 2 * count * width], width)
+            offset += 2 * count * width
+            index._ranges[version] = (starts, ends, buffer[offset : offset + count])
+            offset += count
+
+        if offset != len(buffer):
+            raise Exception(f"{path} is truncated or corrupt")
+
+        return index, header["metadata"]
+
+
+def load_ip_ranges(url: str) -> dict[str, Any]:
+    """Reads AWS's published IP ranges (ip-ranges.json) from a URL or local path."""
+    if "://" not in url:
+        with open(url) as f:
+            return json.load(f)
+
+    with urllib.request.urlopen(url, timeout=30) as response:
+        return json.load(response)
+
+
+def fetch_ip_ranges(url: str, etag: str | None = None) -> tuple[dict[str, Any] | None, str | None]:
+    """
+    As `load_ip_ranges`, but if `etag` is given and matches the current ranges' ETag, they aren't
+    downloaded again and None is returned in their place. Returns the ranges' ETag too, which is
+    always None for local paths.
+    """
+    if "://" not in url:
+        return load_ip_ranges(url), None
+
+    request = urllib.request.Request(url, headers={"If-None-Match": etag} if etag else {})
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return json.load(response), response.headers.get("ETag")
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return None, etag
+        raise
+
+
+def cached_ip_range_index(
+    url: str, cache_path: str, build: Callable[[dict[str, Any]], IPRangeIndex], build_key: str
+) -> IPRangeIndex:
+    """
+    An index of the IP ranges at `url`, as built by `build`, cached in a file at `cache_path`.
+    `build_key` identifies how the index is built (such as by the region it's built for) - a
+    cached index built differently isn't used.
+
+    The cached index is revalidated against the ranges' ETag, and then their syncToken, and only
+    rebuilt if they've changed. If the ranges can't be read, the cached index is used regardless
+    of its age. The cache may be shared between processes, such as on a shared volume.
+    """
+    cached: IPRangeIndex | None = None
+    metadata: dict[str, Any] = {}
+    if os.path.exists(cache_path):
+        try:
+            cached, metadata = IPRangeIndex.load(cache_path)
+        except Exception:
+            logging.exception("Ignoring unreadable IP range index cache %s", cache_path)
+
+        if metadata.get("build_key") != build_key:
+            cached = None
+
+    try:
+        ip_ranges, etag = fetch_ip_ranges(url, metadata.get("etag") if cached is not None else None)
+    except Exception:
+        if cached is None:
+            raise
+
+        logging.exception(
+            "Failed to read IP ranges from %s. Using the cached ranges of %s.", url, metadata.get("create_date")
+        )
+        return cached
+
+    if ip_ranges is None:
+        assert cached is not None
+        return cached
+
+    sync_token = ip_ranges.get("syncToken")
+    if cached is not None and sync_token is not None and sync_token == metadata.get("sync_token"):
+        # The same ranges with a new ETag. Save it, so that later starts revalidate by ETag alone.
+        index = cached
+    else:
+        index = build(ip_ranges)
+
+    try:
+        index.save(
+            cache_path,
+            {
+                "build_key": build_key,
+                "etag": etag,
+                "sync_token": sync_token,
+                "create_date": ip_ranges.get("createDate"),
+            },
+        )
+    except OSError:
+        logging.exception("Failed to cache IP range index in %s", cache_path)
+
+    return index
+
+
+def ip_range_networks(
+    ip_ranges: dict[str, Any], region: str, in_region: str, other_region: str
+) -> list[tuple[IPNetwork, str]]:
+    """
+    The networks of AWS's published IP ranges, as classified by whether they're in `region`.
+    Prefixes not specific to one region ('GLOBAL') are treated as other regions.
+    """
+    return [
+        (ipaddress.ip_network(prefix[key]), in_region if prefix["region"] == region else other_region)
+        for prefixes, key in (
+            (ip_ranges.get("prefixes", []), "ip_prefix"),
+            (ip_ranges.get("ipv6_prefixes", []), "ipv6_prefix"),
+        )
+        for prefix in prefixes
+    ]
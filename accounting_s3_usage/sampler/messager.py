@@ -1,8 +1,11 @@
+import logging
+import os
+import threading
 import uuid
-from collections import defaultdict
-from collections.abc import Iterable, Iterator
+from collections.abc import Callable, Iterable, Iterator, Sequence
 from datetime import UTC, datetime
-from typing import Never
+from functools import lru_cache
+from typing import Any, Never
 
 import pulsar
 from eodhp_utils.aws.egress_classifier import AWSIPClassifier, EgressClass
@@ -11,20 +14,75 @@ from eodhp_utils.pulsar.messages import (
     BillingEvent,
     BillingResourceConsumptionRateSample,
 )
-from opentelemetry import baggage, trace
+from opentelemetry import baggage
 from opentelemetry.context import attach, detach
 
+from .ip_classifier import (
+    AWS_IP_RANGES_URL,
+    IPRangeIndex,
+    cached_ip_range_index,
+    ip_range_networks,
+    load_ip_ranges,
+)
 from .metrics import (
-    get_access_point_api_calls,
-    get_access_point_data_transfer,
+    AWS_REGION,
+    STORAGE_SAMPLE_BACKEND,
+    get_access_point_usage,
+    get_bucket_storage_sizes,
+    get_event_storage_sizes,
+    get_inventory_storage_sizes,
     get_prefix_storage_size,
+    get_workspaces_usage,
+    reconcile_event_storage_totals,
+    storage_size_cache,
 )
 from .sample_requests import (
     GenerateAccessBillingEventRequestMsg,
+    GenerateBatchedAccessBillingEventRequestMsg,
     SampleStorageUseRequestMsg,
 )
+from .telemetry import tracer
+from .usage_columns import UsageColumns
+
+# If set, remote IPs are classified for data transfer using AWS's published IP ranges
+# (ip-ranges.json) read from this URL or path, indexed for binary search, rather than by
+# eodhp_utils' AWSIPClassifier. metrics.AWS_REGION is the region transfer to which is charged as
+# in-region.
+EGRESS_IP_RANGES_URL = os.getenv("EGRESS_IP_RANGES_URL", "")
+
+# If set, the IP range index is cached in a file at this path, which may be on a volume shared
+# between replicas, and only rebuilt when the ranges change. Starting up then needn't download the
+# ranges at all if they haven't changed, and falls back to the cached index if they can't be
+# read. This implies EGRESS_IP_RANGES_URL, which defaults to AWS's URL.
+EGRESS_IP_RANGES_CACHE_PATH = os.getenv("EGRESS_IP_RANGES_CACHE_PATH", "")
+
+# How many remote IPs' classifications are remembered. The same few IPs recur across workspaces,
+# intervals and batches.
+EGRESS_CLASSIFIER_CACHE_SIZE = int(os.getenv("EGRESS_CLASSIFIER_CACHE_SIZE", "65536"))
 
-tracer = trace.get_tracer("s3-usage-sampler")
+TRANSFER_SKUS = {
+    EgressClass.REGION: "AWS-S3-DATA-TRANSFER-OUT-REGION",
+    EgressClass.INTERREGION: "AWS-S3-DATA-TRANSFER-OUT-INTERREGION",
+    EgressClass.INTERNET: "AWS-S3-DATA-TRANSFER-OUT-INTERNET",
+}
+
+# Usage queried with Athena may already be classified, with egress class names in place of remote
+# IPs (see metrics.egress_classified_sql).
+EGRESS_CLASS_SKUS = {egress_class.name: sku for egress_class, sku in TRANSFER_SKUS.items()}
+
+
+def build_transfer_sku_index(ip_ranges: dict[str, Any]) -> IPRangeIndex:
+    """An index of AWS's IP ranges classifying remote IPs by their data transfer SKU."""
+    return IPRangeIndex(
+        ip_range_networks(
+            ip_ranges,
+            AWS_REGION,
+            TRANSFER_SKUS[EgressClass.REGION],
+            TRANSFER_SKUS[EgressClass.INTERREGION],
+        ),
+        priority=[TRANSFER_SKUS[EgressClass.REGION], TRANSFER_SKUS[EgressClass.INTERREGION]],
+        default=TRANSFER_SKUS[EgressClass.INTERNET],
+    )
 
 
 class S3StorageSamplerMessager(Messager[Iterator[SampleStorageUseRequestMsg], BillingResourceConsumptionRateSample]):
@@ -49,7 +107,45 @@ class S3StorageSamplerMessager(Messager[Iterator[SampleStorageUseRequestMsg], Bi
         )
         return Messager.PulsarMessageAction(payload=sample)
 
+    def storage_sample(self, workspace: str, storage_gb: float, sample_time: datetime) -> Messager.Action:
+        print(f"======= {workspace} =======")
+        print(f"Sampled at: {sample_time.isoformat()}")
+        print(f"Storage Size: {storage_gb:.6f} GB")
+        print("============================\n")
+
+        return self.generate_storage_sample(workspace, storage_gb, sample_time)
+
     def process_msg(self, msg: Iterator[SampleStorageUseRequestMsg]) -> Iterable[Messager.Action]:
+        if STORAGE_SAMPLE_BACKEND == "inventory":
+            yield from self.process_msg_from_bucket_sizes(msg, get_inventory_storage_sizes)
+            return
+
+        if STORAGE_SAMPLE_BACKEND == "bucket":
+            yield from self.process_msg_from_bucket_sizes(msg, get_bucket_storage_sizes)
+            return
+
+        if STORAGE_SAMPLE_BACKEND == "events":
+            requests = list(msg)
+            unreconciled: set[tuple[str, str]] = set()
+            for bucket_name in {request.bucket_name for request in requests}:
+                unreconciled.update(
+                    (bucket_name, workspace)
+                    for workspace in reconcile_event_storage_totals(
+                        bucket_name, [request.workspace for request in requests if request.bucket_name == bucket_name]
+                    )
+                )
+
+            for bucket_name, workspace in unreconciled:
+                logging.warning(
+                    "Not sampling storage of %s in %s until its total is reconciled", workspace, bucket_name
+                )
+
+            yield from self.process_msg_from_bucket_sizes(
+                (request for request in requests if (request.bucket_name, request.workspace) not in unreconciled),
+                get_event_storage_sizes,
+            )
+            return
+
         for request in msg:
             token = attach(baggage.set_baggage("workspace", request.workspace))
 
@@ -57,14 +153,42 @@ class S3StorageSamplerMessager(Messager[Iterator[SampleStorageUseRequestMsg], Bi
                 workspace = request.workspace
                 bucket_name = request.bucket_name
                 sample_time = datetime.now(UTC)
-                storage_gb = get_prefix_storage_size(bucket_name, workspace)
 
-                print(f"======= {workspace} =======")
-                print(f"Sampled at: {sample_time.isoformat()}")
-                print(f"Storage Size: {storage_gb:.6f} GB")
-                print("============================\n")
+                cached_gb = storage_size_cache.get(bucket_name, workspace, sample_time) if storage_size_cache else None
+                if cached_gb is not None:
+                    storage_gb = cached_gb
+                else:
+                    storage_gb = get_prefix_storage_size(bucket_name, workspace)
+                    if storage_size_cache is not None:
+                        storage_size_cache.put(bucket_name, workspace, storage_gb, sample_time)
+
+                yield self.storage_sample(workspace, storage_gb, sample_time)
+            finally:
+                detach(token)
+
+    def process_msg_from_bucket_sizes(
+        self,
+        msg: Iterator[SampleStorageUseRequestMsg],
+        bucket_sizes: Callable[[str], tuple[datetime, dict[str, float]]],
+    ) -> Iterable[Messager.Action]:
+        """
+        Samples every requested workspace from one pass over its bucket, made by `bucket_sizes`,
+        which gives the time of the pass and the storage used by each workspace with any objects.
+
+        For inventory buckets the time is the report's creation, so sampling the same report
+        again produces the same samples rather than new ones.
+        """
+        buckets: dict[str, tuple[datetime, dict[str, float]]] = {}
+
+        for request in msg:
+            token = attach(baggage.set_baggage("workspace", request.workspace))
+
+            try:
+                if request.bucket_name not in buckets:
+                    buckets[request.bucket_name] = bucket_sizes(request.bucket_name)
 
-                yield self.generate_storage_sample(workspace, storage_gb, sample_time)
+                sample_time, storage_gb = buckets[request.bucket_name]
+                yield self.storage_sample(request.workspace, storage_gb.get(request.workspace, 0.0), sample_time)
             finally:
                 detach(token)
 
@@ -72,7 +196,12 @@ class S3StorageSamplerMessager(Messager[Iterator[SampleStorageUseRequestMsg], Bi
         raise NotImplementedError()
 
 
-class S3AccessBillingEventMessager(Messager[Iterator[GenerateAccessBillingEventRequestMsg], BillingEvent]):
+class S3AccessBillingEventMessager(
+    Messager[
+        Iterator[GenerateAccessBillingEventRequestMsg | GenerateBatchedAccessBillingEventRequestMsg],
+        BillingEvent,
+    ]
+):
     """
     This generates BillingEvents for the cost of API calls and data transfer from workspace
     object stores.
@@ -83,7 +212,25 @@ class S3AccessBillingEventMessager(Messager[Iterator[GenerateAccessBillingEventR
     def __init__(self, producer: pulsar.Producer | None = None) -> None:
         super().__init__(producer=producer)
 
-        self._aws_ip_classifier = AWSIPClassifier()
+        # Only needed, and so only built, without an IP range index.
+        self._aws_ip_classifier: AWSIPClassifier | None = None
+        self._aws_ip_classifier_lock = threading.Lock()
+
+        self._ip_range_index: IPRangeIndex | None = None
+        classify: Callable[[str], str] = self.classify_transfer
+        if EGRESS_IP_RANGES_CACHE_PATH:
+            self._ip_range_index = cached_ip_range_index(
+                EGRESS_IP_RANGES_URL or AWS_IP_RANGES_URL,
+                EGRESS_IP_RANGES_CACHE_PATH,
+                build_transfer_sku_index,
+                build_key=f"transfer-skus-{AWS_REGION}",
+            )
+            classify = self._ip_range_index.classify
+        elif EGRESS_IP_RANGES_URL:
+            self._ip_range_index = build_transfer_sku_index(load_ip_ranges(EGRESS_IP_RANGES_URL))
+            classify = self._ip_range_index.classify
+
+        self._destination_sku = lru_cache(maxsize=EGRESS_CLASSIFIER_CACHE_SIZE)(classify)
 
     def generate_billing_event(
         self, request: GenerateAccessBillingEventRequestMsg, sku: str, quantity: float
@@ -100,50 +247,165 @@ class S3AccessBillingEventMessager(Messager[Iterator[GenerateAccessBillingEventR
         )
         return Messager.PulsarMessageAction(payload=event)
 
-    def process_msg(self, msg: Iterator[GenerateAccessBillingEventRequestMsg]) -> Iterable[Messager.Action]:
-        for request in msg:
-            token = attach(baggage.set_baggage("workspace", request.workspace))
-            try:
-                sku_quantities: defaultdict[str, float] = defaultdict(lambda: 0)
+    def transfer_sku(self, destination: str) -> str | None:
+        """The SKU for data transfer to a remote IP, or None if it isn't charged."""
+        if destination == "-":
+            # "-" is used as the remote IP when CloudFront accesses S3. We charge
+            # for data transfer from CloudFront separately so it's important we
+            # ignore these. It's not obvious in what other circumstances it might be
+            # "-"
+            #
+            # Null remote IPs have not been observed and are treated the same, to be
+            # defensive.
+            return None
 
-                data_transfer_by_destination = get_access_point_data_transfer(
-                    request.workspace, request.interval_start, request.interval_end
-                )
+        if destination in EGRESS_CLASS_SKUS:
+            return EGRESS_CLASS_SKUS[destination]
 
-                for destination, transferred in data_transfer_by_destination:
-                    if destination is None or destination == "-":
-                        # "-" is used as the remote IP when CloudFront accesses S3. We charge
-                        # for data transfer from CloudFront separately so it's important we
-                        # ignore these. It's not obvious in what other circumstances it might be
-                        # "-"
-                        #
-                        # None has not been observed and is here to be defensive.
-                        continue
-
-                    print(f"{destination=}, {transferred=}")
-                    egress_type = self._aws_ip_classifier.classify(destination)
-                    sku = {
-                        EgressClass.REGION: "AWS-S3-DATA-TRANSFER-OUT-REGION",
-                        EgressClass.INTERREGION: "AWS-S3-DATA-TRANSFER-OUT-INTERREGION",
-                        EgressClass.INTERNET: "AWS-S3-DATA-TRANSFER-OUT-INTERNET",
-                    }[egress_type]
-
-                    assert transferred is not None
-                    sku_quantities[sku] += float(transferred)
-
-                sku_quantities["AWS-S3-API-CALLS"] = get_access_point_api_calls(
-                    request.workspace, request.interval_start, request.interval_end
-                )
+        return self._destination_sku(destination)
+
+    def transfer_skus(self, destinations: Sequence[str]) -> list[str | None]:
+        """
+        The SKU for data transfer to each of a list of remote IPs, or None where it isn't
+        charged, as for `transfer_sku`. With an IP range index, they're classified all at once.
+        """
+        unclassified = [
+            destination for destination in destinations if destination != "-" and destination not in EGRESS_CLASS_SKUS
+        ]
+        if self._ip_range_index is not None:
+            unclassified_skus = iter(self._ip_range_index.classify_many(unclassified))
+        else:
+            unclassified_skus = map(self._destination_sku, unclassified)
+
+        return [
+            None
+            if destination == "-"
+            else EGRESS_CLASS_SKUS[destination]
+            if destination in EGRESS_CLASS_SKUS
+            else next(unclassified_skus)
+            for destination in destinations
+        ]
+
+    def classify_transfer(self, destination: str) -> str:
+        """The SKU for data transfer to a remote IP, as classified by AWSIPClassifier."""
+        with self._aws_ip_classifier_lock:
+            classifier = self._aws_ip_classifier
+            if classifier is None:
+                classifier = self._aws_ip_classifier = AWSIPClassifier()
+
+        return TRANSFER_SKUS[classifier.classify(destination)]
+
+    def sku_quantities(self, usage_by_destination: Iterable[tuple[Any, ...]]) -> dict[str, float]:
+        """
+        The quantity of each SKU used by one workspace in one interval, from its usage rows, which
+        are of the form (remoteip, total_gb_transferred, object_api_calls, listing_api_calls).
+
+        Data transfer is only charged for rows with object API calls - rows with only listings
+        have no object data transfer.
+        """
+        usage = UsageColumns()
+        usage.add_group(None)
+        usage.extend(None, usage_by_destination)
+
+        return usage.sku_totals(self.transfer_skus, "AWS-S3-API-CALLS")[0]
+
+    def generate_billing_events_for_quantities(
+        self, request: GenerateAccessBillingEventRequestMsg, sku_quantities: dict[str, float]
+    ) -> Iterator[Messager.Action]:
+        print(f"======= {request.workspace} =======")
+        print(f"Time Interval: {request.interval_start} to {request.interval_end}")
+        print(f"{sku_quantities}")
+        print("============================\n")
+
+        for sku, quantity in sku_quantities.items():
+            yield self.generate_billing_event(request, sku, quantity)
+
+    def generate_billing_events(
+        self,
+        request: GenerateAccessBillingEventRequestMsg,
+        usage_by_destination: Iterable[tuple[Any, ...]],
+    ) -> Iterator[Messager.Action]:
+        """
+        Generates the billing events for one workspace and interval from its usage rows, as for
+        `sku_quantities`.
+        """
+        yield from self.generate_billing_events_for_quantities(request, self.sku_quantities(usage_by_destination))
 
-                print(f"======= {request.workspace} =======")
-                print(f"Time Interval: {request.interval_start} to {request.interval_end}")
-                print(f"{sku_quantities}")
-                print("============================\n")
+    def generate_batched_billing_events(
+        self,
+        batch: GenerateBatchedAccessBillingEventRequestMsg,
+        usage_rows: Iterable[tuple[Any, ...]],
+    ) -> Iterator[Messager.Action]:
+        """
+        Generates billing events for every workspace and interval in a batched request from the
+        rows of a single query covering all of them.
 
-                for sku, quantity in sku_quantities.items():
-                    yield self.generate_billing_event(request, sku, quantity)
+        The rows are collected column-wise, so each distinct remote IP is classified once for the
+        whole batch.
+        """
+        requests = list(batch.workspace_requests())
+
+        usage = UsageColumns()
+        for interval_index, request in requests:
+            usage.add_group((request.workspace, interval_index))
+
+        for workspace, interval_index, *usage_by_destination in usage_rows:
+            assert workspace is not None
+            assert interval_index is not None
+            usage.append((workspace, int(interval_index)), usage_by_destination)
+
+        totals = usage.sku_totals(self.transfer_skus, "AWS-S3-API-CALLS")
+
+        for group, (interval_index, request) in enumerate(requests):
+            assert usage.groups[group] == (request.workspace, interval_index)
+
+            token = attach(baggage.set_baggage("workspace", request.workspace))
+            try:
+                yield from self.generate_billing_events_for_quantities(request, totals[group])
             finally:
                 detach(token)
 
-    def gen_empty_catalogue_message(self, msg: Iterator[GenerateAccessBillingEventRequestMsg]) -> Never:
+    def query_usage(
+        self, request: GenerateAccessBillingEventRequestMsg | GenerateBatchedAccessBillingEventRequestMsg
+    ) -> Iterable[tuple[Any, ...]]:
+        """Submits the query for a request's usage. Its results are read when iterated."""
+        if isinstance(request, GenerateBatchedAccessBillingEventRequestMsg):
+            return get_workspaces_usage(
+                request.workspaces, request.interval_start, request.interval_end, request.interval
+            )
+
+        return get_access_point_usage(request.workspace, request.interval_start, request.interval_end)
+
+    def process_msg(
+        self, msg: Iterator[GenerateAccessBillingEventRequestMsg | GenerateBatchedAccessBillingEventRequestMsg]
+    ) -> Iterable[Messager.Action]:
+        # The queries' spans are children of this one.
+        with tracer.start_as_current_span("generate-access-billing-events"):
+            # Every query is submitted before any results are read so that they run concurrently.
+            pending = [(request, self.query_usage(request)) for request in msg]
+
+            # The usage of every unbatched request is collected together so that all their remote
+            # IPs are classified at once. Each request is a group, identified by its position.
+            usage = UsageColumns()
+            for position, (request, usage_rows) in enumerate(pending):
+                if not isinstance(request, GenerateBatchedAccessBillingEventRequestMsg):
+                    usage.add_group(position)
+                    usage.extend(position, usage_rows)
+
+            totals = usage.sku_totals(self.transfer_skus, "AWS-S3-API-CALLS")
+
+            for position, (request, usage_rows) in enumerate(pending):
+                if isinstance(request, GenerateBatchedAccessBillingEventRequestMsg):
+                    yield from self.generate_batched_billing_events(request, usage_rows)
+                    continue
+
+                token = attach(baggage.set_baggage("workspace", request.workspace))
+                try:
+                    yield from self.generate_billing_events_for_quantities(request, totals[usage.add_group(position)])
+                finally:
+                    detach(token)
+
+    def gen_empty_catalogue_message(
+        self, msg: Iterator[GenerateAccessBillingEventRequestMsg | GenerateBatchedAccessBillingEventRequestMsg]
+    ) -> Never:
         raise NotImplementedError()
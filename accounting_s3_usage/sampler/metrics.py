@@ -1,14 +1,37 @@
+import logging
 import os
-from collections.abc import Generator
-from datetime import datetime
+import threading
+from collections.abc import Callable, Collection, Iterable, Iterator, Sequence
+from concurrent.futures import Future
+from datetime import UTC, date, datetime, time, timedelta
+from typing import Any
+from urllib.parse import urlparse
 
 import boto3
 
+from .access_logs import (
+    ACCESS_LOG_REGEX,
+    WRITE_OPERATIONS_REGEX,
+    AccessLogManifest,
+    S3LogObjectReader,
+    aggregate_access_log_objects,
+    iter_access_log_records,
+    list_access_log_objects,
+    usage_rows,
+    written_workspaces,
+)
 from .athena_utils import (
-    run_athena_query,
+    AthenaQueryEngine,
+    AthenaResultCache,
+    run_csv_result_athena_query,
     run_long_result_athena_query,
-    run_single_result_athena_query,
 )
+from .bucket_listing import S3BucketListingStorage, parallel_prefix_storage_size
+from .inventory import S3InventoryStorage
+from .ip_classifier import AWS_IP_RANGES_URL, ip_range_networks, load_ip_ranges
+from .sample_requests import LOG_DELAY_BUFFER
+from .storage_cache import StorageSizeCache
+from .storage_events import StorageEventTotals
 
 ATHENA_DB = os.getenv("ATHENA_DB", "accounting_eodhp_dev")
 ATHENA_OUTPUT_BUCKET = os.getenv("ATHENA_OUTPUT_BUCKET", "accounting-athena-eodhp-dev")
@@ -18,6 +41,170 @@ LOGS_PREFIX = os.getenv(
     "s3://workspaces-access-logs-eodhp-dev/012345678901/us-east-1/workspaces-eodhp-dev",
 )
 
+# S3 partitions access logs by the day of either the request ("EventTime") or the log file's
+# delivery ("DeliveryTime"). With EventTime partitions, queries can select log entries by
+# partition rather than parsing every request time. This must match the bucket's logging
+# configuration: assuming EventTime for DeliveryTime partitions loses or misplaces entries logged
+# near midnight, so the default is the DeliveryTime handling, which is correct for either.
+LOGS_PARTITION_DATE_SOURCE = os.getenv("WORKSPACE_S3_ACCESS_LOGS_PARTITION_DATE_SOURCE", "DeliveryTime")
+
+# Where access billing usage comes from: "athena" queries the logs with Athena, "local" reads and
+# parses the log objects in this process. The latter avoids Athena's minimum charge per query,
+# which dominates the cost for small deployments. "incremental" is like "local" but only reads log
+# objects which haven't been read before, keeping running totals of their usage in a manifest.
+ACCESS_LOG_BACKEND = os.getenv("ACCESS_LOG_BACKEND", "athena")
+LOCAL_ACCESS_LOG_BACKENDS = {"local", "incremental"}
+
+# The incremental backend's manifest and running totals. Usage for periods which aren't whole
+# multiples of the totals' resolution is read from the log objects as for the "local" backend.
+ACCESS_LOG_MANIFEST_PATH = os.getenv("ACCESS_LOG_MANIFEST_PATH", "access_log_manifest.sqlite3")
+ACCESS_LOG_TOTALS_RESOLUTION_MINUTES = int(os.getenv("ACCESS_LOG_TOTALS_RESOLUTION_MINUTES", "60"))
+
+# How many processes parse log objects for the local backends. Parsing is CPU-bound, so this
+# should be about the number of cores available.
+ACCESS_LOG_PARSER_PROCESSES = int(os.getenv("ACCESS_LOG_PARSER_PROCESSES", "1"))
+
+access_log_manifest = (
+    AccessLogManifest(ACCESS_LOG_MANIFEST_PATH, resolution=timedelta(minutes=ACCESS_LOG_TOTALS_RESOLUTION_MINUTES))
+    if ACCESS_LOG_BACKEND == "incremental"
+    else None
+)
+
+# Where storage samples come from: "list" lists each workspace's objects separately, "bucket"
+# lists the whole bucket once and sizes every workspace from that, and "inventory" reads the latest
+# report of an S3 Inventory configuration on the workspace bucket, delivered under
+# STORAGE_INVENTORY_S3_PREFIX. Listing costs a request per 1,000 objects on every sample, whereas
+# an inventory report is read once for every workspace but is only updated daily or weekly.
+# "events" keeps running totals from S3 event notifications delivered to STORAGE_EVENTS_QUEUE_URL,
+# which are almost free to sample, and reconciles them with a listing every
+# STORAGE_RECONCILE_HOURS.
+STORAGE_SAMPLE_BACKEND = os.getenv("STORAGE_SAMPLE_BACKEND", "list")
+STORAGE_INVENTORY_S3_PREFIX = os.getenv("STORAGE_INVENTORY_S3_PREFIX", "")
+
+# With the "bucket" backend, how long a listing answers sample requests for. This should be long
+# enough to cover a whole sampling cycle but shorter than the sampling interval.
+STORAGE_LISTING_MAX_AGE_MINUTES = int(os.getenv("STORAGE_LISTING_MAX_AGE_MINUTES", "30"))
+
+# With the "list" backend, how many threads list each workspace. With more than one, a workspace
+# with more than one page of objects is split into shards, at its sub-prefixes or by key range,
+# which are listed concurrently.
+STORAGE_LISTING_THREADS = int(os.getenv("STORAGE_LISTING_THREADS", "1"))
+
+# With the "events" backend, the running totals are kept in an SQLite database at
+# STORAGE_EVENTS_DB_PATH, which is required. It must persist across restarts: workspaces in a new
+# store are reconciled with a full listing before they're first sampled.
+STORAGE_EVENTS_QUEUE_URL = os.getenv("STORAGE_EVENTS_QUEUE_URL", "")
+STORAGE_EVENTS_DB_PATH = os.getenv("STORAGE_EVENTS_DB_PATH", "")
+STORAGE_RECONCILE_HOURS = int(os.getenv("STORAGE_RECONCILE_HOURS", "24"))
+
+storage_event_totals = (
+    StorageEventTotals(STORAGE_EVENTS_DB_PATH, reconcile_interval=timedelta(hours=STORAGE_RECONCILE_HOURS))
+    if STORAGE_SAMPLE_BACKEND == "events" and STORAGE_EVENTS_DB_PATH
+    else None
+)
+# With the "list" backend, if set, each workspace's last sampled size is cached in an SQLite
+# database at this path and reused, without listing the workspace, while the access logs show no
+# objects written or deleted in it. Sizes older than STORAGE_SIZE_CACHE_MAX_AGE_HOURS are always
+# refreshed.
+STORAGE_SIZE_CACHE_PATH = os.getenv("STORAGE_SIZE_CACHE_PATH", "")
+STORAGE_SIZE_CACHE_MAX_AGE_HOURS = int(os.getenv("STORAGE_SIZE_CACHE_MAX_AGE_HOURS", "168"))
+
+storage_size_cache = (
+    StorageSizeCache(
+        STORAGE_SIZE_CACHE_PATH, max_age=timedelta(hours=STORAGE_SIZE_CACHE_MAX_AGE_HOURS), log_delay=LOG_DELAY_BUFFER
+    )
+    if STORAGE_SAMPLE_BACKEND == "list" and STORAGE_SIZE_CACHE_PATH
+    else None
+)
+storage_inventory = S3InventoryStorage(STORAGE_INVENTORY_S3_PREFIX) if STORAGE_SAMPLE_BACKEND == "inventory" else None
+storage_listing = (
+    S3BucketListingStorage(max_age=timedelta(minutes=STORAGE_LISTING_MAX_AGE_MINUTES))
+    if STORAGE_SAMPLE_BACKEND == "bucket"
+    else None
+)
+
+# Athena's default quota is 20-25 concurrent DML queries per account and region.
+ATHENA_MAX_CONCURRENT_QUERIES = int(os.getenv("ATHENA_MAX_CONCURRENT_QUERIES", "20"))
+
+# If set, Athena may answer queries for settled intervals with the results of an identical query
+# run up to this many minutes earlier, without scanning any data.
+ATHENA_RESULT_REUSE_MINUTES = int(os.getenv("ATHENA_RESULT_REUSE_MINUTES", "0"))
+
+# Shared by all billing queries so that they run concurrently, up to the limit above.
+athena_engine = AthenaQueryEngine(
+    max_in_flight=ATHENA_MAX_CONCURRENT_QUERIES,
+    result_reuse_max_age=timedelta(minutes=ATHENA_RESULT_REUSE_MINUTES) if ATHENA_RESULT_REUSE_MINUTES else None,
+)
+
+# If set, results of queries for settled intervals are cached in an SQLite database at this path
+# so that re-running them (such as when back-filling after a restart) costs nothing.
+ATHENA_RESULT_CACHE_PATH = os.getenv("ATHENA_RESULT_CACHE_PATH", "")
+ATHENA_RESULT_CACHE_MAX_MB = int(os.getenv("ATHENA_RESULT_CACHE_MAX_MB", "512"))
+ATHENA_RESULT_CACHE_MAX_AGE_DAYS = int(os.getenv("ATHENA_RESULT_CACHE_MAX_AGE_DAYS", "30"))
+
+athena_result_cache = (
+    AthenaResultCache(
+        ATHENA_RESULT_CACHE_PATH,
+        max_bytes=ATHENA_RESULT_CACHE_MAX_MB * 1024**2,
+        max_age=timedelta(days=ATHENA_RESULT_CACHE_MAX_AGE_DAYS),
+    )
+    if ATHENA_RESULT_CACHE_PATH
+    else None
+)
+
+# How to read billing query results: "api" pages through GetQueryResults, "s3" streams the CSV
+# result file Athena writes to ATHENA_OUTPUT_BUCKET. The latter is much faster for large results.
+ATHENA_RESULT_READER = os.getenv("ATHENA_RESULT_READER", "api")
+
+# A Parquet table of pre-aggregated, pre-attributed log entries, partitioned by day and
+# workspace. Billing queries read it instead of the raw logs for days which have been rolled up.
+# Entries are summed into periods of ATHENA_ROLLUP_RESOLUTION_MINUTES, which should divide a day,
+# so periods and intervals which aren't whole multiples of it are read from the raw logs. Log
+# partitions must be by EventTime, so that each day's entries are in that day's partition.
+ATHENA_ROLLUP_TABLE = os.getenv("ATHENA_ROLLUP_TABLE", f"{ATHENA_TABLE}_rollup")
+ROLLUP_PREFIX = os.getenv("ATHENA_ROLLUP_S3_PREFIX", f"s3://{ATHENA_OUTPUT_BUCKET}/rollup/{ATHENA_ROLLUP_TABLE}/")
+ATHENA_ROLLUP_RESOLUTION_MINUTES = int(os.getenv("ATHENA_ROLLUP_RESOLUTION_MINUTES", "60"))
+
+# Athena writes at most this many partitions in one INSERT INTO.
+ROLLUP_MAX_PARTITIONS_PER_QUERY = 100
+
+# For each day (as 'YYYY-MM-DD'), the workspaces whose logs for that day are completely present
+# in the rollup table. Workspaces whose access points appear later are rolled up separately. This
+# is updated by the access billing pipeline while others read it, so is guarded by the lock.
+rolled_up_workspaces: dict[str, set[str]] = {}
+rolled_up_lock = threading.Lock()
+
+# A lookup table of AWS's published IP ranges (ip-ranges.json, read from ATHENA_IP_RANGES_URL),
+# each tagged with its egress class. Once it's loaded, billing queries classify remote IPs for data
+# transfer themselves, so they return a row per egress class rather than per remote IP. AWS_REGION
+# is the region transfer to which is charged as in-region.
+ATHENA_IP_RANGES_TABLE = os.getenv("ATHENA_IP_RANGES_TABLE", f"{ATHENA_TABLE}_ip_ranges")
+IP_RANGES_PREFIX = os.getenv(
+    "ATHENA_IP_RANGES_S3_PREFIX", f"s3://{ATHENA_OUTPUT_BUCKET}/ip-ranges/{ATHENA_IP_RANGES_TABLE}/"
+)
+ATHENA_IP_RANGES_URL = os.getenv("ATHENA_IP_RANGES_URL", AWS_IP_RANGES_URL)
+AWS_REGION = os.getenv("AWS_REGION", os.getenv("AWS_DEFAULT_REGION", "eu-west-2"))
+
+# Egress classes, named as eodhp_utils' EgressClass, in order of priority where IP ranges overlap.
+# Remote IPs in none of the ranges are of the last class.
+EGRESS_CLASSES = ("REGION", "INTERREGION", "INTERNET")
+
+# The syncToken of the IP ranges in the lookup table, or None if it hasn't been loaded.
+ip_ranges_sync_token: str | None = None
+
+REQUEST_TIME_SQL = "parse_datetime(requestdatetime, 'dd/MMM/yyyy:HH:mm:ss Z')"
+
+# Request times are logged as 'dd/MMM/yyyy:HH:mm:ss +0000', so the time of day can be compared
+# as a string without parsing the whole thing.
+REQUEST_TIME_OF_DAY_SQL = "substr(requestdatetime, 13, 8)"
+REQUEST_SECOND_OF_DAY_SQL = (
+    "(CAST(substr(requestdatetime, 13, 2) AS BIGINT) * 3600 "
+    "+ CAST(substr(requestdatetime, 16, 2) AS BIGINT) * 60 "
+    "+ CAST(substr(requestdatetime, 19, 2) AS BIGINT))"
+)
+
+SECONDS_PER_DAY = 86400
+
 
 def format_datetime(dt: datetime) -> str:
     """Format datetime to string in the format 'YYYY-MM-DD HH:MM:SS'."""
@@ -28,8 +215,136 @@ def get_partition_start_end_days(start_time: datetime, end_time: datetime) -> tu
     return (start_time.strftime("%Y/%m/%d"), end_time.strftime("%Y/%m/%d"))
 
 
+def workspace_list_sql(workspaces: Collection[str]) -> str:
+    """Format workspace names as the contents of an SQL `IN (...)` list."""
+    return ", ".join(f"'{workspace}'" for workspace in sorted(workspaces))
+
+
+def partition_list_sql(partitions: Iterable[str]) -> str:
+    """Format log partitions as the contents of an SQL `IN (...)` list."""
+    return ", ".join(f"'{partition}'" for partition in partitions)
+
+
+def is_settled(end_time: datetime) -> bool:
+    """Whether all logs for a period ending at `end_time` should have been delivered by now."""
+    return end_time <= datetime.now(UTC) - LOG_DELAY_BUFFER
+
+
+def typed_rows(
+    rows: Iterable[tuple[str | None, ...]], column_types: Sequence[Callable[[str], Any]]
+) -> Iterator[tuple[Any, ...]]:
+    """
+    Converts result rows using `column_types`. Rows with nulls are skipped, as they are when the
+    results are read as CSV. Billing queries coalesce nullable columns, so there shouldn't be any.
+    """
+    for row in rows:
+        values = [value for value in row if value is not None]
+        if len(values) < len(row):
+            logging.warning("Skipping result row with nulls: %s", row)
+            continue
+
+        yield tuple(convert(value) for convert, value in zip(column_types, values, strict=True))
+
+
+def run_billing_query(
+    query: str,
+    column_types: Sequence[Callable[[str], Any]],
+    settled: bool = False,
+    kind: str = "other",
+    workspace: str | None = None,
+) -> Iterator[tuple[Any, ...]]:
+    """
+    Submits a billing query to the shared engine and returns an iterator over its result rows,
+    read as configured by ATHENA_RESULT_READER and converted using `column_types`. The query's
+    cost is recorded against `kind` and `workspace`.
+
+    If `settled` is set then the query's results cannot change and may be cached or reused.
+    """
+
+    def run() -> Iterator[tuple[Any, ...]]:
+        if ATHENA_RESULT_READER == "s3":
+            return run_csv_result_athena_query(
+                query,
+                ATHENA_DB,
+                ATHENA_OUTPUT_BUCKET,
+                column_types,
+                engine=athena_engine,
+                reuse_results=settled,
+                kind=kind,
+                workspace=workspace,
+            )
+
+        rows = run_long_result_athena_query(
+            query,
+            ATHENA_DB,
+            ATHENA_OUTPUT_BUCKET,
+            engine=athena_engine,
+            reuse_results=settled,
+            kind=kind,
+            workspace=workspace,
+        )
+        return typed_rows(rows, column_types)
+
+    if settled and athena_result_cache is not None:
+        return athena_result_cache.cached_results(query, ATHENA_DB, run)
+
+    return run()
+
+
+def get_inventory_storage_sizes(bucket_name: str) -> tuple[datetime, dict[str, float]]:
+    """
+    The time of the latest inventory report of `bucket_name` and the storage used by each
+    workspace in it, in GB. Workspaces without any objects are absent.
+    """
+    assert storage_inventory is not None
+    report_time, sizes = storage_inventory.workspace_sizes(boto3.client("s3"), bucket_name)
+    return report_time, {workspace: size / (1024**3) for workspace, size in sizes.items()}
+
+
+def get_bucket_storage_sizes(bucket_name: str) -> tuple[datetime, dict[str, float]]:
+    """
+    The time `bucket_name` was listed and the storage used by each workspace in it, in GB.
+    Workspaces without any objects are absent.
+    """
+    assert storage_listing is not None
+    sample_time, sizes = storage_listing.workspace_sizes(boto3.client("s3"), bucket_name)
+    return sample_time, {workspace: size / (1024**3) for workspace, size in sizes.items()}
+
+
+def get_event_storage_sizes(bucket_name: str) -> tuple[datetime, dict[str, float]]:
+    """
+    The storage used by each workspace in `bucket_name`, in GB, from the running totals after
+    applying every event notification waiting in the queue, and the time they're up to date at.
+    """
+    assert storage_event_totals is not None
+    sample_time = datetime.now(UTC)
+    storage_event_totals.consume(boto3.client("sqs"), STORAGE_EVENTS_QUEUE_URL)
+
+    sizes = storage_event_totals.workspace_sizes(bucket_name)
+    return sample_time, {workspace: size / (1024**3) for workspace, size in sizes.items()}
+
+
+def reconcile_event_storage_totals(bucket_name: str, workspaces: Iterable[str]) -> set[str]:
+    """
+    Reconciles the running totals of any of `workspaces` which are due it with a listing, as for
+    `StorageEventTotals.reconcile_due`. Returns the workspaces whose totals have never been
+    reconciled, and so can't be sampled yet.
+    """
+    assert storage_event_totals is not None
+    return storage_event_totals.reconcile_due(
+        bucket_name,
+        workspaces,
+        lambda bucket, workspace: round(get_prefix_storage_size(bucket, f"{workspace}/") * 1024**3),
+    )
+
+
 def get_prefix_storage_size(bucket_name: str, prefix: str) -> float:
     s3 = boto3.client("s3")
+
+    if STORAGE_LISTING_THREADS > 1:
+        size_bytes = parallel_prefix_storage_size(s3, bucket_name, prefix, STORAGE_LISTING_THREADS)
+        return size_bytes / (1024**3)
+
     paginator = s3.get_paginator("list_objects_v2")
 
     total_size_bytes = 0
@@ -43,45 +358,575 @@ def get_prefix_storage_size(bucket_name: str, prefix: str) -> float:
     return size_gb
 
 
-def get_access_point_data_transfer(
+def get_access_point_usage(
     workspace_prefix: str, start_time: datetime, end_time: datetime
-) -> Generator[tuple[str | None, ...]]:
-    start_partition, end_partition = get_partition_start_end_days(start_time, end_time)
+) -> Iterator[tuple[Any, ...]]:
+    """
+    Data transfer and API calls for a workspace from a single scan of the logs. This returns rows
+    of (remoteip, total_gb_transferred, object_api_calls, listing_api_calls).
+
+    `total_gb_transferred` and `object_api_calls` cover requests for objects in the workspace, and
+    `listing_api_calls` covers listings of its prefix. Null remote IPs are reported as '-'.
+
+    If the rollup table covers the whole period, or the usage is read from the log objects
+    locally, then log entries are attributed as for `get_workspaces_usage`. Usage queried with
+    Athena has remote IPs replaced by their egress classes, as described for
+    `egress_classified_sql`, once the IP ranges table has been loaded.
+    """
+    if ACCESS_LOG_BACKEND in LOCAL_ACCESS_LOG_BACKENDS or rollup_covers(start_time, end_time, [workspace_prefix]):
+        return (row[2:] for row in get_workspaces_usage([workspace_prefix], start_time, end_time))
+
+    object_request = f"key LIKE '{workspace_prefix}/%'"
+    listing_request = f"request_uri LIKE '%prefix={workspace_prefix}%/%'"
     query = f"""
-    SELECT remoteip, COALESCE(SUM(bytessent), 0)/1073741824.0 AS total_gb_transferred
+    SELECT COALESCE(remoteip, '-') AS remoteip,
+           COALESCE(SUM(bytessent) FILTER (WHERE {object_request}), 0)/1073741824.0 AS total_gb_transferred,
+           COUNT_IF({object_request}) AS object_api_calls,
+           COUNT_IF({listing_request}) AS listing_api_calls
     FROM {ATHENA_DB}.{ATHENA_TABLE}
-    WHERE key LIKE '{workspace_prefix}/%'
-      AND parse_datetime(requestdatetime, 'dd/MMM/yyyy:HH:mm:ss Z')
-          BETWEEN TIMESTAMP '{format_datetime(start_time)}' AND TIMESTAMP '{format_datetime(end_time)}'
-      AND timestamp BETWEEN '{start_partition}' AND '{end_partition}'
-    GROUP BY remoteip
+    WHERE ({object_request} OR {listing_request})
+      AND {raw_log_time_filter_sql(start_time, end_time)}
+    GROUP BY 1
+    """
+    if ip_ranges_sync_token is not None:
+        query = egress_classified_sql(query, [])
+
+    return run_billing_query(
+        query, (str, float, int, int), settled=is_settled(end_time), kind="usage", workspace=workspace_prefix
+    )
+
+
+def batched_time_filter_sql(start_time: datetime, end_time: datetime, request_time: str = REQUEST_TIME_SQL) -> str:
+    """
+    The request time condition selecting log entries in the half-open period from `start_time`
+    to `end_time`, so that each log entry falls into exactly one of a series of intervals.
+    """
+    return (
+        f"{request_time} >= TIMESTAMP '{format_datetime(start_time)}' "
+        f"AND {request_time} < TIMESTAMP '{format_datetime(end_time)}'"
+    )
+
+
+def interval_index_sql(start_time: datetime, interval: timedelta | None, request_time: str = REQUEST_TIME_SQL) -> str:
+    """
+    An SQL expression giving the index of the interval, counting from `start_time`, containing
+    each log entry. When `start_time` is aligned with `time_utils.align_to_interval` these
+    intervals are aligned in the same way.
+    """
+    if interval is None:
+        return "0"
+
+    return (
+        f"CAST(floor((to_unixtime({request_time}) - {start_time.timestamp():.0f}) "
+        f"/ {interval.total_seconds():.0f}) AS BIGINT)"
+    )
+
+
+def raw_log_time_filter_sql(start_time: datetime, end_time: datetime) -> str:
+    """
+    The condition selecting raw log entries in the half-open period from `start_time` to
+    `end_time`.
+
+    With EventTime partitions this lists the partitions explicitly. Days wholly inside the period
+    are selected by partition alone and the rest by comparing the time of day as a string, so no
+    request times are parsed. Otherwise request times are parsed and compared.
+    """
+    if LOGS_PARTITION_DATE_SOURCE != "EventTime":
+        start_partition, end_partition = get_partition_start_end_days(start_time, end_time)
+        return (
+            f"{batched_time_filter_sql(start_time, end_time)} "
+            f"AND timestamp BETWEEN '{start_partition}' AND '{end_partition}'"
+        )
+
+    start_time = start_time.astimezone(UTC)
+    end_time = end_time.astimezone(UTC)
+
+    partitions = []
+    whole_days = []
+    partial_days = []
+    for day in days_touched(start_time, end_time):
+        day_start = datetime.combine(date.fromisoformat(day), time.min, tzinfo=UTC)
+        partition = day_start.strftime("%Y/%m/%d")
+        partitions.append(partition)
+
+        times = []
+        if start_time > day_start:
+            times.append(f"{REQUEST_TIME_OF_DAY_SQL} >= '{start_time.strftime('%H:%M:%S')}'")
+        if end_time < day_start + timedelta(days=1):
+            times.append(f"{REQUEST_TIME_OF_DAY_SQL} < '{end_time.strftime('%H:%M:%S')}'")
+
+        if times:
+            partial_days.append(f"(timestamp = '{partition}' AND {' AND '.join(times)})")
+        else:
+            whole_days.append(partition)
+
+    if not partitions:
+        return "false"
+
+    selections = [f"timestamp IN ({partition_list_sql(whole_days)})"] if whole_days else []
+    selections += partial_days
+    return f"timestamp IN ({partition_list_sql(partitions)}) AND ({' OR '.join(selections)})"
+
+
+def raw_log_interval_index_sql(start_time: datetime, end_time: datetime, interval: timedelta | None) -> str:
+    """
+    As `interval_index_sql`, for raw log entries selected by `raw_log_time_filter_sql`.
+
+    With EventTime partitions the day is looked up from the partition and the time of day is
+    taken from the request time string, so no request times are parsed. For whole-day intervals
+    starting at midnight the partition alone is enough.
     """
-    return run_long_result_athena_query(query, ATHENA_DB, ATHENA_OUTPUT_BUCKET)
+    if interval is None:
+        return "0"
 
+    if LOGS_PARTITION_DATE_SOURCE != "EventTime":
+        return interval_index_sql(start_time, interval)
+
+    start_time = start_time.astimezone(UTC)
+    first_day = start_time.date()
+    interval_seconds = int(interval.total_seconds())
+    day_offsets = {
+        date.fromisoformat(day).strftime("%Y/%m/%d"): (date.fromisoformat(day) - first_day).days
+        for day in days_touched(start_time, end_time)
+    }
+
+    if interval_seconds % SECONDS_PER_DAY == 0 and start_time.timetz() == time.min.replace(tzinfo=UTC):
+        interval_days = interval_seconds // SECONDS_PER_DAY
+        cases = " ".join(f"WHEN '{p}' THEN {offset // interval_days}" for p, offset in day_offsets.items())
+        return f"CASE timestamp {cases} END"
+
+    cases = " ".join(f"WHEN '{p}' THEN {offset * SECONDS_PER_DAY}" for p, offset in day_offsets.items())
+    start_second = start_time.hour * 3600 + start_time.minute * 60 + start_time.second
+    return f"(CASE timestamp {cases} END + {REQUEST_SECOND_OF_DAY_SQL} - {start_second}) / {interval_seconds}"
+
+
+def attributed_log_entries_sql(columns: str, conditions: str) -> str:
+    """
+    A FROM clause over the raw logs giving a row for each workspace each log entry is attributed
+    to, with columns `workspace`, `is_object_request`, `remoteip` (with nulls as '-'),
+    `bytessent` and the extra `columns`. Only log entries matching `conditions` are included.
+
+    Object requests are attributed to the workspace named by the first component of `key`.
+    Listing requests are attributed to the workspace named by the first component of the
+    `prefix=` parameter in `request_uri` (up to the first '/', '%2F', '&' or space). A log entry
+    which is both is attributed to each.
+    """
+    return f"""(
+        SELECT COALESCE(remoteip, '-') AS remoteip,
+               bytessent,
+               {columns},
+               IF(key LIKE '%/%', split_part(key, '/', 1)) AS object_workspace,
+               regexp_extract(request_uri, 'prefix=([^/%& "]+)', 1) AS listing_workspace
+        FROM {ATHENA_DB}.{ATHENA_TABLE}
+        WHERE (key LIKE '%/%' OR request_uri LIKE '%prefix=%')
+          AND {conditions}
+    )
+    CROSS JOIN UNNEST(
+        ARRAY[object_workspace, listing_workspace], ARRAY[true, false]
+    ) AS attribution (workspace, is_object_request)"""
+
+
+def get_workspaces_usage(
+    workspaces: Collection[str], start_time: datetime, end_time: datetime, interval: timedelta | None = None
+) -> Iterator[tuple[Any, ...]]:
+    """
+    Data transfer and API calls for all of `workspaces` at once from a single scan of the logs.
+    This returns rows of
+      (workspace, interval_index, remoteip, total_gb_transferred, object_api_calls, listing_api_calls)
+    with the last four columns as for `get_access_point_usage`. Log entries are attributed to
+    workspaces as described for `attributed_log_entries_sql`.
+
+    If `interval` is given, the period from `start_time` to `end_time` is split into intervals
+    of that length and `interval_index` identifies which one each row belongs to. Otherwise the
+    interval index is always 0.
+
+    The rollup table is used instead of the raw logs if it covers the whole period for all of
+    `workspaces`. If ACCESS_LOG_BACKEND is "local" or "incremental" then the raw log objects are
+    read and parsed here instead, with the same results, which is why those backends are only
+    used with all workspaces batched together. Usage queried with Athena has remote IPs replaced by
+    their egress classes, as described for `egress_classified_sql`, once the IP ranges table has
+    been loaded.
+    """
+    if not workspaces:
+        return iter(())
+
+    if ACCESS_LOG_BACKEND in LOCAL_ACCESS_LOG_BACKENDS:
+        return get_workspaces_usage_from_log_objects(workspaces, start_time, end_time, interval)
+
+    column_types = (str, int, str, float, int, int)
+
+    # Queries for several workspaces' usage aren't tagged with any one of them.
+    workspace = next(iter(workspaces)) if len(workspaces) == 1 else None
+
+    if rollup_covers(start_time, end_time, workspaces, interval):
+        query = f"""
+        SELECT workspace,
+               {interval_index_sql(start_time, interval, "requesttime")} AS interval_index,
+               remoteip,
+               COALESCE(SUM(bytessent), 0)/1073741824.0 AS total_gb_transferred,
+               SUM(object_requests) AS object_api_calls,
+               SUM(listing_requests) AS listing_api_calls
+        FROM {ATHENA_DB}.{ATHENA_ROLLUP_TABLE}
+        WHERE workspace IN ({workspace_list_sql(workspaces)})
+          AND day IN ({", ".join(f"'{day}'" for day in days_touched(start_time, end_time))})
+          AND {batched_time_filter_sql(start_time, end_time, "requesttime")}
+        GROUP BY 1, 2, 3
+        """
+    else:
+        entries = attributed_log_entries_sql(
+            f"{raw_log_interval_index_sql(start_time, end_time, interval)} AS interval_index",
+            raw_log_time_filter_sql(start_time, end_time),
+        )
+        query = f"""
+        SELECT workspace,
+               interval_index,
+               remoteip,
+               COALESCE(SUM(bytessent) FILTER (WHERE is_object_request), 0)/1073741824.0 AS total_gb_transferred,
+               COUNT_IF(is_object_request) AS object_api_calls,
+               COUNT_IF(NOT is_object_request) AS listing_api_calls
+        FROM {entries}
+        WHERE workspace IN ({workspace_list_sql(workspaces)})
+        GROUP BY 1, 2, 3
+        """
+
+    if ip_ranges_sync_token is not None:
+        query = egress_classified_sql(query, ["workspace", "interval_index"])
+
+    return run_billing_query(query, column_types, settled=is_settled(end_time), kind="usage", workspace=workspace)
+
+
+def egress_classified_sql(usage_query: str, group_columns: Sequence[str]) -> str:
+    """
+    Wraps a usage query giving rows of (*group_columns, remoteip, total_gb_transferred,
+    object_api_calls, listing_api_calls) so that the remote IPs are replaced by their egress
+    classes (one of EGRESS_CLASSES), looked up in the IP ranges table by CIDR containment. Rows are
+    summed per egress class, so there are at most three per group, plus one for remote IPs of '-',
+    which are left as they are.
+
+    The usage query appears once, so its logs are only scanned once: each of its rows is joined
+    to the ranges containing its remote IP and takes the narrowest class of them, then the rows
+    are summed by class.
+    """
+    groups = "".join(f"{column}, " for column in group_columns)
+    usage_columns = [*group_columns, "remoteip", "total_gb_transferred", "object_api_calls", "listing_api_calls"]
+    ranks = " ".join(f"WHEN '{egress_class}' THEN {rank}" for rank, egress_class in enumerate(EGRESS_CLASSES))
+    classes = " ".join(f"WHEN {rank} THEN '{egress_class}'" for rank, egress_class in enumerate(EGRESS_CLASSES))
+    return f"""
+    SELECT {groups}CASE WHEN remoteip = '-' THEN '-' ELSE CASE egress_rank {classes} END END AS remoteip,
+           SUM(total_gb_transferred) AS total_gb_transferred,
+           SUM(object_api_calls) AS object_api_calls,
+           SUM(listing_api_calls) AS listing_api_calls
+    FROM (
+        SELECT {", ".join(f"usage.{column}" for column in usage_columns)},
+               MIN(CASE ranges.egress_class {ranks} ELSE {len(EGRESS_CLASSES) - 1} END) AS egress_rank
+        FROM ({usage_query}) AS usage
+        LEFT JOIN {ATHENA_DB}.{ATHENA_IP_RANGES_TABLE} AS ranges
+          ON usage.remoteip <> '-' AND contains(ranges.cidr, TRY_CAST(usage.remoteip AS IPADDRESS))
+        GROUP BY {", ".join(str(i + 1) for i in range(len(usage_columns)))}
+    ) AS classified
+    GROUP BY {", ".join(str(i + 1) for i in range(len(group_columns) + 1))}
+    """
+
+
+def raw_log_partitions(start_time: datetime, end_time: datetime) -> list[str]:
+    """
+    The raw log partitions, as 'yyyy/MM/dd', which `raw_log_time_filter_sql` selects from for
+    the half-open period from `start_time` to `end_time`.
+    """
+    if LOGS_PARTITION_DATE_SOURCE == "EventTime":
+        return [date.fromisoformat(day).strftime("%Y/%m/%d") for day in days_touched(start_time, end_time)]
+
+    day = start_time.date()
+    partitions = []
+    while day <= end_time.date():
+        partitions.append(day.strftime("%Y/%m/%d"))
+        day += timedelta(days=1)
+
+    return partitions
+
+
+def get_workspaces_written_since(start_time: datetime, end_time: datetime | None = None) -> set[str]:
+    """
+    The workspaces with objects written or deleted by requests logged from `start_time` until
+    `end_time` (by default, now).
+    """
+    end_time = end_time or datetime.now(UTC)
+
+    if ACCESS_LOG_BACKEND in LOCAL_ACCESS_LOG_BACKENDS:
+        s3 = boto3.client("s3")
+        bucket, prefix = split_s3_url(LOGS_PREFIX)
+        partition_prefixes = [f"{prefix}{partition}/" for partition in raw_log_partitions(start_time, end_time)]
+        records = iter_access_log_records(
+            S3LogObjectReader(bucket, s3), list_access_log_objects(s3, bucket, partition_prefixes)
+        )
+        return written_workspaces(records, start_time, end_time)
 
-def get_access_point_api_calls(workspace_prefix: str, start_time: datetime, end_time: datetime) -> float:
-    start_partition, end_partition = get_partition_start_end_days(start_time, end_time)
     query = f"""
-    SELECT COUNT(*) AS total_api_calls FROM (
-        SELECT requestid FROM {ATHENA_DB}.{ATHENA_TABLE}
-        WHERE key LIKE '{workspace_prefix}/%'
-          AND parse_datetime(requestdatetime, 'dd/MMM/yyyy:HH:mm:ss Z')
-            BETWEEN TIMESTAMP '{format_datetime(start_time)}' AND TIMESTAMP '{format_datetime(end_time)}'
-          AND timestamp BETWEEN '{start_partition}' AND '{end_partition}'
-
-        UNION ALL
-
-        SELECT requestid FROM {ATHENA_DB}.{ATHENA_TABLE}
-        WHERE request_uri LIKE '%prefix={workspace_prefix}%/%'
-          AND parse_datetime(requestdatetime, 'dd/MMM/yyyy:HH:mm:ss Z')
-            BETWEEN TIMESTAMP '{format_datetime(start_time)}' AND TIMESTAMP '{format_datetime(end_time)}'
-          AND timestamp BETWEEN '{start_partition}' AND '{end_partition}'
+SELECT DISTINCT split_part(key, '/', 1) AS workspace
+FROM {ATHENA_DB}.{ATHENA_TABLE}
+WHERE {raw_log_time_filter_sql(start_time, end_time)}
+  AND regexp_like(operation, '{WRITE_OPERATIONS_REGEX}')
+  AND strpos(key, '/') > 0
+"""
+    return {workspace for (workspace,) in run_billing_query(query, [str], kind="storage_changes")}
+
+
+def get_workspaces_usage_from_log_objects(
+    workspaces: Collection[str], start_time: datetime, end_time: datetime, interval: timedelta | None = None
+) -> Iterator[tuple[Any, ...]]:
+    """
+    As `get_workspaces_usage`, but reads the raw log objects from the same partitions as Athena
+    would and parses them in a single pass. With the incremental backend, only objects which
+    haven't been read before are parsed and the usage comes from the manifest's running totals.
+    """
+    s3 = boto3.client("s3")
+    bucket, prefix = split_s3_url(LOGS_PREFIX)
+    partition_prefixes = [f"{prefix}{partition}/" for partition in raw_log_partitions(start_time, end_time)]
+
+    if access_log_manifest is not None and access_log_manifest.covers(start_time, end_time, interval):
+        access_log_manifest.ingest(s3, bucket, partition_prefixes, processes=ACCESS_LOG_PARSER_PROCESSES)
+        return access_log_manifest.usage(workspaces, start_time, end_time, interval)
+
+    totals = aggregate_access_log_objects(
+        S3LogObjectReader(bucket, s3),
+        list_access_log_objects(s3, bucket, partition_prefixes),
+        workspaces,
+        start_time,
+        end_time,
+        interval,
+        processes=ACCESS_LOG_PARSER_PROCESSES,
     )
+    return usage_rows(totals)
+
+
+def days_touched(start_time: datetime, end_time: datetime) -> list[str]:
+    """The UTC days, as 'YYYY-MM-DD', overlapping the half-open period from start_time to end_time."""
+    day = start_time.astimezone(UTC).date()
+    last_day = (end_time - timedelta(microseconds=1)).astimezone(UTC).date()
+
+    days = []
+    while day <= last_day:
+        days.append(day.isoformat())
+        day += timedelta(days=1)
+
+    return days
+
+
+def rollup_covers(
+    start_time: datetime, end_time: datetime, workspaces: Collection[str], interval: timedelta | None = None
+) -> bool:
+    """
+    Whether the rollup table contains every log entry of `workspaces` between `start_time` and
+    `end_time`, and the period and intervals are made up of whole periods of its resolution.
+    Queries against the rollup table use half-open intervals.
     """
-    return run_single_result_athena_query(query, ATHENA_DB, ATHENA_OUTPUT_BUCKET)
+    resolution_seconds = ATHENA_ROLLUP_RESOLUTION_MINUTES * 60
+    if (
+        int(start_time.timestamp()) % resolution_seconds != 0
+        or int(end_time.timestamp()) % resolution_seconds != 0
+        or (interval is not None and int(interval.total_seconds()) % resolution_seconds != 0)
+    ):
+        return False
+
+    with rolled_up_lock:
+        return all(
+            day in rolled_up_workspaces and rolled_up_workspaces[day].issuperset(workspaces)
+            for day in days_touched(start_time, end_time)
+        )
+
+
+def split_s3_url(url: str) -> tuple[str, str]:
+    parsed = urlparse(url)
+    return parsed.netloc, parsed.path.lstrip("/")
+
+
+def create_rollup_table() -> None:
+    query = f"""
+CREATE EXTERNAL TABLE IF NOT EXISTS {ATHENA_DB}.{ATHENA_ROLLUP_TABLE} (
+    requesttime TIMESTAMP,
+    remoteip STRING,
+    bytessent BIGINT,
+    object_requests BIGINT,
+    listing_requests BIGINT
+)
+PARTITIONED BY (
+    day STRING,
+    workspace STRING
+)
+STORED AS PARQUET
+LOCATION '{ROLLUP_PREFIX}'
+TBLPROPERTIES (
+ 'parquet.compression'='SNAPPY'
+);
+"""
+
+    athena_engine.submit(query, ATHENA_DB, ATHENA_OUTPUT_BUCKET, kind="ddl").result()
+
+
+def load_rolled_up_workspaces() -> dict[str, set[str]]:
+    """
+    Finds the days and workspaces whose rollup has completed, from their marker objects, and
+    records them.
+    """
+    bucket, prefix = split_s3_url(ROLLUP_PREFIX)
+    marker_prefix = f"{prefix}_rolled_up/"
+
+    paginator = boto3.client("s3").get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=marker_prefix):
+        for obj in page.get("Contents", []):
+            # Markers for a whole day, without a workspace, don't say which workspaces it covers.
+            day, _, workspace = obj["Key"][len(marker_prefix) :].partition("/")
+            if workspace:
+                with rolled_up_lock:
+                    rolled_up_workspaces.setdefault(day, set()).add(workspace)
+
+    return rolled_up_workspaces
+
+
+def workspaces_to_roll_up(day: date, workspaces: Collection[str]) -> list[str]:
+    """Those of `workspaces` whose logs for `day` aren't in the rollup table yet, sorted."""
+    with rolled_up_lock:
+        rolled_up = rolled_up_workspaces.get(day.isoformat(), set())
+        return sorted(set(workspaces) - rolled_up)
+
+
+def rollup_access_logs(days: Iterable[date], workspaces: Collection[str]) -> None:
+    """
+    Materializes the raw logs of `workspaces` for each of `days` into the rollup table, one row
+    per period of ATHENA_ROLLUP_RESOLUTION_MINUTES, remote IP and workspace, with `requesttime`
+    the start of the period. The days should be settled so that no more logs will arrive for them.
+    Workspaces already rolled up for a day are skipped.
+
+    Each workspace's output for a day is removed before it is written, so that re-running a day
+    whose rollup failed part-way through doesn't double count. A marker object is written for
+    each workspace once its day is complete.
+
+    Each day is read from its partition alone, which only holds all of its log entries with
+    EventTime partitions, so this raises an exception otherwise.
+    """
+    if LOGS_PARTITION_DATE_SOURCE != "EventTime":
+        raise Exception(f"Access logs can't be rolled up from {LOGS_PARTITION_DATE_SOURCE} partitions")
+
+    resolution_seconds = ATHENA_ROLLUP_RESOLUTION_MINUTES * 60
+    s3 = boto3.client("s3")
+    bucket, prefix = split_s3_url(ROLLUP_PREFIX)
+
+    pending: list[tuple[str, list[str], list[Future[str]]]] = []
+    for day in days:
+        day_str = day.isoformat()
+        day_workspaces = workspaces_to_roll_up(day, workspaces)
+        if not day_workspaces:
+            continue
+
+        partitions = {f"{prefix}day={day_str}/workspace={workspace}/" for workspace in day_workspaces}
+        paginator = s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=f"{prefix}day={day_str}/"):
+            stale = [
+                {"Key": obj["Key"]}
+                for obj in page.get("Contents", [])
+                if obj["Key"][: obj["Key"].rfind("/") + 1] in partitions
+            ]
+            if stale:
+                s3.delete_objects(Bucket=bucket, Delete={"Objects": stale})
+
+        futures = []
+        for i in range(0, len(day_workspaces), ROLLUP_MAX_PARTITIONS_PER_QUERY):
+            # Every entry in the day's partition is from that day, so the period's start is found
+            # from the time of day without parsing the whole request time.
+            entries = attributed_log_entries_sql(
+                f"date_add('second', {REQUEST_SECOND_OF_DAY_SQL} / {resolution_seconds} * {resolution_seconds}, "
+                f"TIMESTAMP '{day_str} 00:00:00') AS requesttime",
+                f"timestamp = '{day.strftime('%Y/%m/%d')}'",
+            )
+            query = f"""
+            INSERT INTO {ATHENA_DB}.{ATHENA_ROLLUP_TABLE}
+            SELECT requesttime,
+                   remoteip,
+                   COALESCE(SUM(bytessent) FILTER (WHERE is_object_request), 0) AS bytessent,
+                   COUNT_IF(is_object_request) AS object_requests,
+                   COUNT_IF(NOT is_object_request) AS listing_requests,
+                   '{day_str}' AS day,
+                   workspace
+            FROM {entries}
+            WHERE workspace IN ({workspace_list_sql(day_workspaces[i : i + ROLLUP_MAX_PARTITIONS_PER_QUERY])})
+            GROUP BY requesttime, remoteip, workspace
+            """
+            futures.append(athena_engine.submit(query, ATHENA_DB, ATHENA_OUTPUT_BUCKET, kind="rollup"))
+
+        pending.append((day_str, day_workspaces, futures))
+
+    for day_str, day_workspaces, futures in pending:
+        for future in futures:
+            future.result()
+
+        for workspace in day_workspaces:
+            s3.put_object(Bucket=bucket, Key=f"{prefix}_rolled_up/{day_str}/{workspace}", Body=b"")
+
+        with rolled_up_lock:
+            rolled_up_workspaces.setdefault(day_str, set()).update(day_workspaces)
+        logging.info("Rolled up access logs of %d workspaces for %s", len(day_workspaces), day_str)
+
+
+def rollup_settled_days(workspaces: Collection[str], since: datetime) -> None:
+    """
+    Rolls up every settled day from the one containing `since` for which any of `workspaces`
+    isn't rolled up yet.
+    """
+    day = since.astimezone(UTC).date()
+    days = []
+
+    while is_settled(datetime.combine(day + timedelta(days=1), datetime.min.time(), tzinfo=UTC)):
+        if workspaces_to_roll_up(day, workspaces):
+            days.append(day)
+        day += timedelta(days=1)
+
+    if days:
+        rollup_access_logs(days, workspaces)
+
+
+def create_ip_ranges_table() -> None:
+    query = f"""
+CREATE EXTERNAL TABLE IF NOT EXISTS {ATHENA_DB}.{ATHENA_IP_RANGES_TABLE} (
+    cidr STRING,
+    egress_class STRING
+)
+ROW FORMAT DELIMITED
+FIELDS TERMINATED BY ','
+STORED AS TEXTFILE
+LOCATION '{IP_RANGES_PREFIX}';
+"""
+
+    athena_engine.submit(query, ATHENA_DB, ATHENA_OUTPUT_BUCKET, kind="ddl").result()
+
+
+def refresh_ip_ranges_table() -> bool:
+    """
+    Reads AWS's published IP ranges and, if they've changed since they were last written, writes
+    them to the IP ranges table, tagged with their egress classes as for
+    `ip_classifier.ip_range_networks`. Returns whether they were written.
+    """
+    global ip_ranges_sync_token
+
+    ip_ranges = load_ip_ranges(ATHENA_IP_RANGES_URL)
+    sync_token = str(ip_ranges.get("syncToken", ""))
+    if sync_token and sync_token == ip_ranges_sync_token:
+        return False
+
+    # Prefixes are listed once per AWS service using them.
+    networks = dict.fromkeys(ip_range_networks(ip_ranges, AWS_REGION, EGRESS_CLASSES[0], EGRESS_CLASSES[1]))
+    body = "".join(f"{network},{egress_class}\n" for network, egress_class in networks)
+
+    bucket, prefix = split_s3_url(IP_RANGES_PREFIX)
+    boto3.client("s3").put_object(Bucket=bucket, Key=f"{prefix}ip_ranges.csv", Body=body.encode())
+
+    ip_ranges_sync_token = sync_token
+    logging.info("Wrote %d AWS IP ranges (syncToken %s) to the IP ranges table", len(networks), sync_token)
+    return True
 
 
 def create_athena_table() -> None:
+    # Backslashes are escaped in Athena DDL string literals.
+    input_regex = ACCESS_LOG_REGEX.replace("\\", "\\\\")
     query = f"""
 CREATE EXTERNAL TABLE IF NOT EXISTS {ATHENA_DB}.{ATHENA_TABLE} (
     bucket_owner STRING,
@@ -115,7 +960,7 @@ PARTITIONED BY (
 )
 ROW FORMAT SERDE 'org.apache.hadoop.hive.serde2.RegexSerDe'
 WITH SERDEPROPERTIES (
- 'input.regex'='([^ ]*) ([^ ]*) \\\\[([^]]*)\\\\] ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ("[^"]*"|-) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ("[^"]*"|-) ("[^"]*"|-) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*)(?: ([^ ]*))?.*$'
+ 'input.regex'='{input_regex}'
 )
 LOCATION '{LOGS_PREFIX}'
 TBLPROPERTIES (
@@ -129,5 +974,4 @@ TBLPROPERTIES (
 );
 """
 
-    athena = boto3.client("athena")
-    run_athena_query(athena, query, ATHENA_DB, ATHENA_OUTPUT_BUCKET)
+    athena_engine.submit(query, ATHENA_DB, ATHENA_OUTPUT_BUCKET, kind="ddl").result()
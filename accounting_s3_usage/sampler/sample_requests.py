@@ -17,6 +17,10 @@ AWS_BUCKET_NAME = os.getenv("AWS_WORKSPACE_BUCKET_NAME", "workspaces-eodhp-dev")
 # read more here: https://docs.aws.amazon.com/AmazonS3/latest/userguide/ServerLogs.html#LogDeliveryBestEffort
 LOG_DELAY_BUFFER = timedelta(hours=3)
 
+# The most intervals a single batched access billing request may cover. This bounds the size of
+# each query's result when catching up on a long backlog.
+MAX_BATCHED_INTERVALS = 1000
+
 
 @dataclass(eq=True, frozen=True)
 class SampleStorageUseRequestMsg:
@@ -33,6 +37,55 @@ class GenerateAccessBillingEventRequestMsg:
     interval_end: datetime
 
 
+@dataclass(eq=True, frozen=True)
+class GenerateBatchedAccessBillingEventRequestMsg:
+    """
+    A request to generate access billing events for several workspace object stores in the same
+    bucket, and optionally for several consecutive intervals, at once. The Messager queries the
+    logs once for all of them and then fans the results out into per-workspace, per-interval
+    events.
+
+    If `interval` is None then the request covers the single interval from `interval_start` to
+    `interval_end`. Otherwise that period is split into consecutive intervals of length
+    `interval`.
+    """
+
+    workspaces: tuple[str, ...]
+    bucket_name: str
+    interval_start: datetime
+    interval_end: datetime
+    interval: timedelta | None = None
+
+    def intervals(self) -> list[tuple[datetime, datetime]]:
+        if self.interval is None:
+            return [(self.interval_start, self.interval_end)]
+
+        intervals = []
+        begin_at = self.interval_start
+        while begin_at < self.interval_end:
+            intervals.append((begin_at, begin_at + self.interval))
+            begin_at += self.interval
+
+        return intervals
+
+    def workspace_requests(self) -> Generator[tuple[int, GenerateAccessBillingEventRequestMsg]]:
+        """
+        Yields the equivalent unbatched requests, each with the index of its interval within
+        this request.
+        """
+        for index, (interval_start, interval_end) in enumerate(self.intervals()):
+            for workspace in self.workspaces:
+                yield (
+                    index,
+                    GenerateAccessBillingEventRequestMsg(
+                        workspace=workspace,
+                        bucket_name=self.bucket_name,
+                        interval_start=interval_start,
+                        interval_end=interval_end,
+                    ),
+                )
+
+
 def parse_workspace_prefix(workspace_prefix: str) -> str:
     if workspace_prefix.lower().startswith(AWS_PREFIX.lower()):
         removed_prefix = workspace_prefix[len(AWS_PREFIX) :]
@@ -87,6 +140,79 @@ def generate_access_billing_requests(
         )
 
 
+def generate_batched_access_billing_requests(
+    access_points: Iterable[dict[str, Any]],
+    intervals: Iterable[tuple[datetime, datetime]],
+    batch_workspaces: bool = True,
+    batch_intervals: bool = False,
+) -> Generator[GenerateBatchedAccessBillingEventRequestMsg]:
+    """
+    Generates batched access billing requests. These cover the same workspaces and time periods
+    as the requests produced by `generate_access_billing_requests` but with fewer, larger
+    requests.
+
+    If `batch_workspaces` is set there is one request per bucket covering every workspace object
+    store in that bucket, otherwise one per workspace. If `batch_intervals` is set then runs of
+    consecutive `intervals` (such as those from `generate_sample_times`) are covered by a single
+    request of up to MAX_BATCHED_INTERVALS intervals, otherwise there is one request per interval.
+    """
+    workspaces_by_bucket: dict[str, list[str]] = {}
+    for ap in access_points:
+        logging.info(f"Found access point: {ap=}")
+        workspaces_by_bucket.setdefault(ap["Bucket"], []).append(parse_workspace_prefix(ap["Name"]))
+
+    if batch_workspaces:
+        workspace_groups = [(bucket, tuple(workspaces)) for bucket, workspaces in workspaces_by_bucket.items()]
+    else:
+        workspace_groups = [
+            (bucket, (workspace,)) for bucket, workspaces in workspaces_by_bucket.items() for workspace in workspaces
+        ]
+
+    if batch_intervals:
+        ranges = list(group_consecutive_intervals(intervals, MAX_BATCHED_INTERVALS))
+    else:
+        ranges = [(start, end, None) for start, end in intervals]
+
+    for (range_start, range_end, interval), (bucket_name, workspaces) in itertools.product(ranges, workspace_groups):
+        yield GenerateBatchedAccessBillingEventRequestMsg(
+            workspaces=workspaces,
+            bucket_name=bucket_name,
+            interval_start=range_start,
+            interval_end=range_end,
+            interval=interval,
+        )
+
+
+def group_consecutive_intervals(
+    intervals: Iterable[tuple[datetime, datetime]], max_intervals: int
+) -> Generator[tuple[datetime, datetime, timedelta]]:
+    """
+    Groups runs of consecutive, equal-length intervals into (start, end, interval) ranges of
+    at most `max_intervals` intervals each.
+    """
+    range_start: datetime | None = None
+    range_end: datetime | None = None
+    range_interval: timedelta | None = None
+    count = 0
+
+    for start, end in intervals:
+        if range_start is None or start != range_end or end - start != range_interval or count >= max_intervals:
+            if range_start is not None:
+                assert range_end is not None
+                assert range_interval is not None
+                yield (range_start, range_end, range_interval)
+
+            range_start, range_interval, count = start, end - start, 0
+
+        range_end = end
+        count += 1
+
+    if range_start is not None:
+        assert range_end is not None
+        assert range_interval is not None
+        yield (range_start, range_end, range_interval)
+
+
 def generate_sample_times(last_end: datetime, interval: timedelta) -> Generator[tuple[datetime, datetime]]:
     """
     Generates intervals to sample based on either the end of the last sampled period or a
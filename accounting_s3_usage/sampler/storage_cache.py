@@ -0,0 +1,135 @@
+import logging
+import sqlite3
+from collections.abc import Callable
+from contextlib import closing
+from datetime import UTC, datetime, timedelta
+
+
+class StorageSizeCache:
+    """
+    A local (SQLite) record of the last sampled storage size of each workspace, so that
+    workspaces which can't have changed needn't be listed again.
+
+    Before each sampling cycle, `refresh_changes` finds the workspaces with objects written or
+    deleted since the logs were last checked, according to the access logs, and records when
+    each was last seen to change. The time checked up to is recorded too, so each check only
+    reads the logs since the last one, going back `log_delay` further to catch requests logged
+    late. A cached size is reused for a workspace which hasn't been seen to change since it was
+    sampled until it's older than `max_age`, after which the workspace is listed again
+    regardless.
+    """
+
+    def __init__(self, path: str, max_age: timedelta, log_delay: timedelta) -> None:
+        self.path = path
+        self.max_age = max_age
+        self.log_delay = log_delay
+
+        self._checked = False
+
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS sizes (
+                    bucket TEXT NOT NULL,
+                    workspace TEXT NOT NULL,
+                    size_gb REAL NOT NULL,
+                    sampled REAL NOT NULL,
+                    PRIMARY KEY (bucket, workspace)
+                )
+                """
+            )
+            # When each workspace was last seen to change, as the end of the check which found it.
+            conn.execute("CREATE TABLE IF NOT EXISTS changed (workspace TEXT PRIMARY KEY, changed REAL NOT NULL)")
+            # The period the changes have been checked for, without gaps: "checked_from" and
+            # "checked_until".
+            conn.execute("CREATE TABLE IF NOT EXISTS checks (name TEXT PRIMARY KEY, checked REAL NOT NULL)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    def oldest_sample(self) -> datetime | None:
+        with closing(self._connect()) as conn:
+            (sampled,) = conn.execute("SELECT MIN(sampled) FROM sizes").fetchone()
+
+        return datetime.fromtimestamp(sampled, UTC) if sampled is not None else None
+
+    def _checks(self, conn: sqlite3.Connection) -> dict[str, float]:
+        return dict(conn.execute("SELECT name, checked FROM checks"))
+
+    def refresh_changes(self, written_since: Callable[[datetime, datetime], set[str]], now: datetime) -> None:
+        """
+        Records the workspaces which have changed since the last check using `written_since`,
+        which gives the workspaces with objects written or deleted from one time until another.
+        The first check goes back to the oldest cached sample. If a check fails then no cached
+        sizes are reused until one next succeeds, which covers the failed check's period too.
+        """
+        self._checked = False
+
+        with closing(self._connect()) as conn:
+            checks = self._checks(conn)
+
+        if "checked_until" in checks:
+            since = datetime.fromtimestamp(checks["checked_until"], UTC) - self.log_delay
+            checked_from = checks["checked_from"]
+        else:
+            since = self.oldest_sample() or now
+            checked_from = since.timestamp()
+
+        try:
+            changed = written_since(since, now) if since < now else set()
+        except Exception:
+            logging.exception("Failed to find workspaces written since %s. Listing every workspace.", since)
+            return
+
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                """
+                INSERT INTO changed (workspace, changed) VALUES (?, ?)
+                ON CONFLICT (workspace) DO UPDATE SET changed = excluded.changed
+                """,
+                ((workspace, now.timestamp()) for workspace in changed),
+            )
+            # Sizes sampled before this are never reused, so neither are these.
+            conn.execute("DELETE FROM changed WHERE changed < ?", ((now - self.max_age).timestamp(),))
+            conn.executemany(
+                "INSERT OR REPLACE INTO checks (name, checked) VALUES (?, ?)",
+                [("checked_from", checked_from), ("checked_until", now.timestamp())],
+            )
+
+        self._checked = True
+        logging.info("%d workspaces have been written since %s", len(changed), since)
+
+    def get(self, bucket: str, workspace: str, now: datetime) -> float | None:
+        """The cached size of a workspace in GB, or None if it must be listed."""
+        if not self._checked:
+            return None
+
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT size_gb, sampled FROM sizes WHERE bucket = ? AND workspace = ?", (bucket, workspace)
+            ).fetchone()
+            changed = conn.execute("SELECT changed FROM changed WHERE workspace = ?", (workspace,)).fetchone()
+            checks = self._checks(conn)
+
+        if row is None:
+            return None
+
+        size_gb, sampled = row
+        if (
+            sampled < checks["checked_from"]
+            or (changed is not None and sampled < changed[0])
+            or now.timestamp() - sampled > self.max_age.total_seconds()
+        ):
+            return None
+
+        return size_gb
+
+    def put(self, bucket: str, workspace: str, size_gb: float, sampled: datetime) -> None:
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """
+                INSERT INTO sizes (bucket, workspace, size_gb, sampled) VALUES (?, ?, ?, ?)
+                ON CONFLICT (bucket, workspace) DO UPDATE SET size_gb = excluded.size_gb, sampled = excluded.sampled
+                """,
+                (bucket, workspace, size_gb, sampled.timestamp()),
+            )
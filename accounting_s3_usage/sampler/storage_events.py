@@ -0,0 +1,250 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from datetime import timedelta
+from typing import Any
+from urllib.parse import unquote_plus
+
+from botocore.client import BaseClient
+
+# Sequencers are hexadecimal strings of varying length which order events on the same key. They
+# are padded to this width so that they compare correctly as strings.
+SEQUENCER_WIDTH = 32
+
+
+def storage_event_records(body: str) -> Iterator[dict[str, Any]]:
+    """
+    The S3 event notification records in a queue message body, which is either a notification
+    sent straight to the queue or one wrapped by SNS. Test events have no records.
+    """
+    message = json.loads(body)
+    if "Records" not in message and "Message" in message:
+        message = json.loads(message["Message"])
+
+    yield from message.get("Records", [])
+
+
+class StorageEventTotals:
+    """
+    Running totals of the bytes stored by each workspace, kept up to date from S3
+    ObjectCreated and ObjectRemoved event notifications in a durable local (SQLite) store.
+
+    Removal events don't carry the object's size, so the size of every object is recorded too.
+    Each object's last event sequencer is recorded with it, so that redelivered and out of order
+    events are ignored. The totals drift if events are lost, so each workspace's total is
+    periodically reconciled with a full listing of its objects.
+
+    Reconciliation only corrects the total: objects which have had no events since the store was
+    created, such as those from before notifications were enabled, aren't recorded. Deleting one
+    leaves it counted, and overwriting one counts both sizes, until the workspace's next
+    reconciliation. The drift is limited to the sizes of those objects, for at most
+    `reconcile_interval`. Deleted objects are forgotten by the first reconciliation after they're
+    `reconcile_interval` old, as any event for them delayed beyond that is corrected anyway.
+    """
+
+    def __init__(self, path: str, reconcile_interval: timedelta = timedelta(days=1)) -> None:
+        self.path = path
+        self.reconcile_interval = reconcile_interval
+
+        self._lock = threading.Lock()
+        self._reconciler = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage-reconciler")
+        self._reconciling: set[tuple[str, str]] = set()
+
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS objects (
+                    bucket TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    size INTEGER,
+                    sequencer TEXT NOT NULL,
+                    updated REAL NOT NULL,
+                    PRIMARY KEY (bucket, key)
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS totals (
+                    bucket TEXT NOT NULL,
+                    workspace TEXT NOT NULL,
+                    bytes INTEGER NOT NULL,
+                    reconciled REAL,
+                    PRIMARY KEY (bucket, workspace)
+                )
+                """
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    def apply(self, records: Iterable[dict[str, Any]]) -> int:
+        """
+        Applies S3 event notification records to the totals in one transaction. Returns the
+        number of records which changed anything.
+        """
+        applied = 0
+        now = time.time()
+
+        with self._lock, closing(self._connect()) as conn, conn:
+            for record in records:
+                event_name = record.get("eventName", "")
+                if event_name.startswith("ObjectCreated:"):
+                    size = int(record["s3"]["object"].get("size", 0))
+                elif event_name.startswith("ObjectRemoved:"):
+                    # A delete marker hides the current version, so the object no longer counts.
+                    size = None
+                else:
+                    continue
+
+                bucket = record["s3"]["bucket"]["name"]
+                key = unquote_plus(record["s3"]["object"]["key"])
+                if "/" not in key:
+                    continue
+
+                sequencer = record["s3"]["object"]["sequencer"].rjust(SEQUENCER_WIDTH, "0")
+                previous = conn.execute(
+                    "SELECT size, sequencer FROM objects WHERE bucket = ? AND key = ?", (bucket, key)
+                ).fetchone()
+                if previous is not None and previous[1] >= sequencer:
+                    continue
+
+                delta = (size or 0) - ((previous[0] or 0) if previous is not None else 0)
+                conn.execute(
+                    """
+                    INSERT INTO objects (bucket, key, size, sequencer, updated) VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (bucket, key) DO UPDATE SET
+                        size = excluded.size, sequencer = excluded.sequencer, updated = excluded.updated
+                    """,
+                    (bucket, key, size, sequencer, now),
+                )
+                conn.execute(
+                    """
+                    INSERT INTO totals (bucket, workspace, bytes) VALUES (?, ?, ?)
+                    ON CONFLICT (bucket, workspace) DO UPDATE SET bytes = bytes + excluded.bytes
+                    """,
+                    (bucket, key.split("/", 1)[0], delta),
+                )
+                applied += 1
+
+        return applied
+
+    def consume(self, sqs: BaseClient, queue_url: str) -> int:
+        """
+        Applies every event notification waiting in an SQS queue, deleting each batch of messages
+        once it has been applied. Returns the number of records which changed anything.
+        """
+        applied = 0
+
+        while True:
+            messages = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10, WaitTimeSeconds=1).get(
+                "Messages", []
+            )
+            if not messages:
+                return applied
+
+            applied += self.apply(record for message in messages for record in storage_event_records(message["Body"]))
+            sqs.delete_message_batch(
+                QueueUrl=queue_url,
+                Entries=[
+                    {"Id": str(i), "ReceiptHandle": message["ReceiptHandle"]} for i, message in enumerate(messages)
+                ],
+            )
+
+    def workspace_sizes(self, bucket: str) -> dict[str, int]:
+        """The running total of bytes stored by each workspace in `bucket` with any events."""
+        with closing(self._connect()) as conn:
+            return dict(conn.execute("SELECT workspace, bytes FROM totals WHERE bucket = ?", (bucket,)))
+
+    def reconcile(self, bucket: str, workspace: str, listed_size: Callable[[str, str], int]) -> int:
+        """
+        Corrects a workspace's total with a full listing, made by `listed_size`, which gives the
+        bytes stored under a workspace's prefix. Returns the drift which was corrected.
+
+        The correction is relative to the total when the listing started, so events applied while
+        it runs are kept. Objects changed during the listing may still leave a small drift, which
+        the next reconciliation corrects. Deleted objects in the workspace which are older than
+        `reconcile_interval` are forgotten.
+        """
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT bytes FROM totals WHERE bucket = ? AND workspace = ?", (bucket, workspace)
+            ).fetchone()
+        total_before = row[0] if row is not None else 0
+
+        drift = listed_size(bucket, workspace) - total_before
+
+        now = time.time()
+        prefix = f"{workspace}/"
+        with self._lock, closing(self._connect()) as conn, conn:
+            conn.execute(
+                """
+                INSERT INTO totals (bucket, workspace, bytes, reconciled) VALUES (?, ?, ?, ?)
+                ON CONFLICT (bucket, workspace) DO UPDATE SET
+                    bytes = bytes + excluded.bytes, reconciled = excluded.reconciled
+                """,
+                (bucket, workspace, drift, now),
+            )
+            conn.execute(
+                """
+                DELETE FROM objects
+                WHERE bucket = ? AND substr(key, 1, ?) = ? AND size IS NULL AND updated < ?
+                """,
+                (bucket, len(prefix), prefix, now - self.reconcile_interval.total_seconds()),
+            )
+
+        if drift:
+            logging.warning("Storage total of %s in %s had drifted by %d bytes", workspace, bucket, drift)
+        return drift
+
+    def reconcile_due(
+        self, bucket: str, workspaces: Iterable[str], listed_size: Callable[[str, str], int]
+    ) -> set[str]:
+        """
+        Reconciles each of `workspaces` which hasn't been reconciled within `reconcile_interval`.
+
+        A workspace which has never been reconciled, such as in a new or lost store, is missing
+        every object from before its first event, so it's reconciled before this returns. The rest
+        are reconciled in the background. Returns those of `workspaces` which still haven't ever
+        been reconciled, because their reconciliation failed or is already running elsewhere, so
+        that their totals aren't sampled.
+        """
+        with closing(self._connect()) as conn:
+            reconciled = dict(conn.execute("SELECT workspace, reconciled FROM totals WHERE bucket = ?", (bucket,)))
+
+        due_before = time.time() - self.reconcile_interval.total_seconds()
+        unreconciled: set[str] = set()
+        for workspace in workspaces:
+            last_reconciled = reconciled.get(workspace)
+            if last_reconciled is not None and last_reconciled > due_before:
+                continue
+
+            with self._lock:
+                if (bucket, workspace) in self._reconciling:
+                    if last_reconciled is None:
+                        unreconciled.add(workspace)
+                    continue
+                self._reconciling.add((bucket, workspace))
+
+            if last_reconciled is None:
+                if not self._reconcile_logging_errors(bucket, workspace, listed_size):
+                    unreconciled.add(workspace)
+            else:
+                self._reconciler.submit(self._reconcile_logging_errors, bucket, workspace, listed_size)
+
+        return unreconciled
+
+    def _reconcile_logging_errors(self, bucket: str, workspace: str, listed_size: Callable[[str, str], int]) -> bool:
+        try:
+            self.reconcile(bucket, workspace, listed_size)
+            return True
+        except Exception:
+            logging.exception("Failed to reconcile storage total of %s in %s", workspace, bucket)
+            return False
+        finally:
+            self._reconciling.discard((bucket, workspace))
@@ -0,0 +1,119 @@
+import logging
+import threading
+from collections import defaultdict
+from typing import Any
+
+from opentelemetry import metrics, trace
+from opentelemetry.trace import Span
+
+tracer = trace.get_tracer("s3-usage-sampler")
+meter = metrics.get_meter("s3-usage-sampler")
+
+athena_queries = meter.create_counter(
+    "athena.queries", unit="{query}", description="Athena queries completed, by kind and final state."
+)
+athena_data_scanned = meter.create_counter(
+    "athena.data_scanned", unit="By", description="Bytes scanned (and so billed) by Athena queries."
+)
+
+# Histograms of the per-query statistics Athena reports once a query finishes, keyed by the
+# name of the statistic in the QueryExecution response.
+athena_query_statistics = {
+    "DataScannedInBytes": meter.create_histogram(
+        "athena.query.data_scanned", unit="By", description="Bytes scanned by each Athena query."
+    ),
+    "EngineExecutionTimeInMillis": meter.create_histogram(
+        "athena.query.engine_execution_time", unit="ms", description="Time each Athena query spent executing."
+    ),
+    "QueryQueueTimeInMillis": meter.create_histogram(
+        "athena.query.queue_time", unit="ms", description="Time each Athena query spent queued for resources."
+    ),
+    "TotalExecutionTimeInMillis": meter.create_histogram(
+        "athena.query.total_execution_time", unit="ms", description="Total time taken by each Athena query."
+    ),
+}
+
+
+class ScanBudgetExceededError(Exception):
+    pass
+
+
+class AthenaCostTracker:
+    """
+    Running totals of what Athena queries have cost during the current billing cycle, so that it
+    can be summarized at the end of the cycle.
+
+    If `scan_budget_bytes` is set, no more queries should be started once the queries in this
+    cycle have scanned more than that. This stops a runaway back-fill from scanning the logs over
+    and over.
+    """
+
+    def __init__(self, scan_budget_bytes: int | None = None) -> None:
+        self.scan_budget_bytes = scan_budget_bytes
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.queries: defaultdict[str, int] = defaultdict(int)
+            self.data_scanned_bytes: defaultdict[str, int] = defaultdict(int)
+            self.engine_execution_ms: defaultdict[str, int] = defaultdict(int)
+
+    def record(self, kind: str, statistics: dict[str, Any]) -> None:
+        with self._lock:
+            self.queries[kind] += 1
+            self.data_scanned_bytes[kind] += statistics.get("DataScannedInBytes", 0)
+            self.engine_execution_ms[kind] += statistics.get("EngineExecutionTimeInMillis", 0)
+
+    def total_data_scanned_bytes(self) -> int:
+        with self._lock:
+            return sum(self.data_scanned_bytes.values())
+
+    def over_budget(self) -> bool:
+        return self.scan_budget_bytes is not None and self.total_data_scanned_bytes() > self.scan_budget_bytes
+
+    def log_summary(self) -> None:
+        with self._lock:
+            for kind in sorted(self.queries):
+                logging.info(
+                    "Athena %s queries this cycle: %d queries, %.3f GB scanned, %.1f s engine time",
+                    kind,
+                    self.queries[kind],
+                    self.data_scanned_bytes[kind] / 1024**3,
+                    self.engine_execution_ms[kind] / 1000,
+                )
+
+
+# Shared by everything which runs Athena queries. The budget is set from the command line.
+athena_costs = AthenaCostTracker()
+
+
+def query_attributes(kind: str, workspace: str | None = None) -> dict[str, str]:
+    """The attributes Athena query metrics and spans are tagged with."""
+    attributes = {"athena.query.kind": kind}
+    if workspace is not None:
+        attributes["workspace"] = workspace
+
+    return attributes
+
+
+def record_athena_query(span: Span, query_execution: dict[str, Any], attributes: dict[str, str]) -> None:
+    """
+    Exports the final state and statistics of an Athena query execution as metrics tagged with
+    `attributes`, adds them to `span` and counts them towards the current cycle's costs.
+    """
+    state = query_execution["Status"]["State"]
+    statistics = query_execution.get("Statistics", {})
+
+    athena_queries.add(1, {**attributes, "state": state})
+    athena_data_scanned.add(statistics.get("DataScannedInBytes", 0), attributes)
+    for name, histogram in athena_query_statistics.items():
+        if name in statistics:
+            histogram.record(statistics[name], attributes)
+
+    span.set_attribute("athena.state", state)
+    for name, value in statistics.items():
+        if isinstance(value, int | float | str | bool):
+            span.set_attribute(f"athena.statistics.{name}", value)
+
+    athena_costs.record(attributes.get("athena.query.kind", "other"), statistics)
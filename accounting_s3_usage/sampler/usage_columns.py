@@ -0,0 +1,98 @@
+from array import array
+from collections.abc import Callable, Hashable, Iterable, Sequence
+
+
+class UsageColumns:
+    """
+    Access usage rows of the form (remoteip, total_gb_transferred, object_api_calls,
+    listing_api_calls), held column-wise in arrays rather than as a tuple per row.
+
+    Each row belongs to a group, such as a workspace and interval. Groups and remote IPs are
+    dictionary-encoded as small integers, so that each distinct remote IP need only be classified
+    once however many groups it appears in. That, and the compact storage, is the saving: the
+    totals are still summed by a loop over the rows in Python, not a vectorized group-by, as NumPy
+    isn't a dependency.
+    """
+
+    def __init__(self) -> None:
+        self.groups: list[Hashable] = []
+        self._group_codes: dict[Hashable, int] = {}
+        self.ips: list[str] = []
+        self._ip_codes: dict[str, int] = {}
+
+        self.group = array("l")
+        self.ip = array("l")
+        self.gb = array("d")
+        self.object_calls = array("q")
+        self.listing_calls = array("q")
+
+    def add_group(self, group: Hashable) -> int:
+        """Returns the code for `group`, adding it if it's new. Groups may have no rows."""
+        code = self._group_codes.get(group)
+        if code is None:
+            code = self._group_codes[group] = len(self.groups)
+            self.groups.append(group)
+
+        return code
+
+    def add_ip(self, remoteip: str) -> int:
+        code = self._ip_codes.get(remoteip)
+        if code is None:
+            code = self._ip_codes[remoteip] = len(self.ips)
+            self.ips.append(remoteip)
+
+        return code
+
+    def append(self, group: Hashable, row: Sequence[str | float | int | None]) -> None:
+        """Adds a usage row to `group`. Null remote IPs are treated as '-' and null data transfer as 0."""
+        remoteip, transferred, object_api_calls, listing_api_calls = row
+        assert object_api_calls is not None
+        assert listing_api_calls is not None
+
+        self.group.append(self.add_group(group))
+        self.ip.append(self.add_ip(str(remoteip) if remoteip is not None else "-"))
+        self.gb.append(float(transferred) if transferred is not None else 0.0)
+        self.object_calls.append(int(object_api_calls))
+        self.listing_calls.append(int(listing_api_calls))
+
+    def extend(self, group: Hashable, rows: Iterable[Sequence[str | float | int | None]]) -> None:
+        for row in rows:
+            self.append(group, row)
+
+    def sku_totals(
+        self, transfer_skus: Callable[[Sequence[str]], Sequence[str | None]], api_calls_sku: str
+    ) -> list[dict[str, float]]:
+        """
+        The quantity of each SKU used by each group, indexed by group code.
+
+        `transfer_skus` gives the data transfer SKU for each of a list of remote IPs, or None
+        where transfer to an IP isn't charged. It is called once, with every distinct remote IP
+        to which data was transferred. Data transfer is only counted from rows with object API
+        calls. Every group has a total for `api_calls_sku`, which is the sum of all API calls.
+        """
+        totals: list[dict[str, float]] = [{} for _ in self.groups]
+        api_calls = array("q", bytes(8 * len(self.groups)))
+        transferred_to = bytearray(len(self.ips))
+
+        for group, ip, object_calls, listing_calls in zip(
+            self.group, self.ip, self.object_calls, self.listing_calls, strict=True
+        ):
+            api_calls[group] += object_calls + listing_calls
+            if object_calls:
+                transferred_to[ip] = 1
+
+        ip_codes = [ip for ip, transferred in enumerate(transferred_to) if transferred]
+        ip_skus: list[str | None] = [None] * len(self.ips)
+        for ip, sku in zip(ip_codes, transfer_skus([self.ips[ip] for ip in ip_codes]), strict=True):
+            ip_skus[ip] = sku
+
+        for group, ip, gb, object_calls in zip(self.group, self.ip, self.gb, self.object_calls, strict=True):
+            sku = ip_skus[ip]
+            if object_calls and sku is not None:
+                group_totals = totals[group]
+                group_totals[sku] = group_totals.get(sku, 0.0) + gb
+
+        for group, group_totals in enumerate(totals):
+            group_totals[api_calls_sku] = api_calls[group]
+
+        return totals
@@ -0,0 +1,191 @@
+"""
+Benchmarks the stages of access billing over a synthetic access log file: parsing, workspace
+attribution, egress classification and billing event generation. For example:
+
+    python -m benchmarks.bench_access_logs --requests 1000000 --output bench_access_logs.jsonl
+
+Each stage runs in a fresh process so that its peak RSS can be measured independently. Results
+are written as one JSON object per stage per line, with the elapsed time and the peak RSS of the
+process. Stages which read log lines report the lines and bytes processed and their throughput
+in lines/s and bytes/s. Stages after aggregation work on usage rows, of which there are far fewer
+than log lines, so report the rows processed and their throughput in rows/s instead.
+
+Stages after parsing are timed from already-parsed input, so each measures only its own work,
+but their peak RSS includes holding that input in memory.
+"""
+
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from collections.abc import Callable
+from datetime import UTC, datetime, timedelta
+from typing import Any
+
+import click
+
+from accounting_s3_usage.sampler.access_logs import (
+    aggregate_access_log_records,
+    map_access_log_file,
+    parse_access_log_lines,
+    usage_rows,
+)
+from benchmarks.synthetic_logs import write_synthetic_logs
+
+START_TIME = datetime(2025, 1, 1, tzinfo=UTC)
+PERIOD = timedelta(days=1)
+INTERVAL = timedelta(hours=1)
+
+
+def count_lines(path: str) -> int:
+    with open(path, "rb") as f:
+        return sum(1 for _ in f)
+
+
+def bench_parse_lines(path: str, workspaces: list[str]) -> tuple[float, int]:
+    start = time.perf_counter()
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for _ in parse_access_log_lines(f):
+            pass
+
+    return time.perf_counter() - start, count_lines(path)
+
+
+def bench_parse_mmap(path: str, workspaces: list[str]) -> tuple[float, int]:
+    start = time.perf_counter()
+    for _ in map_access_log_file(path):
+        pass
+
+    return time.perf_counter() - start, count_lines(path)
+
+
+def bench_attribution(path: str, workspaces: list[str]) -> tuple[float, int]:
+    records = list(map_access_log_file(path))
+
+    start = time.perf_counter()
+    aggregate_access_log_records(records, workspaces, START_TIME, START_TIME + PERIOD, INTERVAL)
+    return time.perf_counter() - start, count_lines(path)
+
+
+def bench_classification(path: str, workspaces: list[str]) -> tuple[float, int]:
+    # These need eodhp_utils, so are only imported by the stages which use them.
+    from accounting_s3_usage.sampler.messager import S3AccessBillingEventMessager  # noqa: PLC0415
+    from accounting_s3_usage.sampler.usage_columns import UsageColumns  # noqa: PLC0415
+
+    rows = list(
+        usage_rows(aggregate_access_log_records(map_access_log_file(path), workspaces, START_TIME, None, INTERVAL))
+    )
+    messager = S3AccessBillingEventMessager()
+
+    start = time.perf_counter()
+    usage = UsageColumns()
+    for workspace, interval_index, *usage_by_destination in rows:
+        usage.append((workspace, interval_index), usage_by_destination)
+    usage.sku_totals(messager.transfer_skus, "AWS-S3-API-CALLS")
+    return time.perf_counter() - start, len(rows)
+
+
+def bench_billing_events(path: str, workspaces: list[str]) -> tuple[float, int]:
+    from accounting_s3_usage.sampler.messager import S3AccessBillingEventMessager  # noqa: PLC0415
+    from accounting_s3_usage.sampler.sample_requests import (  # noqa: PLC0415
+        GenerateBatchedAccessBillingEventRequestMsg,
+    )
+
+    rows = list(
+        usage_rows(aggregate_access_log_records(map_access_log_file(path), workspaces, START_TIME, None, INTERVAL))
+    )
+    messager = S3AccessBillingEventMessager()
+    batch = GenerateBatchedAccessBillingEventRequestMsg(
+        workspaces=tuple(workspaces),
+        bucket_name="workspaces-eodhp-bench",
+        interval_start=START_TIME,
+        interval_end=START_TIME + PERIOD,
+        interval=INTERVAL,
+    )
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in messager.generate_batched_billing_events(batch, rows):
+            pass
+    return time.perf_counter() - start, len(rows)
+
+
+# Each stage returns its elapsed time and the number of lines or rows it processed.
+STAGES: dict[str, Callable[[str, list[str]], tuple[float, int]]] = {
+    "parse_lines": bench_parse_lines,
+    "parse_mmap": bench_parse_mmap,
+    "attribution": bench_attribution,
+    "classification": bench_classification,
+    "billing_events": bench_billing_events,
+}
+
+# Stages which process usage rows after aggregation, rather than log lines.
+ROW_STAGES = {"classification", "billing_events"}
+
+
+def run_stage(stage: str, path: str, workspaces: list[str]) -> tuple[float, int, int]:
+    """
+    Runs a stage, returning its elapsed time, the number of lines or rows it processed and the
+    peak RSS of this process in bytes.
+    """
+    seconds, count = STAGES[stage](path, workspaces)
+
+    # ru_maxrss is in kilobytes on Linux but bytes on macOS.
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return seconds, count, peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+def bench_stage(stage: str, path: str, workspaces: list[str]) -> dict[str, Any]:
+    with multiprocessing.get_context("spawn").Pool(1, maxtasksperchild=1) as pool:
+        seconds, count, peak_rss = pool.apply(run_stage, (stage, path, workspaces))
+
+    result: dict[str, Any] = {"stage": stage, "seconds": round(seconds, 6)}
+    if stage in ROW_STAGES:
+        result.update({"rows": count, "rows_per_s": round(count / seconds, 1)})
+    else:
+        size = os.path.getsize(path)
+        result.update(
+            {
+                "lines": count,
+                "bytes": size,
+                "lines_per_s": round(count / seconds, 1),
+                "bytes_per_s": round(size / seconds, 1),
+            }
+        )
+
+    result["peak_rss_bytes"] = peak_rss
+    return result
+
+
+@click.command()
+@click.option("--requests", type=int, default=1_000_000, show_default=True, help="Number of log lines.")
+@click.option("--workspaces", type=int, default=50, show_default=True, help="Number of workspaces.")
+@click.option("--ips", type=int, default=1000, show_default=True, help="Number of distinct remote IPs.")
+@click.option("--seed", type=int, default=0, show_default=True)
+@click.option(
+    "--stage",
+    "stages",
+    type=click.Choice(list(STAGES)),
+    multiple=True,
+    help="Stage to benchmark. May be repeated. Defaults to every stage.",
+)
+@click.option("--output", type=click.File("w"), default="-", help="File to write JSON lines results to.")
+def cli(requests: int, workspaces: int, ips: int, seed: int, stages: tuple[str, ...], output: io.TextIOBase) -> None:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "access.log")
+        workspace_names = list(write_synthetic_logs(path, requests, workspaces, ips, START_TIME, PERIOD, seed))
+
+        for stage in stages or STAGES:
+            result = bench_stage(stage, path, workspace_names)
+            result.update({"workspaces": workspaces, "ips": ips})
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+
+
+if __name__ == "__main__":
+    cli()
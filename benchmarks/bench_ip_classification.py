@@ -0,0 +1,161 @@
+"""
+Benchmarks classifying the remote IPs of access billing usage rows for data transfer. For
+example:
+
+    python -m benchmarks.bench_ip_classification --rows 1000000 --ip-ranges ip-ranges.json
+
+Without --ip-ranges, a synthetic set of AWS-like prefixes is used. Rows' remote IPs are drawn
+from a pool of distinct IPs with a few recurring often, as in real usage. Results are written as
+one JSON object per classifier per line, with the rows classified, the elapsed time and the
+throughput in rows/s.
+
+The "scan" classifier, which checks every network in turn, is only run on the first --scan-rows
+rows as it's so slow. The "range_index_mmap" classifiers use the index saved to a file and
+memory-mapped back, as when it's cached.
+"""
+
+import ipaddress
+import json
+import os
+import random
+import tempfile
+import time
+from collections.abc import Callable
+from functools import lru_cache
+from typing import Any, TextIO
+
+import click
+
+from accounting_s3_usage.sampler.ip_classifier import IPNetwork, IPRangeIndex, ip_range_networks, load_ip_ranges
+
+REGION = "eu-west-2"
+REGIONS = [REGION, "eu-west-1", "us-east-1", "us-west-2", "ap-southeast-1", "GLOBAL"]
+
+
+def synthetic_ip_ranges(prefixes: int, rng: random.Random) -> dict[str, Any]:
+    """AWS-like ip-ranges.json content, with about 80% IPv4 prefixes, some of them nested."""
+    ipv4_prefixes = []
+    ipv6_prefixes = []
+
+    for _ in range(prefixes):
+        region = rng.choice(REGIONS)
+        if rng.random() < 0.8:
+            length = rng.randint(12, 28)
+            network = ipaddress.IPv4Network((rng.getrandbits(32) >> (32 - length) << (32 - length), length))
+            ipv4_prefixes.append({"ip_prefix": str(network), "region": region, "service": "AMAZON"})
+        else:
+            length = rng.randint(32, 64)
+            network = ipaddress.IPv6Network((rng.getrandbits(128) >> (128 - length) << (128 - length), length))
+            ipv6_prefixes.append({"ipv6_prefix": str(network), "region": region, "service": "AMAZON"})
+
+    return {"prefixes": ipv4_prefixes, "ipv6_prefixes": ipv6_prefixes}
+
+
+def synthetic_remote_ips(
+    networks: list[tuple[IPNetwork, str]], distinct_ips: int, rows: int, rng: random.Random
+) -> list[str]:
+    """Rows' remote IPs, half of the distinct IPs inside AWS networks and half anywhere."""
+    pool = []
+    for i in range(distinct_ips):
+        if i % 2 == 0:
+            network, _ = rng.choice(networks)
+            pool.append(str(network.network_address + rng.randrange(network.num_addresses)))
+        else:
+            pool.append(str(ipaddress.IPv4Address(rng.getrandbits(32))))
+
+    # Zipf-like weights, so a few IPs make most requests.
+    return rng.choices(pool, [1 / (i + 1) for i in range(len(pool))], k=rows)
+
+
+def bench(name: str, classify: Callable[[str], str], ips: list[str]) -> dict[str, Any]:
+    start = time.perf_counter()
+    for ip in ips:
+        classify(ip)
+    seconds = time.perf_counter() - start
+
+    return {
+        "classifier": name,
+        "rows": len(ips),
+        "seconds": round(seconds, 6),
+        "rows_per_s": round(len(ips) / seconds, 1),
+    }
+
+
+def bench_batch(name: str, classify_many: Callable[[list[str]], list[str]], ips: list[str]) -> dict[str, Any]:
+    start = time.perf_counter()
+    classify_many(ips)
+    seconds = time.perf_counter() - start
+
+    return {
+        "classifier": name,
+        "rows": len(ips),
+        "seconds": round(seconds, 6),
+        "rows_per_s": round(len(ips) / seconds, 1),
+    }
+
+
+@click.command()
+@click.option("--rows", type=int, default=1_000_000, show_default=True, help="Number of usage rows.")
+@click.option("--distinct-ips", type=int, default=50_000, show_default=True, help="Number of distinct remote IPs.")
+@click.option("--prefixes", type=int, default=10_000, show_default=True, help="Number of synthetic AWS prefixes.")
+@click.option("--ip-ranges", default=None, help="URL or path of a real ip-ranges.json to use instead.")
+@click.option("--scan-rows", type=int, default=10_000, show_default=True)
+@click.option("--cache-size", type=int, default=65536, show_default=True)
+@click.option("--seed", type=int, default=0, show_default=True)
+@click.option("--output", type=click.File("w"), default="-", help="File to write JSON lines results to.")
+def cli(
+    rows: int,
+    distinct_ips: int,
+    prefixes: int,
+    ip_ranges: str | None,
+    scan_rows: int,
+    cache_size: int,
+    seed: int,
+    output: TextIO,
+) -> None:
+    rng = random.Random(seed)
+    ranges = load_ip_ranges(ip_ranges) if ip_ranges else synthetic_ip_ranges(prefixes, rng)
+    networks = ip_range_networks(ranges, REGION, "REGION", "INTERREGION")
+    ips = synthetic_remote_ips(networks, distinct_ips, rows, rng)
+
+    def scan(ip: str) -> str:
+        address = ipaddress.ip_address(ip)
+        matches = {network_class for network, network_class in networks if address in network}
+        return "REGION" if "REGION" in matches else "INTERREGION" if matches else "INTERNET"
+
+    build_start = time.perf_counter()
+    index = IPRangeIndex(networks, priority=["REGION", "INTERREGION"], default="INTERNET")
+    build_seconds = time.perf_counter() - build_start
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        index_path = os.path.join(tmpdir, "index.bin")
+        index.save(index_path, {})
+
+        load_start = time.perf_counter()
+        mapped_index, _ = IPRangeIndex.load(index_path)
+        load_seconds = time.perf_counter() - load_start
+
+        results = [
+            bench("scan", scan, ips[:scan_rows]),
+            bench("range_index", index.classify, ips),
+            bench("range_index_lru", lru_cache(maxsize=cache_size)(index.classify), ips),
+            bench_batch("range_index_batch", index.classify_many, ips),
+            bench("range_index_mmap_lru", lru_cache(maxsize=cache_size)(mapped_index.classify), ips),
+            bench_batch("range_index_mmap_batch", mapped_index.classify_many, ips),
+        ]
+
+    for result in results:
+        result.update(
+            {
+                "networks": len(networks),
+                "index_ranges": len(index),
+                "index_build_seconds": round(build_seconds, 6),
+                "index_load_seconds": round(load_seconds, 6),
+                "distinct_ips": distinct_ips,
+            }
+        )
+        output.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,114 @@
+"""
+Generates realistic synthetic S3 server access logs, in the format matched by the Athena table's
+`input.regex`, for benchmarking. For example:
+
+    python -m benchmarks.synthetic_logs --requests 100000 --output access.log
+"""
+
+import calendar
+import random
+from collections.abc import Iterator, Sequence
+from datetime import UTC, datetime, timedelta
+
+import click
+from faker import Faker
+
+BUCKET = "workspaces-eodhp-bench"
+BUCKET_OWNER = "79a59df900b949e55d96a1e698fbacedfd6e09d98eacf8f8d5218e7cd47ef2be"
+
+# Operations with their relative frequency in our logs.
+OPERATIONS = {
+    "REST.GET.OBJECT": 60,
+    "REST.HEAD.OBJECT": 15,
+    "REST.PUT.OBJECT": 10,
+    "REST.GET.BUCKET": 15,
+}
+
+
+def format_request_time(dt: datetime) -> str:
+    return f"{dt.day:02}/{calendar.month_abbr[dt.month]}/{dt.year}:{dt.hour:02}:{dt.minute:02}:{dt.second:02} +0000"
+
+
+class SyntheticAccessLogs:
+    """
+    Generates access log lines for `workspaces` workspaces, with requests from a pool of `ips`
+    remote IPs. A few IPs and workspaces account for most requests, as in real logs.
+    """
+
+    def __init__(self, workspaces: int, ips: int, seed: int = 0) -> None:
+        self.fake = Faker()
+        self.fake.seed_instance(seed)
+        self.random = random.Random(seed)
+
+        self.workspaces = [f"{self.fake.user_name().replace('_', '-')}-{i}" for i in range(workspaces)]
+        self.ips = ["-"] + [self.fake.ipv4_public() for _ in range(ips - 1)]
+        self.user_agents = [self.fake.user_agent() for _ in range(20)]
+        self.keys = {
+            workspace: [f"{workspace}/{self.fake.file_path(depth=3)[1:]}" for _ in range(20)]
+            for workspace in self.workspaces
+        }
+
+        # Zipf-like weights.
+        self.workspace_weights = [1 / (i + 1) for i in range(len(self.workspaces))]
+        self.ip_weights = [1 / (i + 1) for i in range(len(self.ips))]
+
+    def line(self, request_time: datetime) -> str:
+        workspace = self.random.choices(self.workspaces, self.workspace_weights)[0]
+        remoteip = self.random.choices(self.ips, self.ip_weights)[0]
+        operation = self.random.choices(list(OPERATIONS), list(OPERATIONS.values()))[0]
+
+        if operation == "REST.GET.BUCKET":
+            key = "-"
+            prefix = self.random.choice([f"{workspace}%2F", f"{workspace}/", workspace])
+            request_uri = f"GET /?list-type=2&prefix={prefix}&delimiter=%2F HTTP/1.1"
+            bytessent = str(self.random.randint(500, 50_000))
+            objectsize = "-"
+        else:
+            key = self.random.choice(self.keys[workspace])
+            method = {"REST.GET.OBJECT": "GET", "REST.HEAD.OBJECT": "HEAD", "REST.PUT.OBJECT": "PUT"}[operation]
+            request_uri = f"{method} /{key} HTTP/1.1"
+            size = self.random.randint(1_000, 500_000_000)
+            bytessent = str(size) if method == "GET" else "-"
+            objectsize = str(size)
+
+        return (
+            f"{BUCKET_OWNER} {BUCKET} [{format_request_time(request_time)}] {remoteip} "
+            f"arn:aws:sts::012345678901:assumed-role/{workspace}/{self.fake.user_name()} "
+            f'{self.fake.hexify("^" * 16, upper=True)} {operation} {key} "{request_uri}" 200 - '
+            f"{bytessent} {objectsize} {self.random.randint(1, 5000)} {self.random.randint(1, 100)} "
+            f'"-" "{self.random.choice(self.user_agents)}" - '
+            f"{self.fake.pystr(min_chars=76, max_chars=76)}= SigV4 ECDHE-RSA-AES128-GCM-SHA256 AuthHeader "
+            f"{BUCKET}.s3.eu-west-2.amazonaws.com TLSv1.2 "
+            f"arn:aws:s3:eu-west-2:012345678901:accesspoint/eodhp-bench-{workspace}\n"
+        )
+
+    def lines(self, requests: int, start_time: datetime, period: timedelta) -> Iterator[str]:
+        """`requests` log lines in time order, spread evenly over `period` from `start_time`."""
+        step = period / requests
+        for i in range(requests):
+            yield self.line(start_time + step * i)
+
+
+def write_synthetic_logs(
+    path: str, requests: int, workspaces: int, ips: int, start_time: datetime, period: timedelta, seed: int = 0
+) -> Sequence[str]:
+    """Writes a synthetic log file and returns the workspaces it covers."""
+    logs = SyntheticAccessLogs(workspaces, ips, seed)
+    with open(path, "w") as f:
+        f.writelines(logs.lines(requests, start_time, period))
+
+    return logs.workspaces
+
+
+@click.command()
+@click.option("--requests", type=int, default=100_000, show_default=True, help="Number of log lines.")
+@click.option("--workspaces", type=int, default=50, show_default=True, help="Number of workspaces.")
+@click.option("--ips", type=int, default=1000, show_default=True, help="Number of distinct remote IPs.")
+@click.option("--seed", type=int, default=0, show_default=True)
+@click.option("--output", type=click.Path(dir_okay=False), required=True)
+def cli(requests: int, workspaces: int, ips: int, seed: int, output: str) -> None:
+    write_synthetic_logs(output, requests, workspaces, ips, datetime(2025, 1, 1, tzinfo=UTC), timedelta(days=1), seed)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,226 @@
+from datetime import UTC, datetime, timedelta
+from pathlib import Path
+from unittest import mock
+
+import boto3
+import moto
+
+from accounting_s3_usage.sampler import metrics
+from accounting_s3_usage.sampler.access_logs import (
+    AccessLogManifest,
+    RequestTimeParser,
+    access_log_pattern,
+    aggregate_access_log_objects,
+    aggregate_access_logs,
+    map_access_log_file,
+    merge_totals,
+    parse_access_log_lines,
+    usage_rows,
+    written_workspaces,
+)
+
+
+def log_line(time: str, remoteip: str, operation: str, key: str, request_uri: str, bytessent: str) -> str:
+    return (
+        f"79a59df900b949e55d96a1e698fbacedfd6e09d98eacf8f8d5218e7cd47ef2be workspaces-eodhp-dev [{time}] "
+        f"{remoteip} arn:aws:iam::012345678901:user/test 3E57427F3EXAMPLE {operation} {key} "
+        f'"{request_uri}" 200 - {bytessent} 1000 70 10 "-" "aws-cli/2.0" - '
+        "s9lzHYrFp76ZVxRcpX9+5cjAnEH2ROuNkd2BHfIa6UkFVdtjf5mKR3/eTPFvsiP/XV/VLi31234= SigV4 "
+        "ECDHE-RSA-AES128-GCM-SHA256 AuthHeader workspaces-eodhp-dev.s3.eu-west-2.amazonaws.com TLSV1.2 "
+        "arn:aws:s3:eu-west-2:012345678901:accesspoint/eodhp-dev-ws\n"
+    )
+
+
+LOG_LINES = [
+    log_line(
+        "01/Jan/2025:10:00:00 +0000", "1.2.3.4", "REST.GET.OBJECT", "ws1/a.txt", "GET /ws1/a.txt HTTP/1.1", "100"
+    ),
+    log_line("01/Jan/2025:10:30:00 +0000", "1.2.3.4", "REST.GET.OBJECT", "ws1/b.txt", "GET /ws1/b.txt HTTP/1.1", "50"),
+    log_line("01/Jan/2025:11:00:00 +0000", "5.6.7.8", "REST.PUT.OBJECT", "ws1/c.txt", "PUT /ws1/c.txt HTTP/1.1", "-"),
+    log_line(
+        "01/Jan/2025:11:15:00 +0000", "1.2.3.4", "REST.GET.BUCKET", "-", "GET /?prefix=ws1%2Fdir HTTP/1.1", "900"
+    ),
+    log_line("01/Jan/2025:11:20:00 +0000", "1.2.3.4", "REST.GET.BUCKET", "-", "GET /?prefix=ws2/ HTTP/1.1", "900"),
+    log_line("01/Jan/2025:12:00:00 +0000", "1.2.3.4", "REST.GET.OBJECT", "ws1/a.txt", "GET /ws1/a.txt HTTP/1.1", "7"),
+    log_line("01/Jan/2025:10:00:00 +0000", "1.2.3.4", "REST.GET.OBJECT", "ws3/a.txt", "GET /ws3/a.txt HTTP/1.1", "8"),
+    "not a log line\n",
+]
+
+
+def test_access_log_pattern_splits_lines_into_table_columns() -> None:
+    match = access_log_pattern.match(LOG_LINES[0].rstrip("\n"))
+
+    assert match is not None
+    assert match.group(3) == "01/Jan/2025:10:00:00 +0000"
+    assert match.group(4) == "1.2.3.4"
+    assert match.group(8) == "ws1/a.txt"
+    assert match.group(9) == '"GET /ws1/a.txt HTTP/1.1"'
+    assert match.group(12) == "100"
+    assert match.group(25) == "arn:aws:s3:eu-west-2:012345678901:accesspoint/eodhp-dev-ws"
+
+
+def test_request_times_are_parsed_as_utc() -> None:
+    parse = RequestTimeParser().parse
+
+    assert parse("01/Jan/2025:10:00:00 +0000") == datetime(2025, 1, 1, 10, tzinfo=UTC).timestamp()
+    assert parse("29/Feb/2024:23:59:59 +0000") == datetime(2024, 2, 29, 23, 59, 59, tzinfo=UTC).timestamp()
+    assert parse("01/Jan/2025:10:00:00 +0100") == datetime(2025, 1, 1, 9, tzinfo=UTC).timestamp()
+
+
+def test_log_entries_are_aggregated_by_workspace_interval_and_remote_ip() -> None:
+    totals = aggregate_access_logs(
+        LOG_LINES,
+        ["ws1", "ws2"],
+        datetime(2025, 1, 1, 10, tzinfo=UTC),
+        datetime(2025, 1, 1, 12, tzinfo=UTC),
+        timedelta(hours=1),
+    )
+
+    assert totals == {
+        ("ws1", 0, "1.2.3.4"): [150, 2, 0],
+        ("ws1", 1, "5.6.7.8"): [0, 1, 0],
+        ("ws1", 1, "1.2.3.4"): [0, 0, 1],
+        ("ws2", 1, "1.2.3.4"): [0, 0, 1],
+    }
+
+
+@moto.mock_aws
+def test_local_backend_reads_logs_from_partitions() -> None:
+    s3 = boto3.client("s3")
+    s3.create_bucket(Bucket="access-logs", CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+    s3.put_object(Bucket="access-logs", Key="logs/2025/01/01/log1", Body="".join(LOG_LINES[:3]).encode())
+    s3.put_object(Bucket="access-logs", Key="logs/2025/01/01/log2", Body="".join(LOG_LINES[3:]).encode())
+    s3.put_object(Bucket="access-logs", Key="logs/2025/01/02/log1", Body=LOG_LINES[0].encode())
+
+    with (
+        mock.patch.object(metrics, "ACCESS_LOG_BACKEND", "local"),
+        mock.patch.object(metrics, "LOGS_PREFIX", "s3://access-logs/logs/"),
+        mock.patch.object(metrics, "LOGS_PARTITION_DATE_SOURCE", "EventTime"),
+    ):
+        start_time = datetime(2025, 1, 1, 0, tzinfo=UTC)
+        end_time = datetime(2025, 1, 2, 0, tzinfo=UTC)
+
+        usage = sorted(metrics.get_access_point_usage("ws1", start_time, end_time))
+        assert usage == [
+            ("1.2.3.4", 157 / 1073741824.0, 3, 1),
+            ("5.6.7.8", 0.0, 1, 0),
+        ]
+
+        assert sorted(metrics.get_workspaces_usage(["ws1", "ws2"], start_time, end_time)) == [
+            ("ws1", 0, "1.2.3.4", 157 / 1073741824.0, 3, 1),
+            ("ws1", 0, "5.6.7.8", 0.0, 1, 0),
+            ("ws2", 0, "1.2.3.4", 0.0, 0, 1),
+        ]
+
+
+@moto.mock_aws
+def test_manifest_only_ingests_new_log_objects(tmp_path: Path) -> None:
+    s3 = boto3.client("s3")
+    s3.create_bucket(Bucket="access-logs", CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+    s3.put_object(Bucket="access-logs", Key="logs/2025/01/01/log1", Body="".join(LOG_LINES[:3]).encode())
+
+    manifest = AccessLogManifest(str(tmp_path / "manifest.sqlite3"))
+    start_time = datetime(2025, 1, 1, 10, tzinfo=UTC)
+    end_time = datetime(2025, 1, 1, 12, tzinfo=UTC)
+
+    assert manifest.ingest(s3, "access-logs", ["logs/2025/01/01/"]) == 1
+    assert manifest.ingest(s3, "access-logs", ["logs/2025/01/01/"]) == 0
+
+    s3.put_object(Bucket="access-logs", Key="logs/2025/01/01/log2", Body="".join(LOG_LINES[3:]).encode())
+    assert manifest.ingest(s3, "access-logs", ["logs/2025/01/01/"]) == 1
+
+    # A new manifest on the same file sees what was already processed.
+    manifest = AccessLogManifest(str(tmp_path / "manifest.sqlite3"))
+    assert manifest.ingest(s3, "access-logs", ["logs/2025/01/01/"]) == 0
+
+    expected = usage_rows(aggregate_access_logs(LOG_LINES, ["ws1", "ws2"], start_time, end_time, timedelta(hours=1)))
+    assert sorted(manifest.usage(["ws1", "ws2"], start_time, end_time, timedelta(hours=1))) == sorted(expected)
+    assert sorted(manifest.usage(["ws2"], start_time, end_time)) == [("ws2", 0, "1.2.3.4", 0.0, 0, 1)]
+
+
+def test_manifest_only_covers_whole_periods_of_its_resolution(tmp_path: Path) -> None:
+    manifest = AccessLogManifest(str(tmp_path / "manifest.sqlite3"), resolution=timedelta(hours=1))
+
+    assert manifest.covers(
+        datetime(2025, 1, 1, 10, tzinfo=UTC), datetime(2025, 1, 2, 10, tzinfo=UTC), timedelta(days=1)
+    )
+    assert not manifest.covers(datetime(2025, 1, 1, 10, 30, tzinfo=UTC), datetime(2025, 1, 1, 11, 30, tzinfo=UTC))
+    assert not manifest.covers(
+        datetime(2025, 1, 1, 10, tzinfo=UTC), datetime(2025, 1, 1, 11, tzinfo=UTC), timedelta(minutes=30)
+    )
+
+
+def test_log_objects_are_aggregated_across_worker_processes(tmp_path: Path) -> None:
+    paths = []
+    for i, line in enumerate(LOG_LINES):
+        path = tmp_path / f"log{i}"
+        path.write_text(line)
+        paths.append(str(path))
+
+    start_time = datetime(2025, 1, 1, 10, tzinfo=UTC)
+    end_time = datetime(2025, 1, 1, 12, tzinfo=UTC)
+
+    totals = aggregate_access_log_objects(
+        map_access_log_file, paths, None, start_time, end_time, timedelta(hours=1), processes=2, objects_per_shard=3
+    )
+
+    assert totals == aggregate_access_logs(LOG_LINES, None, start_time, end_time, timedelta(hours=1))
+    assert totals[("ws3", 0, "1.2.3.4")] == [8, 1, 0]
+
+
+def test_partial_totals_are_merged() -> None:
+    totals = {("ws1", 0, "1.2.3.4"): [1, 2, 3]}
+
+    merge_totals(totals, {("ws1", 0, "1.2.3.4"): [10, 20, 30], ("ws2", 0, "1.2.3.4"): [0, 0, 1]})
+
+    assert totals == {("ws1", 0, "1.2.3.4"): [11, 22, 33], ("ws2", 0, "1.2.3.4"): [0, 0, 1]}
+
+
+def test_memory_mapped_log_files_give_the_same_records_as_parsing_lines(tmp_path: Path) -> None:
+    path = tmp_path / "log"
+    # Windows line endings and a missing final newline are both tolerated.
+    path.write_bytes(("".join(LOG_LINES[:3]).replace("\n", "\r\n") + "".join(LOG_LINES[3:])).rstrip("\n").encode())
+
+    records = list(map_access_log_file(str(path)))
+
+    assert records == list(parse_access_log_lines(LOG_LINES))
+    assert len(records) == len(LOG_LINES) - 1
+    assert records[0] == (
+        "01/Jan/2025:10:00:00 +0000",
+        "1.2.3.4",
+        "REST.GET.OBJECT",
+        "ws1/a.txt",
+        '"GET /ws1/a.txt HTTP/1.1"',
+        "100",
+    )
+
+
+def test_empty_log_files_have_no_records(tmp_path: Path) -> None:
+    path = tmp_path / "log"
+    path.write_bytes(b"")
+
+    assert list(map_access_log_file(str(path))) == []
+
+
+def test_written_workspaces_are_found_by_operation() -> None:
+    lines = [
+        *LOG_LINES,
+        log_line(
+            "01/Jan/2025:12:00:00 +0000",
+            "1.2.3.4",
+            "REST.DELETE.OBJECT",
+            "ws2/a.txt",
+            "DELETE /ws2/a.txt HTTP/1.1",
+            "-",
+        ),
+        log_line(
+            "01/Jan/2025:12:00:00 +0000", "1.2.3.4", "BATCH.DELETE.OBJECT", "ws4/a.txt", "POST /?delete HTTP/1.1", "-"
+        ),
+        log_line("01/Jan/2025:12:00:00 +0000", "-", "S3.EXPIRE.OBJECT", "ws5/a.txt", "-", "-"),
+    ]
+
+    records = list(parse_access_log_lines(lines))
+
+    assert written_workspaces(records, datetime(2025, 1, 1, tzinfo=UTC)) == {"ws1", "ws2", "ws4", "ws5"}
+    assert written_workspaces(records, datetime(2025, 1, 1, 11, 30, tzinfo=UTC)) == {"ws2", "ws4", "ws5"}
+    assert written_workspaces(records, datetime(2025, 1, 1, tzinfo=UTC), datetime(2025, 1, 1, 11, tzinfo=UTC)) == set()
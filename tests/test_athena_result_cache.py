@@ -0,0 +1,64 @@
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
+
+from accounting_s3_usage.sampler.athena_utils import AthenaResultCache
+
+
+def test_cached_results_are_returned_without_running_the_query(tmp_path: Path) -> None:
+    cache = AthenaResultCache(str(tmp_path / "cache.db"))
+    run = mock.Mock(return_value=iter([("18.175.49.181", 0.5, 3), ("-", 0.25, 1)]))
+
+    first = list(cache.cached_results("SELECT 1\n  FROM t", "db", run))
+
+    # Whitespace differences don't matter, and the cache survives being reopened.
+    cache = AthenaResultCache(str(tmp_path / "cache.db"))
+    second = list(cache.cached_results("SELECT 1 FROM t", "db", run))
+
+    assert first == second == [("18.175.49.181", 0.5, 3), ("-", 0.25, 1)]
+    run.assert_called_once()
+
+
+def test_partially_read_results_are_not_cached(tmp_path: Path) -> None:
+    cache = AthenaResultCache(str(tmp_path / "cache.db"))
+
+    results = cache.cached_results("SELECT 1", "db", lambda: iter([("a",), ("b",)]))
+    next(results)
+
+    assert cache.get("SELECT 1", "db") is None
+
+
+def test_results_for_different_databases_are_cached_separately(tmp_path: Path) -> None:
+    cache = AthenaResultCache(str(tmp_path / "cache.db"))
+    cache.put("SELECT 1", "db1", [("a",)])
+
+    assert cache.get("SELECT 1", "db1") == [("a",)]
+    assert cache.get("SELECT 1", "db2") is None
+
+
+def test_expired_results_are_not_returned(tmp_path: Path) -> None:
+    cache = AthenaResultCache(str(tmp_path / "cache.db"), max_age=timedelta(hours=1))
+
+    with mock.patch("accounting_s3_usage.sampler.athena_utils.time.time", return_value=1_000_000.0):
+        cache.put("SELECT 1", "db", [("a",)])
+
+    with mock.patch("accounting_s3_usage.sampler.athena_utils.time.time", return_value=1_000_000.0 + 3601):
+        assert cache.get("SELECT 1", "db") is None
+
+
+def test_least_recently_used_results_are_evicted_when_cache_is_full(tmp_path: Path) -> None:
+    cache = AthenaResultCache(str(tmp_path / "cache.db"), max_bytes=100)
+
+    with mock.patch("accounting_s3_usage.sampler.athena_utils.time.time") as time_mock:
+        time_mock.return_value = 1.0
+        cache.put("query 1", "db", [("x" * 30,)])
+        time_mock.return_value = 2.0
+        cache.put("query 2", "db", [("y" * 30,)])
+        time_mock.return_value = 3.0
+        cache.get("query 1", "db")
+        time_mock.return_value = 4.0
+        cache.put("query 3", "db", [("z" * 30,)])
+
+        assert cache.get("query 1", "db") == [("x" * 30,)]
+        assert cache.get("query 2", "db") is None
+        assert cache.get("query 3", "db") == [("z" * 30,)]
@@ -0,0 +1,123 @@
+from datetime import timedelta
+from unittest import mock
+
+import boto3
+import moto
+from botocore.client import BaseClient
+
+from accounting_s3_usage.sampler.bucket_listing import (
+    S3BucketListingStorage,
+    key_midpoint,
+    list_prefix_shard,
+    list_workspace_storage_sizes,
+    parallel_prefix_storage_size,
+)
+
+
+@moto.mock_aws
+def test_bucket_listing_sizes_every_workspace_in_one_pass() -> None:
+    s3 = boto3.client("s3", region_name="eu-west-2")
+    s3.create_bucket(Bucket="workspaces", CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+    s3.put_object(Bucket="workspaces", Key="ws1/a.txt", Body=b"x" * 100)
+    s3.put_object(Bucket="workspaces", Key="ws1/dir/b.txt", Body=b"x" * 20)
+    s3.put_object(Bucket="workspaces", Key="ws10/a.txt", Body=b"x" * 5)
+    s3.put_object(Bucket="workspaces", Key="top-level.txt", Body=b"x" * 7)
+
+    with mock.patch.object(s3, "get_paginator", wraps=s3.get_paginator) as get_paginator:
+        assert list_workspace_storage_sizes(s3, "workspaces") == {"ws1": 120, "ws10": 5}
+
+    get_paginator.assert_called_once_with("list_objects_v2")
+
+
+def test_bucket_listing_is_reused_until_it_expires() -> None:
+    storage = S3BucketListingStorage(max_age=timedelta(minutes=30))
+
+    with (
+        mock.patch(
+            "accounting_s3_usage.sampler.bucket_listing.list_workspace_storage_sizes", return_value={"ws1": 1}
+        ) as list_mock,
+        mock.patch("accounting_s3_usage.sampler.bucket_listing.time.monotonic") as monotonic,
+    ):
+        monotonic.return_value = 1000.0
+        first = storage.workspace_sizes(mock.Mock(), "workspaces")
+        monotonic.return_value = 1000.0 + 29 * 60
+        assert storage.workspace_sizes(mock.Mock(), "workspaces") == first
+        assert list_mock.call_count == 1
+
+        storage.workspace_sizes(mock.Mock(), "other")
+        assert list_mock.call_count == 2
+
+        monotonic.return_value = 1000.0 + 31 * 60
+        storage.workspace_sizes(mock.Mock(), "workspaces")
+        assert list_mock.call_count == 3
+
+
+def create_bucket_with_objects(keys: list[str]) -> BaseClient:
+    s3 = boto3.client("s3", region_name="eu-west-2")
+    s3.create_bucket(Bucket="workspaces", CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+    for size, key in enumerate(keys, start=1):
+        s3.put_object(Bucket="workspaces", Key=key, Body=b"x" * size)
+
+    return s3
+
+
+@moto.mock_aws
+def test_parallel_listing_counts_every_object_once() -> None:
+    keys = [
+        "ws1/a.txt",
+        "ws1/dir/b.txt",
+        "ws1/dir/sub/c.txt",
+        "ws1/dir/sub/deeper/d.txt",
+        "ws1/other/e.txt",
+        "ws1/empty-name/",
+        "ws1/flat/" + "é.txt",
+        *(f"ws1/flat/{i:03}.txt" for i in range(40)),
+        *(f"ws1/dir/{i:02}.txt" for i in range(9)),
+        "ws1x.txt",
+        "ws10/f.txt",
+        "ws2/g.txt",
+    ]
+    s3 = create_bucket_with_objects(keys)
+    expected = sum(size for size, key in enumerate(keys, start=1) if key.startswith("ws1"))
+
+    for page_size in (1, 2, 3, 7, 1000):
+        for max_workers in (1, 4):
+            assert (
+                parallel_prefix_storage_size(s3, "workspaces", "ws1", max_workers=max_workers, page_size=page_size)
+                == expected
+            )
+
+
+@moto.mock_aws
+def test_parallel_listing_lists_a_small_prefix_with_one_request() -> None:
+    s3 = create_bucket_with_objects(["ws1/a.txt", "ws1/dir/b.txt", "ws1/dir/sub/c.txt"])
+
+    with mock.patch.object(s3, "list_objects_v2", wraps=s3.list_objects_v2) as list_objects:
+        assert parallel_prefix_storage_size(s3, "workspaces", "ws1/", max_workers=4) == 6
+
+    list_objects.assert_called_once_with(Bucket="workspaces", Prefix="ws1/", MaxKeys=1000)
+
+
+@moto.mock_aws
+def test_parallel_listing_splits_flat_prefixes_by_key_range() -> None:
+    keys = [f"ws1/{i:04}.dat" for i in range(100)]
+    s3 = create_bucket_with_objects(keys)
+
+    with mock.patch(
+        "accounting_s3_usage.sampler.bucket_listing.list_prefix_shard", wraps=list_prefix_shard
+    ) as list_shard:
+        assert parallel_prefix_storage_size(s3, "workspaces", "ws1/", max_workers=4, page_size=10) == sum(
+            range(1, 101)
+        )
+
+    shards = [c.args[2] for c in list_shard.call_args_list]
+    assert all(shard.prefix == "ws1/" and shard.continuation_token is None for shard in shards)
+    assert any(shard.end is not None for shard in shards)
+
+
+def test_key_midpoint_is_between_its_bounds() -> None:
+    assert key_midpoint("ws1/a", "ws1/c") == "ws1/b"
+    assert "ws1/0999" < (key_midpoint("ws1/0999", "ws1/\x7f") or "") < "ws1/\x7f"
+    assert "a" < (key_midpoint("a", "b") or "") < "b"
+    assert key_midpoint("a", "a\x00") is None
+    assert key_midpoint("b", "a") is None
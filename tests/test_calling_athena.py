@@ -1,117 +1,18 @@
 from unittest import mock
 
+import boto3
+import moto
+import pytest
+from botocore.exceptions import ClientError
+
 from accounting_s3_usage.sampler.athena_utils import (
+    AthenaQueryEngine,
+    iter_csv_query_results,
+    run_athena_query,
+    run_csv_result_athena_query,
     run_long_result_athena_query,
-    run_single_result_athena_query,
 )
-
-
-def test_running_single_result_athena_query_produces_correct_value() -> None:
-    with (
-        mock.patch("accounting_s3_usage.sampler.athena_utils.boto3") as botomock,
-        mock.patch("accounting_s3_usage.sampler.athena_utils.time"),
-    ):
-        athenamock = botomock.client("athena")
-        athenamock.start_query_execution.return_value = {"QueryExecutionId": 123}
-        athenamock.get_query_execution.side_effect = [
-            {"QueryExecution": {"Status": {"State": "QUEUED"}}},
-            {"QueryExecution": {"Status": {"State": "RUNNING"}}},
-            {"QueryExecution": {"Status": {"State": "SUCCEEDED"}}},
-        ]
-
-        # This is a real-life API result from Athena.
-        athenamock.get_query_results.return_value = {
-            "UpdateCount": 0,
-            "ResultSet": {
-                "Rows": [
-                    {"Data": [{"VarCharValue": "total_api_calls"}]},
-                    {"Data": [{"VarCharValue": "166"}]},
-                ],
-                "ResultSetMetadata": {
-                    "ColumnInfo": [
-                        {
-                            "CatalogName": "hive",
-                            "SchemaName": "",
-                            "TableName": "",
-                            "Name": "total_api_calls",
-                            "Label": "total_api_calls",
-                            "Type": "bigint",
-                            "Precision": 19,
-                            "Scale": 0,
-                            "Nullable": "UNKNOWN",
-                            "CaseSensitive": False,
-                        }
-                    ]
-                },
-            },
-            "ResponseMetadata": {
-                "RequestId": "906106d7-ea38-4429-9551-7d2835eebc2f",
-                "HTTPStatusCode": 200,
-                "HTTPHeaders": {
-                    "date": "Wed, 07 May 2025 09:45:17 GMT",
-                    "content-type": "application/x-amz-json-1.1",
-                    "content-length": "379",
-                    "connection": "keep-alive",
-                    "x-amzn-requestid": "906106d7-ea38-4429-9551-7d2835eebc2f",
-                },
-                "RetryAttempts": 0,
-            },
-        }
-
-        result = run_single_result_athena_query("test query", "ATHENA_DB", "ATHENA_OUTPUT_BUCKET")
-        assert result == 166
-
-
-def test_running_single_result_athena_query_with_no_matching_rows_produces_correct_value() -> None:
-    with (
-        mock.patch("accounting_s3_usage.sampler.athena_utils.boto3") as botomock,
-        mock.patch("accounting_s3_usage.sampler.athena_utils.time"),
-    ):
-        athenamock = botomock.client("athena")
-        athenamock.start_query_execution.return_value = {"QueryExecutionId": 123}
-        athenamock.get_query_execution.return_value = {"QueryExecution": {"Status": {"State": "SUCCEEDED"}}}
-
-        # This is a real-life API result from Athena.
-        athenamock.get_query_results.return_value = {
-            "UpdateCount": 0,
-            "ResultSet": {
-                "Rows": [
-                    {"Data": [{"VarCharValue": "total_api_calls"}]},
-                    {"Data": [{"VarCharValue": "0"}]},
-                ],
-                "ResultSetMetadata": {
-                    "ColumnInfo": [
-                        {
-                            "CatalogName": "hive",
-                            "SchemaName": "",
-                            "TableName": "",
-                            "Name": "total_api_calls",
-                            "Label": "total_api_calls",
-                            "Type": "bigint",
-                            "Precision": 19,
-                            "Scale": 0,
-                            "Nullable": "UNKNOWN",
-                            "CaseSensitive": False,
-                        }
-                    ]
-                },
-            },
-            "ResponseMetadata": {
-                "RequestId": "ea4ebbd1-58bb-4cd8-959f-e89479697bf3",
-                "HTTPStatusCode": 200,
-                "HTTPHeaders": {
-                    "date": "Wed, 07 May 2025 09:55:42 GMT",
-                    "content-type": "application/x-amz-json-1.1",
-                    "content-length": "377",
-                    "connection": "keep-alive",
-                    "x-amzn-requestid": "ea4ebbd1-58bb-4cd8-959f-e89479697bf3",
-                },
-                "RetryAttempts": 0,
-            },
-        }
-
-        result = run_single_result_athena_query("test query", "ATHENA_DB", "ATHENA_OUTPUT_BUCKET")
-        assert result == 0.0
+from accounting_s3_usage.sampler.telemetry import AthenaCostTracker, ScanBudgetExceededError
 
 
 def test_running_long_result_athena_query_with_multiple_pages_produces_correct_values() -> None:
@@ -412,3 +313,225 @@ def test_running_long_result_athena_query_with_no_result_rows_produces_correct_v
         results = list(results_it)
 
         assert results == []
+
+
+def test_query_engine_resolves_futures_from_batched_polling() -> None:
+    athenamock = mock.MagicMock()
+    athenamock.start_query_execution.side_effect = [
+        {"QueryExecutionId": "q1"},
+        {"QueryExecutionId": "q2"},
+        {"QueryExecutionId": "q3"},
+    ]
+
+    def batch_get_query_execution(QueryExecutionIds: list[str]) -> dict:
+        states = {"q1": "SUCCEEDED", "q2": "FAILED", "q3": "RUNNING"}
+        if athenamock.batch_get_query_execution.call_count > 2:
+            states["q3"] = "SUCCEEDED"
+
+        return {
+            "QueryExecutions": [
+                {"QueryExecutionId": qid, "Status": {"State": states[qid]}} for qid in QueryExecutionIds
+            ],
+            "UnprocessedQueryExecutionIds": [],
+        }
+
+    athenamock.batch_get_query_execution.side_effect = batch_get_query_execution
+
+    engine = AthenaQueryEngine(athenamock, min_poll_interval=0.001, max_poll_interval=0.01)
+    futures = [engine.submit(f"query {i}", "ATHENA_DB", "ATHENA_OUTPUT_BUCKET") for i in range(3)]
+
+    assert futures[0].result(timeout=5) == "q1"
+    with pytest.raises(Exception, match="FAILED"):
+        futures[1].result(timeout=5)
+    assert futures[2].result(timeout=5) == "q3"
+
+    athenamock.get_query_execution.assert_not_called()
+    athenamock.start_query_execution.assert_any_call(
+        QueryString="query 0",
+        QueryExecutionContext={"Database": "ATHENA_DB"},
+        ResultConfiguration={"OutputLocation": "s3://ATHENA_OUTPUT_BUCKET/athena-results/"},
+    )
+
+
+def test_query_engine_limits_queries_in_flight() -> None:
+    athenamock = mock.MagicMock()
+    athenamock.start_query_execution.side_effect = [{"QueryExecutionId": f"q{i}"} for i in range(5)]
+
+    max_running = 0
+
+    def batch_get_query_execution(QueryExecutionIds: list[str]) -> dict:
+        nonlocal max_running
+        max_running = max(max_running, len(QueryExecutionIds))
+        return {
+            "QueryExecutions": [
+                {"QueryExecutionId": qid, "Status": {"State": "SUCCEEDED"}} for qid in QueryExecutionIds
+            ],
+            "UnprocessedQueryExecutionIds": [],
+        }
+
+    athenamock.batch_get_query_execution.side_effect = batch_get_query_execution
+
+    engine = AthenaQueryEngine(athenamock, max_in_flight=2, min_poll_interval=0.001, max_poll_interval=0.01)
+    futures = [engine.submit(f"query {i}", "ATHENA_DB", "ATHENA_OUTPUT_BUCKET") for i in range(5)]
+
+    assert sorted(f.result(timeout=5) for f in futures) == ["q0", "q1", "q2", "q3", "q4"]
+    assert max_running <= 2
+
+
+def test_query_engine_retries_queries_rejected_by_concurrency_quota() -> None:
+    athenamock = mock.MagicMock()
+    athenamock.start_query_execution.side_effect = [
+        ClientError({"Error": {"Code": "TooManyRequestsException"}}, "StartQueryExecution"),
+        {"QueryExecutionId": "q1"},
+    ]
+    athenamock.batch_get_query_execution.return_value = {
+        "QueryExecutions": [{"QueryExecutionId": "q1", "Status": {"State": "SUCCEEDED"}}],
+        "UnprocessedQueryExecutionIds": [],
+    }
+
+    engine = AthenaQueryEngine(athenamock, min_poll_interval=0.001, max_poll_interval=0.01)
+
+    assert engine.submit("query", "ATHENA_DB", "ATHENA_OUTPUT_BUCKET").result(timeout=5) == "q1"
+    assert athenamock.start_query_execution.call_count == 2
+
+
+def test_query_engine_records_costs_and_stops_starting_queries_over_budget() -> None:
+    athenamock = mock.MagicMock()
+    athenamock.start_query_execution.side_effect = [{"QueryExecutionId": f"q{i}"} for i in range(2)]
+    athenamock.batch_get_query_execution.side_effect = lambda QueryExecutionIds: {
+        "QueryExecutions": [
+            {
+                "QueryExecutionId": qid,
+                "Status": {"State": "SUCCEEDED"},
+                "Statistics": {"DataScannedInBytes": 2048, "EngineExecutionTimeInMillis": 150},
+            }
+            for qid in QueryExecutionIds
+        ],
+        "UnprocessedQueryExecutionIds": [],
+    }
+    costs = AthenaCostTracker(scan_budget_bytes=1024)
+
+    with (
+        mock.patch("accounting_s3_usage.sampler.athena_utils.athena_costs", costs),
+        mock.patch("accounting_s3_usage.sampler.telemetry.athena_costs", costs),
+    ):
+        engine = AthenaQueryEngine(athenamock, min_poll_interval=0.001, max_poll_interval=0.01)
+
+        assert engine.submit("query 0", "ATHENA_DB", "ATHENA_OUTPUT_BUCKET", kind="usage").result(timeout=5) == "q0"
+        assert costs.queries == {"usage": 1}
+        assert costs.data_scanned_bytes == {"usage": 2048}
+        assert costs.engine_execution_ms == {"usage": 150}
+        assert costs.over_budget()
+
+        with pytest.raises(ScanBudgetExceededError):
+            engine.submit("query 1", "ATHENA_DB", "ATHENA_OUTPUT_BUCKET").result(timeout=5)
+
+        assert athenamock.start_query_execution.call_count == 1
+
+        costs.reset()
+        assert not costs.over_budget()
+
+
+def test_queries_outside_the_engine_are_not_started_over_budget() -> None:
+    athenamock = mock.MagicMock()
+    costs = AthenaCostTracker(scan_budget_bytes=1024)
+    costs.record("usage", {"DataScannedInBytes": 2048})
+
+    with (
+        mock.patch("accounting_s3_usage.sampler.athena_utils.athena_costs", costs),
+        pytest.raises(ScanBudgetExceededError),
+    ):
+        run_athena_query(athenamock, "query", "ATHENA_DB", "ATHENA_OUTPUT_BUCKET")
+
+    athenamock.start_query_execution.assert_not_called()
+
+
+def test_long_result_query_with_engine_is_submitted_before_iteration() -> None:
+    engine = mock.MagicMock()
+    engine.submit.return_value.result.return_value = "q1"
+    engine.athena.get_paginator("get_query_results").paginate.return_value = [
+        {
+            "ResultSet": {
+                "Rows": [
+                    {"Data": [{"VarCharValue": "remoteip"}, {"VarCharValue": "total_gb_transferred"}]},
+                    {"Data": [{"VarCharValue": "18.175.49.181"}, {"VarCharValue": "0.02212107926607132"}]},
+                ]
+            }
+        }
+    ]
+
+    results_it = run_long_result_athena_query("test query", "ATHENA_DB", "ATHENA_OUTPUT_BUCKET", engine=engine)
+    engine.submit.assert_called_once_with("test query", "ATHENA_DB", "ATHENA_OUTPUT_BUCKET", False, "other", None)
+
+    assert list(results_it) == [("18.175.49.181", "0.02212107926607132")]
+    engine.athena.get_paginator("get_query_results").paginate.assert_called_with(
+        QueryExecutionId="q1", PaginationConfig={"PageSize": 100}
+    )
+
+
+@moto.mock_aws
+def test_csv_results_are_streamed_from_s3_as_typed_rows_without_nulls() -> None:
+    s3 = boto3.client("s3")
+    s3.create_bucket(Bucket="athena-output", CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+    s3.put_object(
+        Bucket="athena-output",
+        Key="athena-results/q1.csv",
+        Body=(
+            b'"remoteip","total_gb_transferred","object_api_calls"\n'
+            b'"-","0.008852269500494003","3"\n'
+            b'"18.175.49.181","0.02212107926607132","12"\n'
+            b'"3.8.0.146",,"2"\n'
+        ),
+    )
+
+    engine = mock.MagicMock()
+    engine.submit_execution.return_value.result.return_value = {
+        "QueryExecutionId": "q1",
+        "ResultConfiguration": {"OutputLocation": "s3://athena-output/athena-results/q1.csv"},
+    }
+
+    results_it = run_csv_result_athena_query(
+        "test query", "ATHENA_DB", "athena-output", (str, float, int), engine=engine
+    )
+    engine.submit_execution.assert_called_once_with("test query", "ATHENA_DB", "athena-output", False, "other", None)
+
+    assert list(results_it) == [("-", 0.008852269500494003, 3), ("18.175.49.181", 0.02212107926607132, 12)]
+
+
+@moto.mock_aws
+def test_csv_results_are_read_from_the_reused_executions_output_location() -> None:
+    s3 = boto3.client("s3")
+    s3.create_bucket(Bucket="athena-output", CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+    s3.put_object(Bucket="athena-output", Key="workgroup-results/q0.csv", Body=b'"total_api_calls"\n"7"\n')
+
+    athenamock = mock.MagicMock()
+    athenamock.start_query_execution.return_value = {"QueryExecutionId": "q1"}
+    athenamock.batch_get_query_execution.return_value = {
+        "QueryExecutions": [
+            {
+                "QueryExecutionId": "q1",
+                "Status": {"State": "SUCCEEDED"},
+                "ResultConfiguration": {"OutputLocation": "s3://athena-output/workgroup-results/q0.csv"},
+                "Statistics": {"ResultReuseInformation": {"ReusedPreviousResult": True}},
+            }
+        ],
+        "UnprocessedQueryExecutionIds": [],
+    }
+    engine = AthenaQueryEngine(athenamock, min_poll_interval=0.001, max_poll_interval=0.01)
+
+    results = run_csv_result_athena_query(
+        "test query", "ATHENA_DB", "athena-output", (int,), engine=engine, reuse_results=True
+    )
+
+    assert list(results) == [(7,)]
+
+
+@moto.mock_aws
+def test_csv_results_with_no_result_rows_produce_no_values() -> None:
+    s3 = boto3.client("s3")
+    s3.create_bucket(Bucket="athena-output", CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+    s3.put_object(Bucket="athena-output", Key="athena-results/q1.csv", Body=b'"total_api_calls"\n')
+
+    results = list(iter_csv_query_results(s3, lambda: "s3://athena-output/athena-results/q1.csv", (int,)))
+
+    assert results == []
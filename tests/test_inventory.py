@@ -0,0 +1,98 @@
+import gzip
+import json
+from datetime import UTC, datetime
+from unittest import mock
+
+import boto3
+import moto
+import pytest
+from botocore.client import BaseClient
+
+from accounting_s3_usage.sampler.inventory import S3InventoryStorage, workspace_storage_sizes
+
+FILE_SCHEMA = "Bucket, Key, VersionId, IsLatest, IsDeleteMarker, Size"
+
+
+def put_inventory_report(
+    s3: BaseClient,
+    report: str,
+    data_files: list[list[str]],
+    source_bucket: str = "workspaces",
+    complete: bool = True,
+) -> None:
+    prefix = f"inventory/workspaces/all/{report}/"
+    files = []
+    for i, rows in enumerate(data_files):
+        key = f"inventory/workspaces/all/data/{report}-{i}.csv.gz"
+        s3.put_object(Bucket="inventory-dest", Key=key, Body=gzip.compress("".join(rows).encode()))
+        files.append({"key": key, "size": 0, "MD5checksum": "0"})
+
+    manifest = {
+        "sourceBucket": source_bucket,
+        "destinationBucket": "arn:aws:s3:::inventory-dest",
+        "version": "2016-11-30",
+        "creationTimestamp": str(int(datetime.strptime(report, "%Y-%m-%dT%H-%MZ").replace(tzinfo=UTC).timestamp()))
+        + "000",
+        "fileFormat": "CSV",
+        "fileSchema": FILE_SCHEMA,
+        "files": files,
+    }
+    s3.put_object(Bucket="inventory-dest", Key=f"{prefix}manifest.json", Body=json.dumps(manifest).encode())
+    if complete:
+        s3.put_object(Bucket="inventory-dest", Key=f"{prefix}manifest.checksum", Body=b"0")
+
+
+def test_workspace_storage_sizes_count_current_objects_by_first_key_segment() -> None:
+    rows = [
+        {"Key": "ws1/a.txt", "IsLatest": "true", "IsDeleteMarker": "false", "Size": "100"},
+        {"Key": "ws1/dir/b+c%2B.txt", "IsLatest": "true", "IsDeleteMarker": "false", "Size": "20"},
+        {"Key": "ws10/a.txt", "IsLatest": "true", "IsDeleteMarker": "false", "Size": "5"},
+        {"Key": "ws1/old.txt", "IsLatest": "false", "IsDeleteMarker": "false", "Size": "1000"},
+        {"Key": "ws1/deleted.txt", "IsLatest": "true", "IsDeleteMarker": "true", "Size": ""},
+        {"Key": "top-level.txt", "IsLatest": "true", "IsDeleteMarker": "false", "Size": "7"},
+        {"Key": "ws2%2Fencoded.txt", "IsLatest": "true", "IsDeleteMarker": "false", "Size": "3"},
+    ]
+
+    assert workspace_storage_sizes(rows) == {"ws1": 120, "ws10": 5, "ws2": 3}
+
+
+@moto.mock_aws
+def test_inventory_storage_reads_latest_complete_report_once() -> None:
+    s3 = boto3.client("s3", region_name="eu-west-2")
+    s3.create_bucket(Bucket="inventory-dest", CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+
+    put_inventory_report(s3, "2025-01-01T01-00Z", [['"workspaces","ws1/a.txt","","true","false","100"\n']])
+    put_inventory_report(
+        s3,
+        "2025-01-02T01-00Z",
+        [
+            ['"workspaces","ws1/a.txt","","true","false","100"\n', '"workspaces","ws2/a.txt","","true","false","5"\n'],
+            ['"workspaces","ws1/b.txt","","true","false","50"\n'],
+        ],
+    )
+    put_inventory_report(
+        s3, "2025-01-03T01-00Z", [['"workspaces","ws1/a.txt","","true","false","1"\n']], complete=False
+    )
+
+    inventory = S3InventoryStorage("s3://inventory-dest/inventory/workspaces/all/")
+
+    with mock.patch.object(inventory, "read_manifest", wraps=inventory.read_manifest) as read_manifest:
+        assert inventory.workspace_sizes(s3, "workspaces") == (
+            datetime(2025, 1, 2, 1, 0, tzinfo=UTC),
+            {"ws1": 150, "ws2": 5},
+        )
+        assert inventory.workspace_sizes(s3, "workspaces")[1] == {"ws1": 150, "ws2": 5}
+
+    read_manifest.assert_called_once()
+
+
+@moto.mock_aws
+def test_inventory_storage_rejects_report_of_another_bucket() -> None:
+    s3 = boto3.client("s3", region_name="eu-west-2")
+    s3.create_bucket(Bucket="inventory-dest", CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+    put_inventory_report(s3, "2025-01-01T01-00Z", [[]], source_bucket="other")
+
+    inventory = S3InventoryStorage("s3://inventory-dest/inventory/workspaces/all")
+
+    with pytest.raises(Exception, match="not workspaces"):
+        inventory.workspace_sizes(s3, "workspaces")
@@ -0,0 +1,164 @@
+import ipaddress
+import random
+from pathlib import Path
+from typing import Any
+from unittest import mock
+
+import pytest
+
+from accounting_s3_usage.sampler import ip_classifier
+from accounting_s3_usage.sampler.ip_classifier import IPRangeIndex, cached_ip_range_index, ip_range_networks
+
+IP_RANGES = {
+    "prefixes": [
+        {"ip_prefix": "3.8.0.0/14", "region": "eu-west-2", "service": "AMAZON"},
+        {"ip_prefix": "3.8.0.0/16", "region": "eu-west-2", "service": "S3"},
+        {"ip_prefix": "3.0.0.0/9", "region": "GLOBAL", "service": "AMAZON"},
+        {"ip_prefix": "52.94.0.0/22", "region": "us-east-1", "service": "AMAZON"},
+        {"ip_prefix": "52.94.4.0/24", "region": "eu-west-2", "service": "AMAZON"},
+    ],
+    "ipv6_prefixes": [
+        {"ipv6_prefix": "2a05:d07a::/32", "region": "eu-west-2", "service": "AMAZON"},
+        {"ipv6_prefix": "2600:1f00::/24", "region": "us-east-1", "service": "AMAZON"},
+    ],
+}
+
+
+def build_index(ip_ranges: dict[str, Any] = IP_RANGES) -> IPRangeIndex:
+    return IPRangeIndex(
+        ip_range_networks(ip_ranges, "eu-west-2", "REGION", "INTERREGION"),
+        priority=["REGION", "INTERREGION"],
+        default="INTERNET",
+    )
+
+
+def test_range_index_classifies_ipv4_and_ipv6() -> None:
+    index = build_index()
+
+    assert index.classify("3.8.1.1") == "REGION"
+    assert index.classify("3.11.255.255") == "REGION"
+    assert index.classify("3.12.0.0") == "INTERREGION"
+    assert index.classify("2.255.255.255") == "INTERNET"
+    assert index.classify("3.128.0.0") == "INTERNET"
+    assert index.classify("52.94.3.255") == "INTERREGION"
+    assert index.classify("52.94.4.0") == "REGION"
+    assert index.classify("52.94.5.0") == "INTERNET"
+    assert index.classify("2a05:d07a:1::1") == "REGION"
+    assert index.classify("2600:1f00::1") == "INTERREGION"
+    assert index.classify("2001:db8::1") == "INTERNET"
+
+
+def test_overlapping_networks_are_merged_into_disjoint_ranges() -> None:
+    # 3.0.0.0/9 is split around 3.8.0.0/14, and the /16 inside the /14 adds nothing.
+    # 52.94.0.0/22 and 52.94.4.0/24 are adjacent but of different classes.
+    assert len(build_index()) == 3 + 2 + 2
+
+
+def test_range_index_agrees_with_scanning_networks() -> None:
+    networks = ip_range_networks(IP_RANGES, "eu-west-2", "REGION", "INTERREGION")
+    index = build_index()
+
+    def scan(ip: str) -> str:
+        address = ipaddress.ip_address(ip)
+        matches = {network_class for network, network_class in networks if address in network}
+        return next((c for c in ("REGION", "INTERREGION") if c in matches), "INTERNET")
+
+    rng = random.Random(0)
+    ips = [str(ipaddress.IPv4Address(rng.randrange(0x02000000, 0x35000000))) for _ in range(2000)]
+    ips += [str(network.network_address + rng.randrange(network.num_addresses)) for network, _ in networks]
+    ips += [str(network.broadcast_address + 1) for network, _ in networks]
+
+    for ip in ips:
+        assert index.classify(ip) == scan(ip), ip
+
+
+def test_classifying_many_agrees_with_classifying_each() -> None:
+    index = build_index()
+    rng = random.Random(0)
+
+    ips = [str(ipaddress.IPv4Address(rng.randrange(0x02000000, 0x35000000))) for _ in range(2000)]
+    ips += ["0.0.0.0", "255.255.255.255", "3.8.0.0", "3.8.1.1", "52.94.4.255", "2a05:d07a::", "2a05:d07a:1::1", "::1"]
+    ips += [str(ipaddress.IPv6Address(rng.getrandbits(128))) for _ in range(100)]
+    rng.shuffle(ips)
+
+    assert index.classify_many(ips) == [index.classify(ip) for ip in ips]
+    assert index.classify_many([]) == []
+
+
+def test_invalid_addresses_only_affect_their_own_classification() -> None:
+    index = build_index()
+
+    assert index.classify_many(["3.8.1.1", "not-an-ip", "", "3.8.1.1.1", "2600:1f00::1"]) == [
+        "REGION",
+        "INTERNET",
+        "INTERNET",
+        "INTERNET",
+        index.classify("2600:1f00::1"),
+    ]
+
+
+def test_saved_index_loads_with_the_same_classifications(tmp_path: Path) -> None:
+    index = build_index()
+    index.save(str(tmp_path / "index.bin"), {"sync_token": "1"})
+
+    loaded, metadata = IPRangeIndex.load(str(tmp_path / "index.bin"))
+
+    assert metadata == {"sync_token": "1"}
+    assert len(loaded) == len(index)
+
+    rng = random.Random(0)
+    ips = [str(ipaddress.IPv4Address(rng.randrange(0x02000000, 0x35000000))) for _ in range(2000)]
+    ips += ["0.0.0.0", "255.255.255.255", "3.8.0.0", "52.94.4.255", "2a05:d07a::", "2600:1f00::1", "::1"]
+
+    assert [loaded.classify(ip) for ip in ips] == [index.classify(ip) for ip in ips]
+    assert loaded.classify_many(ips) == index.classify_many(ips)
+
+
+def test_cached_index_is_only_rebuilt_when_ranges_change(tmp_path: Path) -> None:
+    cache_path = str(tmp_path / "index.bin")
+    build = mock.Mock(side_effect=build_index)
+
+    with mock.patch.object(ip_classifier, "fetch_ip_ranges", return_value=({**IP_RANGES, "syncToken": "1"}, '"a"')):
+        cached_ip_range_index("https://example.com/ip-ranges.json", cache_path, build, "eu-west-2")
+        assert build.call_count == 1
+
+    # Not modified since the cached ETag.
+    with mock.patch.object(ip_classifier, "fetch_ip_ranges", return_value=(None, '"a"')) as fetch_mock:
+        index = cached_ip_range_index("https://example.com/ip-ranges.json", cache_path, build, "eu-west-2")
+        fetch_mock.assert_called_once_with("https://example.com/ip-ranges.json", '"a"')
+        assert index.classify("3.8.1.1") == "REGION"
+
+    # A new ETag but the same syncToken.
+    with mock.patch.object(ip_classifier, "fetch_ip_ranges", return_value=({**IP_RANGES, "syncToken": "1"}, '"b"')):
+        cached_ip_range_index("https://example.com/ip-ranges.json", cache_path, build, "eu-west-2")
+        assert build.call_count == 1
+
+    # The new ETag is remembered.
+    with mock.patch.object(ip_classifier, "fetch_ip_ranges", return_value=(None, '"b"')) as fetch_mock:
+        cached_ip_range_index("https://example.com/ip-ranges.json", cache_path, build, "eu-west-2")
+        fetch_mock.assert_called_once_with("https://example.com/ip-ranges.json", '"b"')
+
+    # Built for another region.
+    with mock.patch.object(ip_classifier, "fetch_ip_ranges", return_value=({**IP_RANGES, "syncToken": "1"}, '"b"')):
+        cached_ip_range_index("https://example.com/ip-ranges.json", cache_path, build, "us-east-1")
+        assert build.call_count == 2
+
+    new_ranges = {"syncToken": "2", "prefixes": [{"ip_prefix": "3.8.0.0/14", "region": "us-east-1"}]}
+    with mock.patch.object(ip_classifier, "fetch_ip_ranges", return_value=(new_ranges, '"c"')):
+        index = cached_ip_range_index("https://example.com/ip-ranges.json", cache_path, build, "us-east-1")
+        assert build.call_count == 3
+        assert index.classify("3.8.1.1") == "INTERREGION"
+
+
+def test_cached_index_is_used_when_ranges_cannot_be_read(tmp_path: Path) -> None:
+    cache_path = str(tmp_path / "index.bin")
+    build_index().save(cache_path, {"build_key": "eu-west-2", "etag": '"a"', "sync_token": "1"})
+
+    with mock.patch.object(ip_classifier, "fetch_ip_ranges", side_effect=OSError("unreachable")):
+        index = cached_ip_range_index("https://example.com/ip-ranges.json", cache_path, build_index, "eu-west-2")
+        assert index.classify("3.8.1.1") == "REGION"
+
+        with pytest.raises(OSError, match="unreachable"):
+            cached_ip_range_index(
+                "https://example.com/ip-ranges.json", str(tmp_path / "missing.bin"), build_index, "eu-west-2"
+            )
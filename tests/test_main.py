@@ -1,9 +1,11 @@
+import threading
 from datetime import UTC, datetime, timedelta
 from unittest import mock
 
 import pytest
 from eodhp_utils.messagers import Messager
 
+from accounting_s3_usage.sampler import __main__ as sampler_main
 from accounting_s3_usage.sampler.__main__ import main_loop
 
 
@@ -76,3 +78,34 @@ def test_permanent_error_after_two_generation_persios_results_in_correct_generat
                 mock.call(datetime(2025, 1, 3, 3, 10, 1, tzinfo=UTC)),
             ]
         )
+
+
+def test_storage_sampling_and_access_billing_run_concurrently() -> None:
+    # Each pipeline waits for the other to start, which would time out if they ran one after the other.
+    both_running = threading.Barrier(2, timeout=5)
+
+    def wait_for_other_pipeline(requests: object) -> object:
+        both_running.wait()
+        return mock.DEFAULT
+
+    storage_runner = mock.Mock()
+    storage_runner.consume.side_effect = wait_for_other_pipeline
+    storage_runner.consume.return_value = Messager.Failures()
+    usage_runner = mock.Mock()
+    usage_runner.consume.side_effect = wait_for_other_pipeline
+    usage_runner.consume.return_value = Messager.Failures(temporary=True)
+
+    with (
+        mock.patch.object(sampler_main, "storage_messager", storage_runner),
+        mock.patch.object(sampler_main, "usage_messager", usage_runner),
+        mock.patch.object(sampler_main, "storage_size_cache", None),
+        mock.patch.object(sampler_main, "athena_costs") as athena_costs,
+        mock.patch.object(sampler_main, "generate_workspace_s3_access_point_list", return_value=iter([])),
+    ):
+        athena_costs.over_budget.return_value = False
+        failures = sampler_main.generate_billing_events(datetime(2025, 1, 1, tzinfo=UTC), timedelta(days=1))
+
+    storage_runner.consume.assert_called_once()
+    usage_runner.consume.assert_called_once()
+    assert failures.any_temporary()
+    assert not failures.any_permanent()
@@ -0,0 +1,186 @@
+from collections.abc import Iterator
+from datetime import UTC, datetime, timedelta
+from unittest import mock
+
+import boto3
+import moto
+import pytest
+
+from accounting_s3_usage.sampler import metrics
+
+
+@pytest.fixture(autouse=True)
+def event_time_partitions() -> Iterator[None]:
+    # Most query planning only applies to logs partitioned by request time.
+    with mock.patch.object(metrics, "LOGS_PARTITION_DATE_SOURCE", "EventTime"):
+        yield
+
+
+def test_whole_days_are_selected_by_partition_only() -> None:
+    condition = metrics.raw_log_time_filter_sql(
+        datetime(2025, 1, 1, 0, 0, 0, tzinfo=UTC), datetime(2025, 1, 3, 0, 0, 0, tzinfo=UTC)
+    )
+
+    assert condition == "timestamp IN ('2025/01/01', '2025/01/02') AND (timestamp IN ('2025/01/01', '2025/01/02'))"
+
+
+def test_partial_days_compare_time_of_day_strings() -> None:
+    condition = metrics.raw_log_time_filter_sql(
+        datetime(2025, 1, 1, 12, 0, 0, tzinfo=UTC), datetime(2025, 1, 3, 6, 30, 0, tzinfo=UTC)
+    )
+
+    assert condition.startswith("timestamp IN ('2025/01/01', '2025/01/02', '2025/01/03') AND (")
+    assert "timestamp IN ('2025/01/02')" in condition
+    assert "(timestamp = '2025/01/01' AND substr(requestdatetime, 13, 8) >= '12:00:00')" in condition
+    assert "(timestamp = '2025/01/03' AND substr(requestdatetime, 13, 8) < '06:30:00')" in condition
+    assert "parse_datetime" not in condition
+
+
+def test_hour_within_a_day_is_selected_by_time_of_day() -> None:
+    condition = metrics.raw_log_time_filter_sql(
+        datetime(2025, 1, 1, 5, 0, 0, tzinfo=UTC), datetime(2025, 1, 1, 6, 0, 0, tzinfo=UTC)
+    )
+
+    assert condition == (
+        "timestamp IN ('2025/01/01') AND ((timestamp = '2025/01/01' "
+        "AND substr(requestdatetime, 13, 8) >= '05:00:00' AND substr(requestdatetime, 13, 8) < '06:00:00'))"
+    )
+
+
+def test_delivery_time_partitions_fall_back_to_parsing_request_times() -> None:
+    with mock.patch.object(metrics, "LOGS_PARTITION_DATE_SOURCE", "DeliveryTime"):
+        condition = metrics.raw_log_time_filter_sql(
+            datetime(2025, 1, 1, 0, 0, 0, tzinfo=UTC), datetime(2025, 1, 2, 0, 0, 0, tzinfo=UTC)
+        )
+
+    assert metrics.REQUEST_TIME_SQL in condition
+    assert "timestamp BETWEEN '2025/01/01' AND '2025/01/02'" in condition
+
+
+def test_whole_day_interval_index_comes_from_partition() -> None:
+    index = metrics.raw_log_interval_index_sql(
+        datetime(2025, 1, 1, 0, 0, 0, tzinfo=UTC), datetime(2025, 1, 5, 0, 0, 0, tzinfo=UTC), timedelta(days=2)
+    )
+
+    assert index == (
+        "CASE timestamp WHEN '2025/01/01' THEN 0 WHEN '2025/01/02' THEN 0 "
+        "WHEN '2025/01/03' THEN 1 WHEN '2025/01/04' THEN 1 END"
+    )
+
+
+def test_sub_day_interval_index_uses_time_of_day() -> None:
+    index = metrics.raw_log_interval_index_sql(
+        datetime(2025, 1, 1, 22, 0, 0, tzinfo=UTC), datetime(2025, 1, 2, 2, 0, 0, tzinfo=UTC), timedelta(hours=1)
+    )
+
+    assert index.startswith("(CASE timestamp WHEN '2025/01/01' THEN 0 WHEN '2025/01/02' THEN 86400 END + ")
+    assert index.endswith(" - 79200) / 3600")
+    assert "parse_datetime" not in index
+
+
+def test_raw_usage_queries_do_not_parse_request_times_for_whole_days() -> None:
+    with (
+        mock.patch.object(metrics, "rolled_up_workspaces", {}),
+        mock.patch.object(metrics, "run_billing_query") as run_mock,
+    ):
+        metrics.get_workspaces_usage(
+            ["workspace1"],
+            datetime(2025, 1, 1, 0, 0, 0, tzinfo=UTC),
+            datetime(2025, 1, 3, 0, 0, 0, tzinfo=UTC),
+            timedelta(days=1),
+        )
+        assert "parse_datetime" not in run_mock.call_args.args[0]
+
+        metrics.get_access_point_usage(
+            "workspace1", datetime(2025, 1, 1, 0, 0, 0, tzinfo=UTC), datetime(2025, 1, 2, 0, 0, 0, tzinfo=UTC)
+        )
+        assert "parse_datetime" not in run_mock.call_args.args[0]
+
+
+def test_written_workspaces_query_selects_write_operations_by_partition() -> None:
+    with mock.patch.object(metrics, "run_billing_query", return_value=iter([("workspace1",)])) as run_mock:
+        written = metrics.get_workspaces_written_since(
+            datetime(2025, 1, 1, 0, 0, 0, tzinfo=UTC), datetime(2025, 1, 3, 0, 0, 0, tzinfo=UTC)
+        )
+
+    assert written == {"workspace1"}
+    query = run_mock.call_args.args[0]
+    assert "timestamp IN ('2025/01/01', '2025/01/02')" in query
+    assert f"regexp_like(operation, '{metrics.WRITE_OPERATIONS_REGEX}')" in query
+    assert "parse_datetime" not in query
+
+
+def test_usage_queries_classify_remote_ips_once_ip_ranges_are_loaded() -> None:
+    start_time = datetime(2025, 1, 1, 0, 0, 0, tzinfo=UTC)
+    end_time = datetime(2025, 1, 2, 0, 0, 0, tzinfo=UTC)
+
+    with (
+        mock.patch.object(metrics, "rolled_up_workspaces", {}),
+        mock.patch.object(metrics, "run_billing_query") as run_mock,
+    ):
+        metrics.get_workspaces_usage(["workspace1"], start_time, end_time, timedelta(hours=1))
+        assert metrics.ATHENA_IP_RANGES_TABLE not in run_mock.call_args.args[0]
+
+        with mock.patch.object(metrics, "ip_ranges_sync_token", "1700000000"):
+            metrics.get_workspaces_usage(["workspace1"], start_time, end_time, timedelta(hours=1))
+            batched_query = run_mock.call_args.args[0]
+
+            metrics.get_access_point_usage("workspace1", start_time, end_time)
+            query = run_mock.call_args.args[0]
+
+    assert f"LEFT JOIN {metrics.ATHENA_DB}.{metrics.ATHENA_IP_RANGES_TABLE} AS ranges" in batched_query
+    assert "contains(ranges.cidr, TRY_CAST(usage.remoteip AS IPADDRESS))" in batched_query
+    assert "SELECT workspace, interval_index, CASE WHEN remoteip = '-' THEN '-'" in batched_query
+    assert batched_query.rstrip().endswith("GROUP BY 1, 2, 3")
+
+    assert "SELECT CASE WHEN remoteip = '-' THEN '-'" in query
+    assert query.rstrip().endswith("GROUP BY 1")
+
+    # The logs are only scanned once.
+    for usage_query in (batched_query, query):
+        assert usage_query.count(f"FROM {metrics.ATHENA_DB}.{metrics.ATHENA_TABLE}\n") == 1
+
+
+def test_egress_classification_reads_the_usage_query_once() -> None:
+    usage_query = "SELECT workspace, remoteip, 1.0, 1, 0 FROM usage_table GROUP BY 1, 2"
+
+    query = metrics.egress_classified_sql(usage_query, ["workspace"])
+
+    assert query.count(usage_query) == 1
+    assert "GROUP BY 1, 2, 3, 4, 5\n" in query
+    assert query.rstrip().endswith("GROUP BY 1, 2")
+
+
+@moto.mock_aws
+def test_ip_ranges_table_is_only_rewritten_when_ranges_change() -> None:
+    s3 = boto3.client("s3", region_name="us-east-1")
+    bucket, prefix = metrics.split_s3_url(metrics.IP_RANGES_PREFIX)
+    s3.create_bucket(Bucket=bucket)
+
+    ip_ranges = {
+        "syncToken": "1700000000",
+        "prefixes": [
+            {"ip_prefix": "3.8.0.0/14", "region": "eu-west-2", "service": "AMAZON"},
+            {"ip_prefix": "3.8.0.0/14", "region": "eu-west-2", "service": "EC2"},
+            {"ip_prefix": "3.5.140.0/22", "region": "ap-northeast-2", "service": "S3"},
+        ],
+        "ipv6_prefixes": [{"ipv6_prefix": "2600:1f00::/24", "region": "GLOBAL", "service": "AMAZON"}],
+    }
+
+    with (
+        mock.patch.object(metrics, "ip_ranges_sync_token", None),
+        mock.patch.object(metrics, "AWS_REGION", "eu-west-2"),
+        mock.patch.object(metrics, "load_ip_ranges", return_value=ip_ranges),
+    ):
+        assert metrics.refresh_ip_ranges_table()
+        assert metrics.ip_ranges_sync_token == "1700000000"
+        assert not metrics.refresh_ip_ranges_table()
+
+    body = s3.get_object(Bucket=bucket, Key=f"{prefix}ip_ranges.csv")["Body"].read().decode()
+    assert body == "3.8.0.0/14,REGION\n3.5.140.0/22,INTERREGION\n2600:1f00::/24,INTERREGION\n"
+
+
+def test_billing_result_rows_with_nulls_are_skipped_rather_than_converted() -> None:
+    rows = [("1.2.3.4", "0.5", "3"), ("-", None, "1"), ("5.6.7.8", "0", "0")]
+
+    assert list(metrics.typed_rows(rows, (str, float, int))) == [("1.2.3.4", 0.5, 3), ("5.6.7.8", 0.0, 0)]
@@ -0,0 +1,150 @@
+from datetime import UTC, date, datetime, timedelta
+from unittest import mock
+
+import boto3
+import moto
+import pytest
+
+from accounting_s3_usage.sampler import metrics
+
+
+def test_days_touched_covers_half_open_period() -> None:
+    assert metrics.days_touched(
+        datetime(2025, 1, 1, 0, 0, 0, tzinfo=UTC), datetime(2025, 1, 2, 0, 0, 0, tzinfo=UTC)
+    ) == ["2025-01-01"]
+    assert metrics.days_touched(
+        datetime(2025, 1, 1, 23, 0, 0, tzinfo=UTC), datetime(2025, 1, 3, 1, 0, 0, tzinfo=UTC)
+    ) == ["2025-01-01", "2025-01-02", "2025-01-03"]
+
+
+def test_rollup_is_only_used_when_every_day_is_rolled_up_for_every_workspace() -> None:
+    rolled_up = {"2025-01-01": {"ws1", "ws2"}, "2025-01-02": {"ws1"}}
+    with mock.patch.object(metrics, "rolled_up_workspaces", rolled_up):
+        assert metrics.rollup_covers(
+            datetime(2025, 1, 1, 0, 0, 0, tzinfo=UTC), datetime(2025, 1, 3, 0, 0, 0, tzinfo=UTC), ["ws1"]
+        )
+        assert not metrics.rollup_covers(
+            datetime(2025, 1, 2, 0, 0, 0, tzinfo=UTC), datetime(2025, 1, 3, 0, 0, 1, tzinfo=UTC), ["ws1"]
+        )
+        # ws2's access point appeared after 2025-01-02 was rolled up.
+        assert metrics.rollup_covers(
+            datetime(2025, 1, 1, 0, 0, 0, tzinfo=UTC), datetime(2025, 1, 2, 0, 0, 0, tzinfo=UTC), ["ws1", "ws2"]
+        )
+        assert not metrics.rollup_covers(
+            datetime(2025, 1, 1, 0, 0, 0, tzinfo=UTC), datetime(2025, 1, 3, 0, 0, 0, tzinfo=UTC), ["ws1", "ws2"]
+        )
+
+
+def test_rollup_is_only_used_for_whole_periods_of_its_resolution() -> None:
+    start_time = datetime(2025, 1, 1, 0, 0, 0, tzinfo=UTC)
+    with (
+        mock.patch.object(metrics, "rolled_up_workspaces", {"2025-01-01": {"ws1"}}),
+        mock.patch.object(metrics, "ATHENA_ROLLUP_RESOLUTION_MINUTES", 60),
+    ):
+        assert metrics.rollup_covers(start_time, start_time + timedelta(hours=3), ["ws1"], timedelta(hours=1))
+        assert not metrics.rollup_covers(start_time, start_time + timedelta(minutes=90), ["ws1"])
+        assert not metrics.rollup_covers(start_time, start_time + timedelta(hours=3), ["ws1"], timedelta(minutes=30))
+
+
+def test_workspace_usage_reads_rollup_table_when_it_covers_the_period() -> None:
+    with (
+        mock.patch.object(metrics, "rolled_up_workspaces", {"2025-01-01": {"workspace1"}}),
+        mock.patch.object(metrics, "run_billing_query") as run_mock,
+    ):
+        metrics.get_workspaces_usage(
+            ["workspace1"], datetime(2025, 1, 1, 0, 0, 0, tzinfo=UTC), datetime(2025, 1, 2, 0, 0, 0, tzinfo=UTC)
+        )
+        query = run_mock.call_args.args[0]
+        assert f"FROM {metrics.ATHENA_DB}.{metrics.ATHENA_ROLLUP_TABLE}" in query
+        assert "day IN ('2025-01-01')" in query
+        assert "parse_datetime" not in query
+
+        metrics.get_workspaces_usage(
+            ["workspace1"], datetime(2025, 1, 2, 0, 0, 0, tzinfo=UTC), datetime(2025, 1, 3, 0, 0, 0, tzinfo=UTC)
+        )
+        query = run_mock.call_args.args[0]
+        assert f"FROM {metrics.ATHENA_DB}.{metrics.ATHENA_TABLE}\n" in query
+
+
+def test_rollup_table_is_created_through_the_shared_engine() -> None:
+    with mock.patch.object(metrics, "athena_engine") as engine_mock:
+        metrics.create_rollup_table()
+
+    engine_mock.submit.assert_called_once()
+    assert engine_mock.submit.call_args.kwargs == {"kind": "ddl"}
+    assert (
+        f"CREATE EXTERNAL TABLE IF NOT EXISTS {metrics.ATHENA_DB}.{metrics.ATHENA_ROLLUP_TABLE}"
+        in (engine_mock.submit.call_args.args[0])
+    )
+    engine_mock.submit.return_value.result.assert_called_once_with()
+
+
+@moto.mock_aws
+def test_rollup_replaces_partial_output_and_marks_workspaces_complete() -> None:
+    s3 = boto3.client("s3")
+    s3.create_bucket(Bucket="rollup-bucket", CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+    s3.put_object(Bucket="rollup-bucket", Key="rollup/t/day=2025-01-01/workspace=ws1/partial", Body=b"x")
+    s3.put_object(Bucket="rollup-bucket", Key="rollup/t/day=2025-01-01/workspace=ws0/complete", Body=b"x")
+    s3.put_object(Bucket="rollup-bucket", Key="rollup/t/day=2025-01-02/workspace=ws1/complete", Body=b"x")
+
+    with (
+        mock.patch.object(metrics, "ROLLUP_PREFIX", "s3://rollup-bucket/rollup/t/"),
+        mock.patch.object(metrics, "ROLLUP_MAX_PARTITIONS_PER_QUERY", 2),
+        mock.patch.object(metrics, "ATHENA_ROLLUP_RESOLUTION_MINUTES", 60),
+        mock.patch.object(metrics, "LOGS_PARTITION_DATE_SOURCE", "EventTime"),
+        mock.patch.object(metrics, "rolled_up_workspaces", {"2025-01-01": {"ws0"}}),
+        mock.patch.object(metrics, "athena_engine") as engine_mock,
+    ):
+        metrics.rollup_access_logs([date(2025, 1, 1)], ["ws0", "ws1", "ws2", "ws3"])
+
+        queries = [c.args[0] for c in engine_mock.submit.call_args_list]
+        assert len(queries) == 2
+        assert all("INSERT INTO" in q and "timestamp = '2025/01/01'" in q for q in queries)
+        # Entries are summed by hour, remote IP and workspace.
+        assert all("/ 3600 * 3600, TIMESTAMP '2025-01-01 00:00:00') AS requesttime" in q for q in queries)
+        assert all("GROUP BY requesttime, remoteip, workspace" in q for q in queries)
+        assert "IN ('ws1', 'ws2')" in queries[0]
+        assert "IN ('ws3')" in queries[1]
+
+        keys = [obj["Key"] for obj in s3.list_objects_v2(Bucket="rollup-bucket")["Contents"]]
+        assert "rollup/t/day=2025-01-01/workspace=ws1/partial" not in keys
+        assert "rollup/t/day=2025-01-01/workspace=ws0/complete" in keys
+        assert "rollup/t/day=2025-01-02/workspace=ws1/complete" in keys
+        assert "rollup/t/_rolled_up/2025-01-01/ws3" in keys
+        assert metrics.rolled_up_workspaces == {"2025-01-01": {"ws0", "ws1", "ws2", "ws3"}}
+
+        # A marker from before rollups were per workspace covers none of them.
+        s3.put_object(Bucket="rollup-bucket", Key="rollup/t/_rolled_up/2024-12-31", Body=b"")
+        metrics.rolled_up_workspaces.clear()
+        assert metrics.load_rolled_up_workspaces() == {"2025-01-01": {"ws1", "ws2", "ws3"}}
+
+
+def test_rollup_is_refused_without_event_time_partitions() -> None:
+    with (
+        mock.patch.object(metrics, "LOGS_PARTITION_DATE_SOURCE", "DeliveryTime"),
+        mock.patch.object(metrics, "athena_engine") as engine_mock,
+        pytest.raises(Exception, match="DeliveryTime"),
+    ):
+        metrics.rollup_access_logs([date(2025, 1, 1)], ["ws1"])
+
+    engine_mock.submit.assert_not_called()
+
+
+def test_only_settled_days_which_are_not_rolled_up_are_rolled_up() -> None:
+    now = datetime.now(UTC)
+    today = now.date()
+
+    with (
+        mock.patch.object(
+            metrics,
+            "rolled_up_workspaces",
+            {(today - timedelta(days=3)).isoformat(): {"ws1"}, (today - timedelta(days=2)).isoformat(): {"ws2"}},
+        ),
+        mock.patch.object(metrics, "rollup_access_logs") as rollup_mock,
+    ):
+        metrics.rollup_settled_days(["ws1"], now - timedelta(days=3))
+
+        days = rollup_mock.call_args.args[0]
+        assert today - timedelta(days=3) not in days
+        assert today - timedelta(days=2) in days
+        assert today not in days
@@ -7,11 +7,14 @@ import pytest
 
 from accounting_s3_usage.sampler.sample_requests import (
     GenerateAccessBillingEventRequestMsg,
+    GenerateBatchedAccessBillingEventRequestMsg,
     SampleStorageUseRequestMsg,
     generate_access_billing_requests,
+    generate_batched_access_billing_requests,
     generate_sample_times,
     generate_storage_sample_requests,
     generate_workspace_s3_access_point_list,
+    group_consecutive_intervals,
 )
 
 orig_moto = botocore.client.BaseClient._make_api_call
@@ -174,6 +177,99 @@ def test_sample_request_generation_produces_correct_requests_for_time_intervals(
         }
 
 
+@mock.patch("accounting_s3_usage.sampler.sample_requests.AWS_BUCKET_NAME", "ws-bucket")
+@mock.patch("accounting_s3_usage.sampler.sample_requests.AWS_PREFIX", "aws-prefix-")
+@moto.mock_aws
+def test_batched_request_generation_produces_one_request_per_interval_covering_all_workspaces() -> None:
+    with mock.patch("botocore.client.BaseClient._make_api_call", new=mock_make_api_call):
+        intervals: list[tuple[datetime, datetime]] = [
+            (
+                datetime(2025, 1, 1, 0, 0, 0, tzinfo=UTC),
+                datetime(2025, 1, 2, 0, 0, 0, tzinfo=UTC),
+            ),
+            (
+                datetime(2025, 1, 2, 0, 0, 0, tzinfo=UTC),
+                datetime(2025, 1, 3, 0, 0, 0, tzinfo=UTC),
+            ),
+        ]
+
+        requests = list(generate_batched_access_billing_requests(generate_workspace_s3_access_point_list(), intervals))
+
+        assert requests == [
+            GenerateBatchedAccessBillingEventRequestMsg(
+                workspaces=("workspace1", "workspace3", "workspace4"),
+                bucket_name="ws-bucket",
+                interval_start=interval[0],
+                interval_end=interval[1],
+            )
+            for interval in intervals
+        ]
+
+        assert set(requests[0].workspace_requests()) == {
+            (
+                0,
+                GenerateAccessBillingEventRequestMsg(
+                    workspace=workspace,
+                    bucket_name="ws-bucket",
+                    interval_start=intervals[0][0],
+                    interval_end=intervals[0][1],
+                ),
+            )
+            for workspace in ["workspace1", "workspace3", "workspace4"]
+        }
+
+
+@mock.patch("accounting_s3_usage.sampler.sample_requests.AWS_BUCKET_NAME", "ws-bucket")
+@mock.patch("accounting_s3_usage.sampler.sample_requests.AWS_PREFIX", "aws-prefix-")
+@moto.mock_aws
+def test_interval_batched_request_generation_covers_each_workspaces_intervals_with_one_request() -> None:
+    with mock.patch("botocore.client.BaseClient._make_api_call", new=mock_make_api_call):
+        intervals = [
+            (
+                datetime(2025, 1, 1, hour, 0, 0, tzinfo=UTC),
+                datetime(2025, 1, 1, hour + 1, 0, 0, tzinfo=UTC),
+            )
+            for hour in range(5)
+        ]
+
+        requests = list(
+            generate_batched_access_billing_requests(
+                generate_workspace_s3_access_point_list(),
+                intervals,
+                batch_workspaces=False,
+                batch_intervals=True,
+            )
+        )
+
+        assert requests == [
+            GenerateBatchedAccessBillingEventRequestMsg(
+                workspaces=(workspace,),
+                bucket_name="ws-bucket",
+                interval_start=datetime(2025, 1, 1, 0, 0, 0, tzinfo=UTC),
+                interval_end=datetime(2025, 1, 1, 5, 0, 0, tzinfo=UTC),
+                interval=timedelta(hours=1),
+            )
+            for workspace in ["workspace1", "workspace3", "workspace4"]
+        ]
+
+        assert requests[0].intervals() == intervals
+        assert [index for index, _ in requests[0].workspace_requests()] == [0, 1, 2, 3, 4]
+
+
+def test_consecutive_interval_grouping_splits_at_gaps_and_size_limit() -> None:
+    intervals = [
+        (datetime(2025, 1, 1, hour, 0, 0, tzinfo=UTC), datetime(2025, 1, 1, hour + 1, 0, 0, tzinfo=UTC))
+        for hour in [0, 1, 2, 3, 4, 10, 11]
+    ]
+
+    assert list(group_consecutive_intervals(intervals, 3)) == [
+        (datetime(2025, 1, 1, 0, 0, 0, tzinfo=UTC), datetime(2025, 1, 1, 3, 0, 0, tzinfo=UTC), timedelta(hours=1)),
+        (datetime(2025, 1, 1, 3, 0, 0, tzinfo=UTC), datetime(2025, 1, 1, 5, 0, 0, tzinfo=UTC), timedelta(hours=1)),
+        (datetime(2025, 1, 1, 10, 0, 0, tzinfo=UTC), datetime(2025, 1, 1, 12, 0, 0, tzinfo=UTC), timedelta(hours=1)),
+    ]
+    assert list(group_consecutive_intervals([], 3)) == []
+
+
 @mock.patch("accounting_s3_usage.sampler.sample_requests.AWS_BUCKET_NAME", "ws-bucket")
 @mock.patch("accounting_s3_usage.sampler.sample_requests.AWS_PREFIX", "aws-prefix-")
 @moto.mock_aws
@@ -0,0 +1,83 @@
+from datetime import UTC, datetime, timedelta
+from pathlib import Path
+from unittest import mock
+
+from accounting_s3_usage.sampler.storage_cache import StorageSizeCache
+
+
+def make_cache(tmp_path: Path) -> StorageSizeCache:
+    return StorageSizeCache(str(tmp_path / "sizes.sqlite3"), max_age=timedelta(days=7), log_delay=timedelta(hours=3))
+
+
+def test_cached_sizes_are_reused_for_unwritten_workspaces(tmp_path: Path) -> None:
+    cache = make_cache(tmp_path)
+    sampled = datetime(2025, 1, 1, tzinfo=UTC)
+    now = sampled + timedelta(days=1)
+
+    cache.put("bucket", "ws1", 1.5, sampled)
+    cache.put("bucket", "ws2", 2.5, sampled + timedelta(hours=1))
+
+    # Nothing is reused until the changes have been checked.
+    assert cache.get("bucket", "ws1", now) is None
+
+    written_since = mock.Mock(return_value={"ws2"})
+    cache.refresh_changes(written_since, now)
+
+    written_since.assert_called_once_with(sampled, now)
+    assert cache.get("bucket", "ws1", now) == 1.5
+    assert cache.get("bucket", "ws2", now) is None
+    assert cache.get("bucket", "ws3", now) is None
+    assert cache.get("other", "ws1", now) is None
+
+    # Sizes older than the maximum age are always refreshed.
+    assert cache.get("bucket", "ws1", sampled + timedelta(days=8)) is None
+
+
+def test_later_checks_only_read_the_logs_since_the_last_one(tmp_path: Path) -> None:
+    cache = make_cache(tmp_path)
+    sampled = datetime(2025, 1, 1, tzinfo=UTC)
+    first_check = sampled + timedelta(days=1)
+    second_check = first_check + timedelta(days=1)
+
+    cache.put("bucket", "ws1", 1.5, sampled)
+    cache.put("bucket", "ws2", 2.5, sampled)
+    cache.refresh_changes(mock.Mock(return_value={"ws2"}), first_check)
+
+    # ws2 is listed again after the first check, and ws1 is written after it. The check's state
+    # is kept in the database, so it carries over to a new cache.
+    cache.put("bucket", "ws2", 3.0, first_check + timedelta(hours=1))
+    cache = make_cache(tmp_path)
+    written_since = mock.Mock(return_value={"ws1"})
+    cache.refresh_changes(written_since, second_check)
+
+    written_since.assert_called_once_with(first_check - timedelta(hours=3), second_check)
+    assert cache.get("bucket", "ws1", second_check) is None
+    assert cache.get("bucket", "ws2", second_check) == 3.0
+
+
+def test_sizes_sampled_before_the_first_check_are_not_reused(tmp_path: Path) -> None:
+    cache = make_cache(tmp_path)
+    sampled = datetime(2025, 1, 1, tzinfo=UTC)
+
+    cache.put("bucket", "ws1", 1.5, sampled)
+    cache.refresh_changes(mock.Mock(return_value=set()), sampled + timedelta(days=1))
+    cache.put("bucket", "ws1", 3.0, sampled - timedelta(days=1))
+
+    assert cache.get("bucket", "ws1", sampled + timedelta(days=1)) is None
+
+
+def test_failed_change_check_lists_every_workspace(tmp_path: Path) -> None:
+    cache = make_cache(tmp_path)
+    sampled = datetime(2025, 1, 1, tzinfo=UTC)
+    now = sampled + timedelta(days=1)
+    cache.put("bucket", "ws1", 1.5, sampled)
+    cache.refresh_changes(mock.Mock(return_value=set()), now)
+
+    cache.refresh_changes(mock.Mock(side_effect=Exception("Athena failed")), now + timedelta(days=1))
+    assert cache.get("bucket", "ws1", now + timedelta(days=1)) is None
+
+    # The next check covers the failed one's period too.
+    written_since = mock.Mock(return_value=set())
+    cache.refresh_changes(written_since, now + timedelta(days=2))
+    written_since.assert_called_once_with(now - timedelta(hours=3), now + timedelta(days=2))
+    assert cache.get("bucket", "ws1", now + timedelta(days=2)) == 1.5
@@ -0,0 +1,167 @@
+import json
+import sqlite3
+from contextlib import closing
+from datetime import timedelta
+from pathlib import Path
+from typing import Any
+from unittest import mock
+
+import boto3
+import moto
+
+from accounting_s3_usage.sampler.storage_events import StorageEventTotals, storage_event_records
+
+
+def event(name: str, key: str, sequencer: str, size: int | None = None) -> dict[str, Any]:
+    obj: dict[str, Any] = {"key": key, "sequencer": sequencer}
+    if size is not None:
+        obj["size"] = size
+
+    return {"eventSource": "aws:s3", "eventName": name, "s3": {"bucket": {"name": "workspaces"}, "object": obj}}
+
+
+def test_storage_event_records_are_read_from_direct_and_sns_notifications() -> None:
+    records = [event("ObjectCreated:Put", "ws1/a.txt", "01", 10)]
+
+    assert list(storage_event_records(json.dumps({"Records": records}))) == records
+    assert list(storage_event_records(json.dumps({"Message": json.dumps({"Records": records})}))) == records
+    assert list(storage_event_records(json.dumps({"Event": "s3:TestEvent"}))) == []
+
+
+def test_events_keep_running_totals(tmp_path: Path) -> None:
+    totals = StorageEventTotals(str(tmp_path / "totals.sqlite3"))
+
+    applied = totals.apply(
+        [
+            event("ObjectCreated:Put", "ws1/a.txt", "0A", 100),
+            event("ObjectCreated:Put", "ws1/dir/b%2Bc.txt", "0B", 20),
+            event("ObjectCreated:Put", "ws2/a.txt", "0C", 5),
+            event("ObjectCreated:Put", "top-level.txt", "0D", 1000),
+            # An overwrite replaces the object's size.
+            event("ObjectCreated:Put", "ws1/a.txt", "0E", 60),
+            event("ObjectRemoved:Delete", "ws2/a.txt", "0F"),
+            event("ObjectRemoved:DeleteMarkerCreated", "ws1/dir/b%2Bc.txt", "10"),
+        ]
+    )
+
+    assert applied == 6
+    assert totals.workspace_sizes("workspaces") == {"ws1": 60, "ws2": 0}
+
+
+def test_redelivered_and_out_of_order_events_are_ignored(tmp_path: Path) -> None:
+    totals = StorageEventTotals(str(tmp_path / "totals.sqlite3"))
+
+    totals.apply([event("ObjectCreated:Put", "ws1/a.txt", "0100", 100)])
+    totals.apply([event("ObjectCreated:Put", "ws1/a.txt", "0100", 100)])
+    # Sequencers of different lengths compare as numbers.
+    totals.apply([event("ObjectRemoved:Delete", "ws1/a.txt", "FF")])
+    assert totals.workspace_sizes("workspaces") == {"ws1": 100}
+
+    totals.apply([event("ObjectRemoved:Delete", "ws1/a.txt", "0101")])
+    totals.apply([event("ObjectCreated:Put", "ws1/a.txt", "00FF", 100)])
+    assert totals.workspace_sizes("workspaces") == {"ws1": 0}
+
+
+@moto.mock_aws
+def test_events_are_consumed_from_queue(tmp_path: Path) -> None:
+    sqs = boto3.client("sqs", region_name="eu-west-2")
+    queue_url = sqs.create_queue(QueueName="storage-events")["QueueUrl"]
+
+    for i in range(25):
+        records = [event("ObjectCreated:Put", f"ws1/{i}.txt", f"{i:04X}", 10)]
+        sqs.send_message(QueueUrl=queue_url, MessageBody=json.dumps({"Records": records}))
+
+    totals = StorageEventTotals(str(tmp_path / "totals.sqlite3"))
+
+    assert totals.consume(sqs, queue_url) == 25
+    assert totals.workspace_sizes("workspaces") == {"ws1": 250}
+    assert "Messages" not in sqs.receive_message(QueueUrl=queue_url)
+
+
+def test_reconciliation_corrects_drift(tmp_path: Path) -> None:
+    totals = StorageEventTotals(str(tmp_path / "totals.sqlite3"), reconcile_interval=timedelta(hours=24))
+    totals.apply([event("ObjectCreated:Put", "ws1/a.txt", "01", 100)])
+
+    assert totals.reconcile("workspaces", "ws1", lambda bucket, workspace: 150) == 50
+    assert totals.workspace_sizes("workspaces") == {"ws1": 150}
+
+    # Later events apply on top of the reconciled total.
+    totals.apply([event("ObjectRemoved:Delete", "ws1/a.txt", "02")])
+    assert totals.workspace_sizes("workspaces") == {"ws1": 50}
+
+
+def test_only_workspaces_due_reconciliation_are_listed(tmp_path: Path) -> None:
+    totals = StorageEventTotals(str(tmp_path / "totals.sqlite3"), reconcile_interval=timedelta(hours=24))
+    totals.reconcile("workspaces", "ws1", lambda bucket, workspace: 10)
+
+    listed_size = mock.Mock(return_value=20)
+    assert totals.reconcile_due("workspaces", ["ws1", "ws2"], listed_size) == set()
+    totals._reconciler.shutdown(wait=True)
+
+    listed_size.assert_called_once_with("workspaces", "ws2")
+    assert totals.workspace_sizes("workspaces") == {"ws1": 10, "ws2": 20}
+
+
+def test_workspaces_never_reconciled_are_reconciled_before_returning(tmp_path: Path) -> None:
+    totals = StorageEventTotals(str(tmp_path / "totals.sqlite3"), reconcile_interval=timedelta(hours=24))
+    totals.apply([event("ObjectCreated:Put", "ws1/a.txt", "01", 100)])
+
+    with mock.patch.object(totals, "_reconciler") as reconciler:
+        assert totals.reconcile_due("workspaces", ["ws1", "ws2"], lambda bucket, workspace: 500) == set()
+
+    reconciler.submit.assert_not_called()
+    assert totals.workspace_sizes("workspaces") == {"ws1": 500, "ws2": 500}
+
+
+def test_workspaces_which_fail_their_first_reconciliation_are_returned(tmp_path: Path) -> None:
+    totals = StorageEventTotals(str(tmp_path / "totals.sqlite3"), reconcile_interval=timedelta(hours=24))
+    totals.apply([event("ObjectCreated:Put", "ws1/a.txt", "01", 100)])
+
+    listed_size = mock.Mock(side_effect=Exception("listing failed"))
+    assert totals.reconcile_due("workspaces", ["ws1"], listed_size) == {"ws1"}
+
+    # Once it succeeds, the workspace can be sampled.
+    listed_size.side_effect = None
+    listed_size.return_value = 100
+    assert totals.reconcile_due("workspaces", ["ws1"], listed_size) == set()
+
+
+def test_objects_from_before_the_first_event_drift_until_the_next_reconciliation(tmp_path: Path) -> None:
+    totals = StorageEventTotals(str(tmp_path / "totals.sqlite3"), reconcile_interval=timedelta(hours=24))
+    # ws1/old.txt, of 100 bytes, has had no events.
+    totals.reconcile("workspaces", "ws1", lambda bucket, workspace: 100)
+
+    totals.apply([event("ObjectCreated:Put", "ws1/old.txt", "01", 60)])
+    totals.apply([event("ObjectCreated:Put", "ws1/new.txt", "02", 10)])
+    assert totals.workspace_sizes("workspaces") == {"ws1": 170}
+
+    assert totals.reconcile("workspaces", "ws1", lambda bucket, workspace: 70) == -100
+    assert totals.workspace_sizes("workspaces") == {"ws1": 70}
+
+    # Once recorded, the object's changes are exact.
+    totals.apply([event("ObjectRemoved:Delete", "ws1/old.txt", "03")])
+    assert totals.workspace_sizes("workspaces") == {"ws1": 10}
+
+
+def test_reconciliation_forgets_old_deleted_objects(tmp_path: Path) -> None:
+    totals = StorageEventTotals(str(tmp_path / "totals.sqlite3"), reconcile_interval=timedelta(hours=24))
+
+    with mock.patch("time.time", return_value=1_000_000.0):
+        totals.apply(
+            [
+                event("ObjectCreated:Put", "ws1/a.txt", "01", 100),
+                event("ObjectRemoved:Delete", "ws1/a.txt", "02"),
+                event("ObjectCreated:Put", "ws1/b.txt", "03", 10),
+                event("ObjectRemoved:Delete", "ws2/a.txt", "04"),
+            ]
+        )
+    totals.apply([event("ObjectCreated:Put", "ws1/c.txt", "05", 20), event("ObjectRemoved:Delete", "ws1/c.txt", "06")])
+
+    totals.reconcile("workspaces", "ws1", lambda bucket, workspace: 10)
+
+    with closing(sqlite3.connect(totals.path)) as conn:
+        assert sorted(conn.execute("SELECT key, size FROM objects")) == [
+            ("ws1/b.txt", 10),
+            ("ws1/c.txt", None),
+            ("ws2/a.txt", None),
+        ]
@@ -71,3 +71,168 @@ def test_storage_sample_correctly_calculated_from_computed_storage_use(
 
         assert payloads["workspace2-AWS-S3-STORAGE"].sample_time == "2025-01-01T12:00:01+00:00"
         assert payloads["workspace2-AWS-S3-STORAGE"].rate == 0
+
+
+def test_storage_samples_from_inventory_read_each_bucket_once(
+    sampler_messager: S3StorageSamplerMessager,
+) -> None:
+    report_time = datetime(2025, 1, 1, 1, 0, 0, tzinfo=UTC)
+
+    with (
+        mock.patch("accounting_s3_usage.sampler.messager.STORAGE_SAMPLE_BACKEND", "inventory"),
+        mock.patch("accounting_s3_usage.sampler.messager.get_inventory_storage_sizes") as inventory_mock,
+        mock.patch("accounting_s3_usage.sampler.messager.get_prefix_storage_size") as storage_size_mock,
+    ):
+        inventory_mock.return_value = (report_time, {"workspace1": 100.5, "other": 1.0})
+
+        actions = sampler_messager.process_msg(
+            iter(
+                [
+                    SampleStorageUseRequestMsg(workspace="workspace1", bucket_name="bucket1", access_point_name="ap1"),
+                    SampleStorageUseRequestMsg(workspace="workspace2", bucket_name="bucket1", access_point_name="ap2"),
+                ]
+            )
+        )
+
+        samples = [
+            cast(BillingResourceConsumptionRateSample, a.payload)
+            for a in actions
+            if isinstance(a, Messager.PulsarMessageAction)
+        ]
+
+    inventory_mock.assert_called_once_with("bucket1")
+    storage_size_mock.assert_not_called()
+
+    assert [(s.workspace, s.rate, s.sample_time) for s in samples] == [
+        ("workspace1", 100.5, "2025-01-01T01:00:00+00:00"),
+        ("workspace2", 0, "2025-01-01T01:00:00+00:00"),
+    ]
+
+
+def test_storage_samples_from_bucket_listing_include_empty_workspaces(
+    sampler_messager: S3StorageSamplerMessager,
+) -> None:
+    listing_time = datetime(2025, 1, 1, 12, 0, 0, tzinfo=UTC)
+
+    with (
+        mock.patch("accounting_s3_usage.sampler.messager.STORAGE_SAMPLE_BACKEND", "bucket"),
+        mock.patch("accounting_s3_usage.sampler.messager.get_bucket_storage_sizes") as listing_mock,
+    ):
+        listing_mock.return_value = (listing_time, {"workspace1": 2.5})
+
+        actions = sampler_messager.process_msg(
+            iter(
+                [
+                    SampleStorageUseRequestMsg(workspace="workspace1", bucket_name="bucket1", access_point_name="ap1"),
+                    SampleStorageUseRequestMsg(workspace="workspace2", bucket_name="bucket1", access_point_name="ap2"),
+                ]
+            )
+        )
+
+        samples = [
+            cast(BillingResourceConsumptionRateSample, a.payload)
+            for a in actions
+            if isinstance(a, Messager.PulsarMessageAction)
+        ]
+
+    listing_mock.assert_called_once_with("bucket1")
+    assert {s.workspace: s.rate for s in samples} == {"workspace1": 2.5, "workspace2": 0}
+
+
+def test_storage_samples_from_events_reconcile_requested_workspaces(
+    sampler_messager: S3StorageSamplerMessager,
+) -> None:
+    with (
+        mock.patch("accounting_s3_usage.sampler.messager.STORAGE_SAMPLE_BACKEND", "events"),
+        mock.patch("accounting_s3_usage.sampler.messager.get_event_storage_sizes") as totals_mock,
+        mock.patch("accounting_s3_usage.sampler.messager.reconcile_event_storage_totals") as reconcile_mock,
+    ):
+        totals_mock.return_value = (datetime(2025, 1, 1, 12, 0, 0, tzinfo=UTC), {"workspace1": 2.5})
+        reconcile_mock.return_value = set()
+
+        actions = list(
+            sampler_messager.process_msg(
+                iter(
+                    [
+                        SampleStorageUseRequestMsg(
+                            workspace="workspace1", bucket_name="bucket1", access_point_name="ap1"
+                        ),
+                        SampleStorageUseRequestMsg(
+                            workspace="workspace2", bucket_name="bucket1", access_point_name="ap2"
+                        ),
+                    ]
+                )
+            )
+        )
+
+    reconcile_mock.assert_called_once_with("bucket1", ["workspace1", "workspace2"])
+    totals_mock.assert_called_once_with("bucket1")
+    assert len(actions) == 2
+
+
+def test_storage_samples_from_events_skip_workspaces_never_reconciled(
+    sampler_messager: S3StorageSamplerMessager,
+) -> None:
+    with (
+        mock.patch("accounting_s3_usage.sampler.messager.STORAGE_SAMPLE_BACKEND", "events"),
+        mock.patch("accounting_s3_usage.sampler.messager.get_event_storage_sizes") as totals_mock,
+        mock.patch("accounting_s3_usage.sampler.messager.reconcile_event_storage_totals", return_value={"workspace2"}),
+    ):
+        totals_mock.return_value = (datetime(2025, 1, 1, 12, 0, 0, tzinfo=UTC), {"workspace1": 2.5})
+
+        actions = list(
+            sampler_messager.process_msg(
+                iter(
+                    [
+                        SampleStorageUseRequestMsg(
+                            workspace="workspace1", bucket_name="bucket1", access_point_name="ap1"
+                        ),
+                        SampleStorageUseRequestMsg(
+                            workspace="workspace2", bucket_name="bucket1", access_point_name="ap2"
+                        ),
+                    ]
+                )
+            )
+        )
+
+        samples = [
+            cast(BillingResourceConsumptionRateSample, a.payload)
+            for a in actions
+            if isinstance(a, Messager.PulsarMessageAction)
+        ]
+
+    assert {s.workspace: s.rate for s in samples} == {"workspace1": 2.5}
+
+
+def test_cached_storage_sizes_skip_listing(
+    sampler_messager: S3StorageSamplerMessager,
+) -> None:
+    cache = mock.Mock()
+    cache.get.side_effect = [7.0, None]
+
+    with (
+        mock.patch("accounting_s3_usage.sampler.messager.storage_size_cache", cache),
+        mock.patch("accounting_s3_usage.sampler.messager.get_prefix_storage_size") as storage_size_mock,
+    ):
+        storage_size_mock.return_value = 3.0
+
+        samples = [
+            cast(BillingResourceConsumptionRateSample, a.payload)
+            for a in sampler_messager.process_msg(
+                iter(
+                    [
+                        SampleStorageUseRequestMsg(
+                            workspace="workspace1", bucket_name="bucket1", access_point_name="ap1"
+                        ),
+                        SampleStorageUseRequestMsg(
+                            workspace="workspace2", bucket_name="bucket1", access_point_name="ap2"
+                        ),
+                    ]
+                )
+            )
+            if isinstance(a, Messager.PulsarMessageAction)
+        ]
+
+    storage_size_mock.assert_called_once_with("bucket1", "workspace2")
+    cache.put.assert_called_once_with("bucket1", "workspace2", 3.0, mock.ANY)
+    assert {s.workspace: s.rate for s in samples} == {"workspace1": 7.0, "workspace2": 3.0}
@@ -0,0 +1,38 @@
+from unittest import mock
+
+from accounting_s3_usage.sampler.usage_columns import UsageColumns
+
+
+def test_usage_rows_are_dictionary_encoded() -> None:
+    usage = UsageColumns()
+    usage.extend("ws1", [("1.2.3.4", "1.5", "2", "0"), ("5.6.7.8", 0.5, 1, 0)])
+    usage.extend("ws2", [("1.2.3.4", 3.0, 3, 1), (None, None, 0, 4)])
+
+    assert usage.groups == ["ws1", "ws2"]
+    assert usage.ips == ["1.2.3.4", "5.6.7.8", "-"]
+    assert list(usage.group) == [0, 0, 1, 1]
+    assert list(usage.ip) == [0, 1, 0, 2]
+    assert list(usage.gb) == [1.5, 0.5, 3.0, 0.0]
+    assert list(usage.object_calls) == [2, 1, 3, 0]
+    assert list(usage.listing_calls) == [0, 0, 1, 4]
+
+
+def test_sku_totals_classify_all_charged_ips_at_once() -> None:
+    usage = UsageColumns()
+    usage.add_group("empty")
+    usage.extend("ws1", [("1.2.3.4", 1.5, 2, 0), ("5.6.7.8", 0.5, 1, 0), ("-", 7.0, 1, 1)])
+    usage.extend("ws2", [("1.2.3.4", 3.0, 3, 1), ("9.9.9.9", 0.0, 0, 4)])
+
+    skus = {"1.2.3.4": "REGION", "5.6.7.8": "INTERNET"}
+    transfer_skus = mock.Mock(side_effect=lambda ips: [skus.get(ip) for ip in ips])
+
+    totals = usage.sku_totals(transfer_skus, "API-CALLS")
+
+    assert totals == [
+        {"API-CALLS": 0},
+        {"REGION": 1.5, "INTERNET": 0.5, "API-CALLS": 5},
+        {"REGION": 3.0, "API-CALLS": 8},
+    ]
+    # 9.9.9.9 only made listings, so there's no transfer to it to classify.
+    transfer_skus.assert_called_once()
+    assert sorted(transfer_skus.call_args.args[0]) == ["-", "1.2.3.4", "5.6.7.8"]
@@ -1,4 +1,4 @@
-from datetime import UTC, datetime
+from datetime import UTC, datetime, timedelta
 from typing import cast
 from unittest import mock
 
@@ -9,6 +9,7 @@ from eodhp_utils.pulsar.messages import BillingEvent
 from accounting_s3_usage.sampler.messager import S3AccessBillingEventMessager
 from accounting_s3_usage.sampler.sample_requests import (
     GenerateAccessBillingEventRequestMsg,
+    GenerateBatchedAccessBillingEventRequestMsg,
 )
 
 
@@ -27,23 +28,20 @@ def test_no_logged_requests_means_messager_produces_no_messages(
 def test_data_transfer_and_api_calls_correctly_calculated_from_athena_results(
     sampler_messager: S3AccessBillingEventMessager,
 ) -> None:
-    with (
-        mock.patch("accounting_s3_usage.sampler.messager.get_access_point_data_transfer") as dt_mock,
-        mock.patch("accounting_s3_usage.sampler.messager.get_access_point_api_calls") as api_mock,
-    ):
-        dt_mock.side_effect = [
+    with mock.patch("accounting_s3_usage.sampler.messager.get_access_point_usage") as usage_mock:
+        usage_mock.side_effect = [
             (
-                ("3.8.0.146", "42.3"),
-                ("3.8.0.147", "42.42"),  # Same region
-                ("89.241.216.125", "22.3"),
-                ("89.241.216.126", "22.4"),  # Internet
-                ("3.5.140.0", "10.0"),  # Different region
-                ("-", "14"),  # Observed in logs
-                (None, "10.2"),  # Never observed in logs, but just in case
+                ("3.8.0.146", "42.3", "100", "0"),
+                ("3.8.0.147", "42.42", "100", "0"),  # Same region
+                ("89.241.216.125", "22.3", "50", "0"),
+                ("89.241.216.126", "22.4", "50", "0"),  # Internet
+                ("3.5.140.0", "10.0", "10", "0"),  # Different region
+                ("-", "14", "2", "2"),  # Observed in logs
+                (None, "10.2", "0", "0"),  # Never observed in logs, but just in case
+                ("3.8.0.148", "0.0", "0", "5"),  # Listings only
             ),
-            (("3.8.0.146", "12.3"),),
+            (("3.8.0.146", "12.3", "1", "0"),),
         ]
-        api_mock.side_effect = [314.0, 0]
 
         actions = sampler_messager.process_msg(
             iter(
@@ -91,23 +89,19 @@ def test_data_transfer_and_api_calls_correctly_calculated_from_athena_results(
         assert by_key["workspace1-AWS-S3-DATA-TRANSFER-OUT-INTERNET"].quantity == 22.3 + 22.4
         assert by_key["workspace1-AWS-S3-DATA-TRANSFER-OUT-REGION"].quantity == 42.3 + 42.42
         assert by_key["workspace1-AWS-S3-DATA-TRANSFER-OUT-INTERREGION"].quantity == 10.0
-        assert by_key["workspace1-AWS-S3-API-CALLS"].quantity == 314
+        assert by_key["workspace1-AWS-S3-API-CALLS"].quantity == 319
         assert by_key["workspace2-AWS-S3-DATA-TRANSFER-OUT-REGION"].quantity == 12.3
-        assert by_key["workspace2-AWS-S3-API-CALLS"].quantity == 0
+        assert by_key["workspace2-AWS-S3-API-CALLS"].quantity == 1
 
 
 def test_dup_sample_request_result_in_msgs_with_same_uuid(
     sampler_messager: S3AccessBillingEventMessager,
 ) -> None:
-    with (
-        mock.patch("accounting_s3_usage.sampler.messager.get_access_point_data_transfer") as dt_mock,
-        mock.patch("accounting_s3_usage.sampler.messager.get_access_point_api_calls") as api_mock,
-    ):
-        dt_mock.side_effect = [
-            (("3.8.0.146", "42.3"),),
-            (("3.8.0.146", "12.3"),),
+    with mock.patch("accounting_s3_usage.sampler.messager.get_access_point_usage") as usage_mock:
+        usage_mock.side_effect = [
+            (("3.8.0.146", "42.3", "314", "0"),),
+            (("3.8.0.146", "12.3", "1", "0"),),
         ]
-        api_mock.side_effect = [314.0, 0]
 
         actions = sampler_messager.process_msg(
             iter(
@@ -130,3 +124,131 @@ def test_dup_sample_request_result_in_msgs_with_same_uuid(
         assert events[0].uuid != events[1].uuid
         assert events[0].uuid == events[2].uuid
         assert events[1].uuid == events[3].uuid
+
+
+def test_batched_request_fans_out_into_per_workspace_events(
+    sampler_messager: S3AccessBillingEventMessager,
+) -> None:
+    with mock.patch("accounting_s3_usage.sampler.messager.get_workspaces_usage") as usage_mock:
+        usage_mock.return_value = (
+            ("workspace1", "0", "3.8.0.146", "42.3", "300", "0"),
+            ("workspace1", "0", "89.241.216.125", "22.3", "10", "4"),
+            ("workspace2", "0", "3.8.0.146", "12.3", "1", "0"),
+            ("workspace2", "0", "-", "14", "1", "1"),
+        )
+
+        batch = GenerateBatchedAccessBillingEventRequestMsg(
+            workspaces=("workspace1", "workspace2", "workspace3"),
+            bucket_name="bucket1",
+            interval_start=datetime(2025, 2, 2, 12, 00, 00, tzinfo=UTC),
+            interval_end=datetime(2025, 2, 2, 13, 00, 00, tzinfo=UTC),
+        )
+        results = list(sampler_messager.process_msg(iter([batch])))
+
+        usage_mock.assert_called_once_with(batch.workspaces, batch.interval_start, batch.interval_end, None)
+
+        events = [cast(BillingEvent, a.payload) for a in results if isinstance(a, Messager.PulsarMessageAction)]
+        by_key = {f"{e.workspace}-{e.sku}": e for e in events}
+
+        assert set(by_key) == {
+            "workspace1-AWS-S3-DATA-TRANSFER-OUT-REGION",
+            "workspace1-AWS-S3-DATA-TRANSFER-OUT-INTERNET",
+            "workspace1-AWS-S3-API-CALLS",
+            "workspace2-AWS-S3-DATA-TRANSFER-OUT-REGION",
+            "workspace2-AWS-S3-API-CALLS",
+            "workspace3-AWS-S3-API-CALLS",
+        }
+
+        assert by_key["workspace1-AWS-S3-DATA-TRANSFER-OUT-REGION"].quantity == 42.3
+        assert by_key["workspace1-AWS-S3-DATA-TRANSFER-OUT-INTERNET"].quantity == 22.3
+        assert by_key["workspace1-AWS-S3-API-CALLS"].quantity == 314
+        assert by_key["workspace2-AWS-S3-DATA-TRANSFER-OUT-REGION"].quantity == 12.3
+        assert by_key["workspace2-AWS-S3-API-CALLS"].quantity == 3
+        assert by_key["workspace3-AWS-S3-API-CALLS"].quantity == 0
+
+        # Events must be identical to those from unbatched requests so that switching modes
+        # doesn't produce duplicate billing.
+        unbatched = sampler_messager.generate_billing_event(
+            next(batch.workspace_requests())[1], "AWS-S3-API-CALLS", 314
+        ).payload
+        assert by_key["workspace1-AWS-S3-API-CALLS"].uuid == unbatched.uuid
+
+
+def test_interval_batched_request_splits_rows_back_into_per_interval_events(
+    sampler_messager: S3AccessBillingEventMessager,
+) -> None:
+    with mock.patch("accounting_s3_usage.sampler.messager.get_workspaces_usage") as usage_mock:
+        usage_mock.return_value = (
+            ("workspace1", "0", "3.8.0.146", "1.5", "10", "0"),
+            ("workspace1", "2", "3.8.0.146", "2.5", "15", "5"),
+        )
+
+        batch = GenerateBatchedAccessBillingEventRequestMsg(
+            workspaces=("workspace1",),
+            bucket_name="bucket1",
+            interval_start=datetime(2025, 2, 2, 0, 00, 00, tzinfo=UTC),
+            interval_end=datetime(2025, 2, 2, 3, 00, 00, tzinfo=UTC),
+            interval=timedelta(hours=1),
+        )
+        results = list(sampler_messager.process_msg(iter([batch])))
+
+        events = [cast(BillingEvent, a.payload) for a in results if isinstance(a, Messager.PulsarMessageAction)]
+        by_key = {f"{e.event_start}-{e.sku}": e for e in events}
+
+        assert set(by_key) == {
+            "2025-02-02T00:00:00+00:00-AWS-S3-DATA-TRANSFER-OUT-REGION",
+            "2025-02-02T00:00:00+00:00-AWS-S3-API-CALLS",
+            "2025-02-02T01:00:00+00:00-AWS-S3-API-CALLS",
+            "2025-02-02T02:00:00+00:00-AWS-S3-DATA-TRANSFER-OUT-REGION",
+            "2025-02-02T02:00:00+00:00-AWS-S3-API-CALLS",
+        }
+
+        assert by_key["2025-02-02T00:00:00+00:00-AWS-S3-DATA-TRANSFER-OUT-REGION"].quantity == 1.5
+        assert by_key["2025-02-02T00:00:00+00:00-AWS-S3-API-CALLS"].quantity == 10
+        assert by_key["2025-02-02T01:00:00+00:00-AWS-S3-API-CALLS"].quantity == 0
+        assert by_key["2025-02-02T02:00:00+00:00-AWS-S3-DATA-TRANSFER-OUT-REGION"].quantity == 2.5
+        assert by_key["2025-02-02T02:00:00+00:00-AWS-S3-API-CALLS"].quantity == 20
+        assert by_key["2025-02-02T01:00:00+00:00-AWS-S3-API-CALLS"].event_end == "2025-02-02T02:00:00+00:00"
+
+
+def test_usage_classified_by_athena_is_charged_by_egress_class(
+    sampler_messager: S3AccessBillingEventMessager,
+) -> None:
+    with mock.patch("accounting_s3_usage.sampler.messager.get_workspaces_usage") as usage_mock:
+        usage_mock.return_value = (
+            ("workspace1", "0", "REGION", "84.72", "200", "0"),
+            ("workspace1", "0", "INTERREGION", "10.0", "10", "0"),
+            ("workspace1", "0", "INTERNET", "44.7", "100", "5"),
+            ("workspace1", "0", "-", "14", "2", "2"),
+        )
+
+        batch = GenerateBatchedAccessBillingEventRequestMsg(
+            workspaces=("workspace1",),
+            bucket_name="bucket1",
+            interval_start=datetime(2025, 2, 2, 12, 00, 00, tzinfo=UTC),
+            interval_end=datetime(2025, 2, 2, 13, 00, 00, tzinfo=UTC),
+        )
+        results = list(sampler_messager.process_msg(iter([batch])))
+
+        events = [cast(BillingEvent, a.payload) for a in results if isinstance(a, Messager.PulsarMessageAction)]
+        by_sku = {e.sku: e.quantity for e in events}
+
+        assert by_sku == {
+            "AWS-S3-DATA-TRANSFER-OUT-REGION": 84.72,
+            "AWS-S3-DATA-TRANSFER-OUT-INTERREGION": 10.0,
+            "AWS-S3-DATA-TRANSFER-OUT-INTERNET": 44.7,
+            "AWS-S3-API-CALLS": 319,
+        }
+
+
+def test_aws_ip_classifier_is_only_built_without_an_ip_range_index() -> None:
+    ip_ranges = {"prefixes": [{"ip_prefix": "3.8.0.0/14", "region": "eu-west-2", "service": "AMAZON"}]}
+
+    with (
+        mock.patch("accounting_s3_usage.sampler.messager.EGRESS_IP_RANGES_URL", "https://example.com/ip-ranges.json"),
+        mock.patch("accounting_s3_usage.sampler.messager.load_ip_ranges", return_value=ip_ranges),
+        mock.patch("accounting_s3_usage.sampler.messager.AWSIPClassifier") as classifier_mock,
+    ):
+        S3AccessBillingEventMessager().transfer_skus(["3.8.0.1", "8.8.8.8"])
+
+    classifier_mock.assert_not_called()